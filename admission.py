@@ -0,0 +1,84 @@
+import contextvars
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import jsonify
+
+import metrics
+import tracing
+
+# Simulations solved at once, more only fight over the same cores
+MAX_SIMULATIONS = int(os.environ.get("MAX_SIMULATIONS", os.cpu_count() or 1))
+# Simulations allowed to wait for a free slot before requests are turned away
+MAX_QUEUED_SIMULATIONS = int(os.environ.get("MAX_QUEUED_SIMULATIONS", 16))
+# Starting guess of a simulation's duration in seconds, used for Retry-After
+EXPECTED_DURATION = float(os.environ.get("EXPECTED_SIMULATION_SECONDS", 30))
+
+_pool = ThreadPoolExecutor(MAX_SIMULATIONS, thread_name_prefix="simulation")
+_lock = threading.Lock()
+_in_flight = {}  # result key -> Future shared by every identical request
+_pending = 0  # admitted simulations, running or queued
+_average_duration = EXPECTED_DURATION
+
+
+class Busy(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server busy, retry in {retry_after} s")
+        self.retry_after = retry_after
+
+
+# Seconds until a slot is likely free, from the recent simulation durations
+def retry_after() -> int:
+    waves = max(_pending - MAX_SIMULATIONS + 1, 1) / MAX_SIMULATIONS
+    return max(1, math.ceil(_average_duration * waves))
+
+
+def _run(key: str, function, submitted_at: float):
+    global _pending, _average_duration
+    metrics.simulations_queued.dec()
+    tracing.record("queue", submitted_at)
+    started = time.perf_counter()
+    try:
+        with tracing.profile_thread():
+            return function()
+    finally:
+        duration = time.perf_counter() - started
+        with _lock:
+            _pending -= 1
+            _in_flight.pop(key, None)
+            _average_duration = 0.8 * _average_duration + 0.2 * duration
+
+
+# Runs function() on the simulation pool once per key: identical requests that
+# arrive while it runs wait for the same result. When the queue is full it raises
+# Busy, unless `block` is set (jobs, which already waited in their own queue).
+def run_once(key: str, function, labels: dict, block: bool = False):
+    global _pending
+    with _lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            metrics.deduplicated_requests.inc(**labels)
+        else:
+            if not block and _pending >= MAX_SIMULATIONS + MAX_QUEUED_SIMULATIONS:
+                metrics.admission_rejections.inc(**labels)
+                raise Busy(retry_after())
+            _pending += 1
+            metrics.simulations_queued.inc()
+            # The copied context carries the trace and the Flask app context along
+            context = contextvars.copy_context()
+            future = _pool.submit(
+                context.run, _run, key, function, time.perf_counter()
+            )
+            _in_flight[key] = future
+    with tracing.span("wait"):
+        return future.result()
+
+
+def busy_response(error: Busy):
+    response = jsonify(["ERROR: " + str(error)])
+    response.status_code = 503
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
@@ -0,0 +1,668 @@
+# Benchmarks for the lab endpoints and the utils hot paths.
+#
+#     python benchmark.py run --output before.json
+#     python benchmark.py run --suite labs --sizes small typical --output after.json
+#     python benchmark.py compare before.json after.json
+#     python benchmark.py validate --labs lab2
+#     python benchmark.py fidelity
+#
+# Every lab case runs in a fresh process so its peak RSS is its own, with the
+# result cache and cycling checkpoints disabled and lab1's process pool reduced to
+# --workers.
+#
+# validate runs the payloads on every solver backend that is available, compares
+# their graphs with the CasADi reference and writes the fastest equivalent backend
+# of each lab to solver_backends.json, where the labs pick it up. fidelity times
+# lab2's fidelity tiers and measures their error against standard, for the errors
+# recorded in lab2.FIDELITY_TIERS.
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Fixed payloads per lab and size, "worst" is the longest run (50 cycles, 5 C rates)
+# that stays clear of bounded cycling
+PAYLOADS = {
+    "lab1": {
+        "small": {
+            "Type": "NMC",
+            "Ambient temperature [K]": 298.15,
+            "Nominal cell capacity [A.h]": 5,
+            "C Rates": [1],
+            "Cycles": 1,
+        },
+        "typical": {
+            "Type": "NMC",
+            "Ambient temperature [K]": 298.15,
+            "Nominal cell capacity [A.h]": 5,
+            "C Rates": [0.5, 1, 2],
+            "Cycles": 10,
+        },
+        "worst": {
+            "Type": "NMC",
+            "Ambient temperature [K]": 298.15,
+            "Nominal cell capacity [A.h]": 5,
+            "C Rates": [0.5, 1, 2, 3, 4],
+            "Cycles": 50,
+        },
+    },
+    "lab2": {
+        "small": {
+            "Ambient temperature [K]": 298.15,
+            "C Rates": [1],
+            "Silicon Percentage": 0.1,
+            "Cycles": 1,
+            "Negative electrode thickness [um]": 85,
+            "Separator thickness [um]": 12,
+        },
+        "typical": {
+            "Ambient temperature [K]": 298.15,
+            "C Rates": [1],
+            "Silicon Percentage": 0.1,
+            "Cycles": 5,
+            "Negative electrode thickness [um]": 85,
+            "Separator thickness [um]": 12,
+        },
+        "worst": {
+            "Ambient temperature [K]": 298.15,
+            "C Rates": [2],
+            "Silicon Percentage": 0.2,
+            "Cycles": 50,
+            "Negative electrode thickness [um]": 85,
+            "Separator thickness [um]": 12,
+        },
+    },
+    "lab3": {
+        size: {
+            "Type": "NMC",
+            "Initial SOC": 10,
+            "Charging Properties": {
+                "Charge C": charge_c,
+                "Charge V": 4.2,
+                "Hold V": 4.2,
+                "Hold C": 0.05,
+                "Rest T": 5,
+                "Discharge C": 1,
+                "Discharge V": 3,
+                "Rest 2T": 5,
+                "Cycles": cycles,
+            },
+        }
+        for size, charge_c, cycles in (
+            ("small", 1, 2),
+            ("typical", 1, 10),
+            ("worst", 2, 50),
+        )
+    },
+}
+
+SIZES = ["small", "typical", "worst"]
+LAB_METRICS = ["wall_time", "solve_time", "peak_rss_mb", "response_bytes"]
+# Micro benchmarks are timed call by call, this many calls per --repeat
+MICRO_ROUNDS = 10
+MICRO_BENCHMARKS = [
+    "interpolate_array",
+    "plot_against_cycle",
+    "transform_to_inverse_bezier_curve",
+    "extract_values_from_sub_sol",
+]
+# Payload sizes validation runs, the worst ones take minutes per backend
+VALIDATION_SIZES = ["small", "typical"]
+# Largest difference between a backend's graphs and the reference's, relative to the
+# range of each reference series, for the backend to count as equivalent
+VALIDATION_TOLERANCE = 1e-3
+# lab2 variables each fidelity error covers: the throughput capacity summary, then
+# the lithium in electrodes and loss of lithium traces
+FIDELITY_OUTPUTS = {
+    "capacity": ["Throughput capacity [A.h]"],
+    "lithium inventory": [
+        "Total lithium in positive electrode [mol]",
+        "Total lithium in negative electrode [mol]",
+        "Total lithium [mol]",
+        "Loss of lithium inventory [%]",
+    ],
+}
+# Points of each cycle the traces are compared at
+FIDELITY_CYCLE_POINTS = 200
+
+
+def _peak_rss_mb() -> float:
+    import resource
+
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+# Adds up Solution.solve_time of every solve a lab makes. A batch that falls back
+# to single solves counts once, through its own solutions.
+def _record_solve_times(solve_times: list) -> None:
+    import threading
+
+    import pybamm
+    import model_cache
+
+    depth = threading.local()
+
+    def timed(solve):
+        def wrapper(*args, **kwargs):
+            depth.value = getattr(depth, "value", 0) + 1
+            try:
+                result = solve(*args, **kwargs)
+            finally:
+                depth.value -= 1
+            if depth.value == 0:
+                for solution in result if isinstance(result, list) else [result]:
+                    solve_times.append(float(solution.solve_time.value))
+            return result
+
+        return wrapper
+
+    pybamm.Simulation.solve = timed(pybamm.Simulation.solve)
+    model_cache.BuiltModel.solve = timed(model_cache.BuiltModel.solve)
+    model_cache.BuiltModel.solve_batch = timed(model_cache.BuiltModel.solve_batch)
+
+
+# Runs in a fresh process: one lab payload through the Flask route `repeat` times
+def _run_lab_case(lab: str, size: str, repeat: int) -> dict:
+    solve_times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+
+        _record_solve_times(solve_times)
+        client = main.app.test_client()
+        baseline_rss = _peak_rss_mb()
+        wall_times = []
+        solve_time_per_run = []
+        for _ in range(repeat):
+            solve_times.clear()
+            start = time.perf_counter()
+            response = client.post(f"/simulate-{lab}", json=PAYLOADS[lab][size])
+            wall_times.append(time.perf_counter() - start)
+            solve_time_per_run.append(sum(solve_times))
+            body = response.get_data()
+
+    case = {
+        "name": f"{lab}/{size}",
+        "wall_time": statistics.median(wall_times),
+        "wall_times": wall_times,
+        "solve_time": statistics.median(solve_time_per_run),
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": _peak_rss_mb(),
+        "response_bytes": len(body),
+    }
+    if body.startswith(b'["ERROR'):
+        case["error"] = json.loads(body)[0]
+    return case
+
+
+# Runs in a fresh process: a benchmark payload with `options` added, at full
+# precision. Returns the median wall time, the result and the response headers.
+def _run_payload_case(lab: str, size: str, options: dict, repeat: int) -> dict:
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+
+        client = main.app.test_client()
+        payload = dict(PAYLOADS[lab][size], **options, **{"Significant Digits": 0})
+        wall_times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = client.post(f"/simulate-{lab}", json=payload)
+            body = response.get_data()
+            wall_times.append(time.perf_counter() - start)
+
+    result = json.loads(body)
+    case = {
+        "wall_time": statistics.median(wall_times),
+        "result": result,
+        "headers": dict(response.headers),
+    }
+    if body.startswith(b'["ERROR'):
+        case["error"] = result[0]
+    return case
+
+
+# Largest difference between two lab results, each series' relative to its range in
+# `reference`, infinite when they do not have the same graphs and lengths
+def _result_difference(reference, candidate) -> float:
+    import numpy as np
+
+    if isinstance(reference, dict):
+        if not isinstance(candidate, dict) or reference.keys() != candidate.keys():
+            return float("inf")
+        return max(
+            [_result_difference(reference[k], candidate[k]) for k in reference],
+            default=0.0,
+        )
+    if isinstance(reference, list):
+        if not isinstance(candidate, list) or len(reference) != len(candidate):
+            return float("inf")
+        if reference and all(isinstance(v, (int, float)) for v in reference):
+            try:
+                old = np.asarray(reference, dtype=float)
+                new = np.asarray(candidate, dtype=float)
+            except (TypeError, ValueError):
+                return float("inf")
+            scale = max(np.ptp(old), np.abs(old).max() * 1e-9, 1e-12)
+            return float(np.nan_to_num(np.abs(new - old).max() / scale, nan=np.inf))
+        return max(
+            [_result_difference(a, b) for a, b in zip(reference, candidate)],
+            default=0.0,
+        )
+    return 0.0 if reference == candidate else float("inf")
+
+
+# The FIDELITY_OUTPUTS of a lab2 solution on a shared cycle axis: the summary per
+# cycle, the traces at FIDELITY_CYCLE_POINTS fractions of each cycle's duration. Runs
+# on other meshes end their steps at slightly different times, so their raw samples
+# do not line up.
+def _fidelity_series(solution) -> dict:
+    import numpy as np
+
+    series = {}
+    for name in FIDELITY_OUTPUTS["capacity"]:
+        series[name] = np.asarray(solution.summary_variables[name], dtype=float)
+    fractions = np.linspace(0, 1, FIDELITY_CYCLE_POINTS)
+    for name in FIDELITY_OUTPUTS["lithium inventory"]:
+        cycles = []
+        for cycle in solution.cycles:
+            t = cycle.t
+            cycles.append(
+                np.interp(fractions, (t - t[0]) / (t[-1] - t[0]), cycle[name].entries)
+            )
+        series[name] = np.concatenate(cycles)
+    return series
+
+
+# Runs in a fresh process: the lab2 payload at a fidelity, with the FIDELITY_OUTPUTS
+# of the solution it was answered with
+def _run_fidelity_case(size: str, fidelity: str, repeat: int) -> dict:
+    import cycling
+
+    solutions = []
+    solve = cycling.solve
+
+    def recording_solve(*args, **kwargs):
+        solution = solve(*args, **kwargs)
+        solutions.append(solution)
+        return solution
+
+    cycling.solve = recording_solve
+    case = _run_payload_case("lab2", size, {"Fidelity": fidelity}, repeat)
+    if "error" not in case:
+        case["series"] = _fidelity_series(solutions[-1])
+    return case
+
+
+# Largest difference between two series on the same axis relative to the range of
+# `reference` (its size for a single point), over the cycles both reached
+def _series_difference(reference, candidate) -> float:
+    import numpy as np
+
+    length = min(len(reference), len(candidate))
+    old = np.asarray(reference[:length], dtype=float)
+    new = np.asarray(candidate[:length], dtype=float)
+    scale = np.ptp(old) or np.abs(old).max() or 1.0
+    return float(np.abs(new - old).max() / scale)
+
+
+def _micro_fixture():
+    import pybamm
+    import utils
+
+    parameters = utils.get_battery_parameters("NMC", degradation_enabled=True)
+    experiment = pybamm.Experiment(
+        [("Charge at 1 C until 4.2 V", "Discharge at 1 C until 3 V")] * 10
+    )
+    sim = pybamm.Simulation(
+        pybamm.lithium_ion.SPM({"SEI": "ec reaction limited"}),
+        parameter_values=parameters,
+        experiment=experiment,
+    )
+    return sim.solve(initial_soc=0, save_at_cycles=1)
+
+
+# Processed variables are cached on a solution, drop them so every call does the work
+def _clear_processed_variables(solution) -> None:
+    for sub_solution in [solution] + solution.cycles + solution.sub_solutions:
+        sub_solution._variables.clear()
+
+
+# Runs in a fresh process: times each utils helper on a real cycling solution
+def _run_micro_suite(repeat: int) -> list:
+    import numpy as np
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import utils
+
+        solution = _micro_fixture()
+        long_series = np.cumsum(np.random.default_rng(0).normal(size=50000))
+        capacity = np.linspace(5, 4.6, 50)
+        calls = {
+            "interpolate_array": lambda: utils.interpolate_array(long_series, 8100),
+            "plot_against_cycle": lambda: utils.plot_against_cycle(
+                solution, 10, "Voltage [V]"
+            ),
+            "transform_to_inverse_bezier_curve": lambda: (
+                utils.transform_to_inverse_bezier_curve(capacity, 0.1)
+            ),
+            "extract_values_from_sub_sol": lambda: utils.extract_values_from_sub_sol(
+                solution,
+                "Throughput capacity [A.h]",
+                "Voltage [V]",
+                0,
+                len(solution.sub_solutions),
+            ),
+        }
+        results = []
+        for name in MICRO_BENCHMARKS:
+            times = []
+            for _ in range(repeat * MICRO_ROUNDS):
+                _clear_processed_variables(solution)
+                start = time.perf_counter()
+                calls[name]()
+                times.append(time.perf_counter() - start)
+            results.append({"name": f"micro/{name}", "time": min(times), "times": times})
+    return results
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> None:
+    # Children inherit this environment: no cached results or checkpoints, so every
+    # repeat solves from scratch, and a fixed pool size
+    os.environ["RESULT_CACHE_MAX_ENTRIES"] = "0"
+    os.environ["RESULT_CACHE_DIR"] = ""
+    os.environ["MAX_CHECKPOINTS"] = "0"
+    os.environ["SIMULATION_WORKERS"] = str(args.workers)
+    context = multiprocessing.get_context("spawn")
+
+    import pybamm
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "pybamm": pybamm.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "workers": args.workers,
+            "repeat": args.repeat,
+        },
+        "results": [],
+    }
+
+    if args.suite in ("all", "micro"):
+        print("Running micro benchmarks")
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            report["results"] += pool.submit(_run_micro_suite, args.repeat).result()
+
+    if args.suite in ("all", "labs"):
+        for lab in args.labs:
+            for size in args.sizes:
+                print(f"Running {lab}/{size}")
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    case = pool.submit(_run_lab_case, lab, size, args.repeat).result()
+                report["results"].append(case)
+
+    for result in report["results"]:
+        summary = ", ".join(
+            f"{metric}={result[metric]:.4g}"
+            for metric in LAB_METRICS + ["time"]
+            if metric in result
+        )
+        print(f"{result['name']}: {summary} {result.get('error', '')}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Saved to", args.output)
+
+
+def validate(args) -> None:
+    import solver_backends
+
+    os.environ["RESULT_CACHE_MAX_ENTRIES"] = "0"
+    os.environ["RESULT_CACHE_DIR"] = ""
+    os.environ["MAX_CHECKPOINTS"] = "0"
+    os.environ["SIMULATION_WORKERS"] = str(args.workers)
+    # A backend that fails must not pass on the reference's graphs
+    os.environ["SOLVER_BACKEND_FALLBACK"] = "0"
+    context = multiprocessing.get_context("spawn")
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "sizes": args.sizes,
+            "tolerance": args.tolerance,
+        },
+        "labs": {},
+    }
+    for lab in args.labs:
+        backends = {}
+        references = {}
+        for backend in solver_backends.BACKENDS:
+            if not solver_backends.available(backend):
+                print(f"{lab} {backend}: not available")
+                backends[backend] = {"equivalent": False, "error": "not available"}
+                continue
+            summary = {"wall_time": 0.0}
+            difference = 0.0
+            for size in args.sizes:
+                print(f"Running {lab}/{size} on {backend}")
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    case = pool.submit(
+                        _run_payload_case,
+                        lab,
+                        size,
+                        {"Solver Backend": backend},
+                        args.repeat,
+                    ).result()
+                summary["wall_time"] += case["wall_time"]
+                if "error" in case:
+                    summary["error"] = case["error"]
+                    difference = float("inf")
+                    break
+                if backend == solver_backends.REFERENCE:
+                    references[size] = case["result"]
+                elif size in references:
+                    difference = max(
+                        difference, _result_difference(references[size], case["result"])
+                    )
+                else:
+                    difference = float("inf")
+            summary["equivalent"] = difference <= args.tolerance
+            # JSON has no infinity, results that could not be compared have none
+            if difference < float("inf"):
+                summary["max_difference"] = difference
+            print(
+                f"{lab} {backend}: {summary['wall_time']:.4g}s, max difference "
+                f"{difference:.3g} {summary.get('error', '')}"
+            )
+            backends[backend] = summary
+
+        equivalent = [name for name in backends if backends[name]["equivalent"]]
+        chosen = min(
+            equivalent,
+            key=lambda name: backends[name]["wall_time"],
+            default=solver_backends.REFERENCE,
+        )
+        print(f"{lab}: {chosen}")
+        report["labs"][lab] = {"backend": chosen, "backends": backends}
+
+    output = args.output or solver_backends.VALIDATION_FILE
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Saved to", output)
+
+
+def fidelity(args) -> None:
+    import lab2
+
+    os.environ["RESULT_CACHE_MAX_ENTRIES"] = "0"
+    os.environ["RESULT_CACHE_DIR"] = ""
+    os.environ["MAX_CHECKPOINTS"] = "0"
+    context = multiprocessing.get_context("spawn")
+
+    # Standard first, the others are measured against it
+    tiers = [lab2.DEFAULT_FIDELITY] + [
+        tier for tier in lab2.FIDELITY_TIERS if tier != lab2.DEFAULT_FIDELITY
+    ]
+    wall_times = {tier: 0.0 for tier in tiers}
+    errors = {tier: {output: 0.0 for output in FIDELITY_OUTPUTS} for tier in tiers}
+    failures = {tier: 0 for tier in tiers}
+    references = {}
+    for tier in tiers:
+        for size in args.sizes:
+            print(f"Running lab2/{size} at {tier} fidelity")
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                case = pool.submit(_run_fidelity_case, size, tier, args.repeat).result()
+            if "error" in case:
+                raise RuntimeError(f"lab2/{size} at {tier}: {case['error']}")
+            wall_times[tier] += case["wall_time"]
+            if tier == lab2.DEFAULT_FIDELITY:
+                references[size] = case["series"]
+                continue
+            # The time still counts, it is what asking for this fidelity costs
+            if case["headers"].get("X-Fidelity") != tier:
+                print(f"lab2/{size} failed at {tier}, answered at standard")
+                failures[tier] += 1
+                continue
+            for output, names in FIDELITY_OUTPUTS.items():
+                for name in names:
+                    errors[tier][output] = max(
+                        errors[tier][output],
+                        _series_difference(
+                            references[size][name], case["series"][name]
+                        ),
+                    )
+
+    standard = wall_times[lab2.DEFAULT_FIDELITY]
+    for tier in tiers:
+        measured = ", ".join(
+            f"{output} {error:.2g}" for output, error in errors[tier].items()
+        )
+        print(
+            f"{tier}: {wall_times[tier]:.4g}s ({standard / wall_times[tier]:.2f}x), "
+            f"error {measured}, "
+            f"failed on {failures[tier]} of {len(args.sizes)} payloads"
+        )
+
+
+# Prints every shared metric of two runs, returns the number of regressions
+def compare(args) -> int:
+    with open(args.baseline) as f:
+        baseline = {result["name"]: result for result in json.load(f)["results"]}
+    with open(args.candidate) as f:
+        candidate = {result["name"]: result for result in json.load(f)["results"]}
+
+    regressions = 0
+    print(f"{'benchmark':<48}{'baseline':>12}{'candidate':>12}{'ratio':>8}")
+    for name in baseline:
+        if name not in candidate:
+            continue
+        for metric in LAB_METRICS + ["time"]:
+            old = baseline[name].get(metric)
+            new = candidate[name].get(metric)
+            if old is None or new is None:
+                continue
+            ratio = new / old if old else float("inf") if new else 1.0
+            flag = ""
+            if ratio > 1 + args.threshold:
+                flag = " slower" if "time" in metric else " larger"
+                regressions += 1
+            elif ratio < 1 - args.threshold:
+                flag = " faster" if "time" in metric else " smaller"
+            print(
+                f"{name + ' ' + metric:<48}{old:>12.4g}{new:>12.4g}{ratio:>8.2f}{flag}"
+            )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for the lab endpoints and the utils hot paths"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--output", default="benchmark.json")
+    run_parser.add_argument(
+        "--suite", choices=["all", "labs", "micro"], default="all"
+    )
+    run_parser.add_argument(
+        "--labs", nargs="+", choices=sorted(PAYLOADS), default=sorted(PAYLOADS)
+    )
+    run_parser.add_argument("--sizes", nargs="+", choices=SIZES, default=SIZES)
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--workers", type=int, default=1)
+
+    compare_parser = commands.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="relative change to report"
+    )
+    compare_parser.add_argument(
+        "--fail-on-regression", action="store_true", help="exit 1 on regressions"
+    )
+
+    validate_parser = commands.add_parser(
+        "validate", help="check the solver backends against the reference"
+    )
+    validate_parser.add_argument(
+        "--output", default=None, help="defaults to the file the labs read"
+    )
+    validate_parser.add_argument(
+        "--labs", nargs="+", choices=sorted(PAYLOADS), default=sorted(PAYLOADS)
+    )
+    validate_parser.add_argument(
+        "--sizes", nargs="+", choices=SIZES, default=VALIDATION_SIZES
+    )
+    validate_parser.add_argument("--repeat", type=int, default=1)
+    validate_parser.add_argument("--workers", type=int, default=1)
+    validate_parser.add_argument(
+        "--tolerance", type=float, default=VALIDATION_TOLERANCE
+    )
+
+    fidelity_parser = commands.add_parser(
+        "fidelity", help="time lab2's fidelity tiers and measure their error"
+    )
+    fidelity_parser.add_argument(
+        "--sizes", nargs="+", choices=SIZES, default=VALIDATION_SIZES
+    )
+    fidelity_parser.add_argument("--repeat", type=int, default=1)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    elif args.command == "validate":
+        validate(args)
+    elif args.command == "fidelity":
+        fidelity(args)
+    elif compare(args) and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
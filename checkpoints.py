@@ -0,0 +1,107 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import pybamm
+import outputs
+import utils
+
+# A checkpoint is left every this many cycles, and at the end of every run
+CHECKPOINT_EVERY = int(os.environ.get("CHECKPOINT_EVERY_CYCLES", 10))
+# Checkpoints kept in memory, those of one run share its arrays. 0 leaves none.
+MAX_CHECKPOINTS = int(os.environ.get("MAX_CHECKPOINTS", 64))
+
+# (run key, cycles done, protocol prefix hash) -> Solution of those cycles. Kept per
+# process: runs solved in executor workers (lab1's cycling with SIMULATION_WORKERS
+# above 1) do not leave checkpoints, lab3 runs in the server and always does.
+_checkpoints = OrderedDict()
+_lock = threading.Lock()
+
+
+# Everything a run's states depend on apart from its protocol
+def run_key(
+    chemistry: str,
+    model: pybamm.BaseModel,
+    parameters: pybamm.ParameterValues,
+    output_variables: outputs.OutputVariables,
+    solve_options: dict,
+) -> str:
+    digest = hashlib.sha256()
+    for part in (
+        chemistry,
+        type(model).__name__,
+        repr(sorted(model.options.items())),
+        repr((output_variables.variables, output_variables.summary_variables)),
+        utils.parameter_fingerprint(parameters),
+        repr(sorted(solve_options.items())),
+    ):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+# Hash of the first n cycles' steps of an experiment, for every n
+def prefix_hashes(experiment: pybamm.Experiment) -> list:
+    digest = hashlib.sha256()
+    hashes = [digest.hexdigest()]
+    steps = iter(experiment.steps)
+    for cycle_length in experiment.cycle_lengths:
+        for _ in range(cycle_length):
+            step = next(steps)
+            digest.update(f"{step}|{step.period}|{step.temperature}\n".encode())
+        digest.update(b"cycle\n")
+        hashes.append(digest.hexdigest())
+    return hashes
+
+
+# The longest checkpoint of the run that starts the same way as `experiment` and
+# leaves at least one cycle to solve, as (cycles done, Solution) or (0, None)
+def resume(key: str, experiment: pybamm.Experiment) -> tuple:
+    hashes = prefix_hashes(experiment)
+    with _lock:
+        for cycles in range(len(hashes) - 2, 0, -1):
+            solution = _checkpoints.get((key, cycles, hashes[cycles]))
+            if solution is not None:
+                _checkpoints.move_to_end((key, cycles, hashes[cycles]))
+                return cycles, solution
+    return 0, None
+
+
+# The cycles of `experiment` after the first `cycles_done`
+def remaining(experiment: pybamm.Experiment, cycles_done: int) -> pybamm.Experiment:
+    _, period, temperature, termination = experiment.args
+    return pybamm.Experiment(
+        experiment.cycles[cycles_done:], period, temperature, termination
+    )
+
+
+# Leaves checkpoints from a finished run with every cycle saved. Each is a Solution
+# of the cycles so far that pybamm accepts as a `starting_solution`, the arrays are
+# shared with `solution`.
+def save(key: str, experiment: pybamm.Experiment, solution: pybamm.Solution) -> None:
+    if MAX_CHECKPOINTS <= 0:
+        return
+    cycles = solution.cycles
+    # Runs cut short (or with dropped cycles) may end mid cycle
+    if len(cycles) != len(experiment.cycle_lengths) or any(c is None for c in cycles):
+        return
+    hashes = prefix_hashes(experiment)
+    saved = []
+    prefix = None
+    for done, cycle in enumerate(cycles, start=1):
+        prefix = cycle.copy() if prefix is None else prefix + cycle
+        if done % CHECKPOINT_EVERY != 0 and done != len(cycles):
+            continue
+        checkpoint = prefix.copy()
+        checkpoint.cycles = cycles[:done]
+        checkpoint.set_summary_variables(solution.all_summary_variables[:done])
+        checkpoint.all_first_states = solution.all_first_states[:done]
+        checkpoint.initial_start_time = solution.initial_start_time
+        saved.append(((key, done, hashes[done]), checkpoint))
+    with _lock:
+        for checkpoint_key, checkpoint in saved:
+            _checkpoints[checkpoint_key] = checkpoint
+            _checkpoints.move_to_end(checkpoint_key)
+        while len(_checkpoints) > MAX_CHECKPOINTS:
+            _checkpoints.popitem(last=False)
@@ -0,0 +1,276 @@
+import functools
+import os
+import tempfile
+
+import numpy as np
+import pybamm
+
+import checkpoints
+import outputs
+import solver_backends
+import solver_profiles
+
+# Longest run a lab accepts
+MAX_CYCLES = int(os.environ.get("MAX_CYCLES", 1000))
+# Runs of more cycles than this are solved in bounded memory
+BOUNDED_FROM_CYCLES = int(os.environ.get("BOUNDED_CYCLING_FROM", 50))
+# Samples of each declared variable kept in memory per cycle of a bounded run
+TRACE_POINTS = int(os.environ.get("BOUNDED_CYCLING_TRACE_POINTS", 64))
+# Where the full traces of bounded runs are spilled, the system temp dir by default
+SPILL_DIR = os.environ.get("BOUNDED_CYCLING_SPILL_DIR") or None
+
+
+_warned = set()
+
+
+# Prints a message the first time it comes up
+def _warn_once(message: str) -> None:
+    if message not in _warned:
+        _warned.add(message)
+        print(f"{message} (pybamm {pybamm.__version__})")
+
+
+def clamp_cycles(cycles: int) -> int:
+    return min(int(cycles), MAX_CYCLES)
+
+
+# Append-only file of float64 arrays, read back through a memory map
+class SpillFile:
+    def __init__(self):
+        # Deleted as soon as it is closed or garbage collected
+        self.file = tempfile.TemporaryFile(prefix="cycling-", dir=SPILL_DIR)
+        self.length = 0
+        self._map = None
+
+    def append(self, values: np.ndarray) -> tuple:
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        self.file.write(values.tobytes())
+        start = self.length
+        self.length += len(values)
+        return start, len(values)
+
+    def read(self, start: int, length: int) -> np.ndarray:
+        if self._map is None or len(self._map) < start + length:
+            self.file.flush()
+            self._map = np.memmap(self.file, dtype=np.float64, mode="r")
+        return self._map[start : start + length]
+
+
+# Stands in for pybamm's ProcessedVariable where the labs only read `entries`
+class StoredVariable:
+    def __init__(self, entries: np.ndarray):
+        self.entries = entries
+
+
+class StoredStep:
+    def __init__(self, spill: SpillFile, spans: dict):
+        self.spill = spill
+        self.spans = spans  # variable -> (start, length) in the spill file
+
+    def __getitem__(self, name: str) -> StoredVariable:
+        return StoredVariable(self.spill.read(*self.spans[name]))
+
+
+class StoredCycle:
+    def __init__(self, steps: list):
+        self.steps = steps
+
+    def __getitem__(self, name: str) -> StoredVariable:
+        entries = [step[name].entries for step in self.steps if step is not None]
+        return StoredVariable(np.concatenate(entries) if entries else np.array([]))
+
+
+# Collects a bounded run while pybamm drops its cycles: the full trace of every
+# declared variable goes to a spill file, a TRACE_POINTS sample of each cycle stays in
+# memory, and the solver state that piles up is freed after every cycle.
+# After the solve it answers the labs' reads (summary_variables, cycles, steps) the
+# way a pybamm Solution would.
+class CycleStore(pybamm.callbacks.Callback):
+    def __init__(self, output_variables: outputs.OutputVariables):
+        self.variables = output_variables.variables
+        self.simulation = None
+        self.solvers = []
+        self.summary_variables = None
+        self.solve_time = None
+        self.on_experiment_start(None)
+
+    # A solver retry starts over
+    def on_experiment_start(self, logs):
+        self.spill = SpillFile()
+        self.cycles = []
+        self.traces = {name: [] for name in self.variables}
+        self.steps = []
+        self.step_index = 0
+
+    def on_cycle_start(self, logs):
+        self.steps = []
+
+    def on_step_start(self, logs):
+        step_number, cycle_length = logs["step number"]
+        if not self.steps:
+            self.steps = [None] * cycle_length
+        self.step_index = step_number - 1
+
+    # Called by RecordingSolver with every step it solves
+    def add_step(self, solution: pybamm.Solution, solver: pybamm.BaseSolver) -> None:
+        if solver not in self.solvers:
+            self.solvers.append(solver)
+        spans = {}
+        for name in self.variables:
+            spans[name] = self.spill.append(np.ravel(solution[name].entries))
+        self.steps[self.step_index] = StoredStep(self.spill, spans)
+
+    def on_cycle_end(self, logs):
+        cycle = StoredCycle(self.steps)
+        self.cycles.append(cycle)
+        self.steps = []
+        for name in self.variables:
+            entries = cycle[name].entries
+            if len(entries) > TRACE_POINTS:
+                indices = np.linspace(0, len(entries) - 1, TRACE_POINTS).round()
+                entries = entries[indices.astype(int)]
+            self.traces[name].append(np.array(entries))
+        self.free_solver_state()
+
+    # CasadiSolver keeps an integrator for every time grid it has seen, and the
+    # parameter values every symbol they processed, the eSOH summary variables
+    # included (a new 1000 point expression each cycle). Both are cheap to make again.
+    # Neither is pybamm API (this is pybamm 24.5's layout), so each is only cleared
+    # when it still looks that way.
+    def free_solver_state(self) -> None:
+        if self.simulation is not None:
+            parameters = self.simulation.parameter_values
+            processed = getattr(parameters, "_processed_symbols", None)
+            if isinstance(processed, dict):
+                processed.clear()
+            else:
+                _warn_once("Cannot free pybamm's processed symbols, memory will grow")
+        for solver in self.solvers:
+            solver_integrators = getattr(solver, "integrators", None)
+            if not isinstance(solver_integrators, dict):
+                _warn_once("Cannot free pybamm's integrators, memory will grow")
+                continue
+            for model in list(solver_integrators):
+                integrators = solver_integrators[model]
+                if not isinstance(integrators, dict):
+                    _warn_once("Cannot free pybamm's integrators, memory will grow")
+                    continue
+                for grid in [grid for grid in integrators if grid != "no grid"]:
+                    del integrators[grid]
+                # Without any left the solver sets the model up again next step
+                if not integrators:
+                    del solver_integrators[model]
+
+    # The in-memory sample of a variable over every cycle
+    def trace(self, name: str) -> np.ndarray:
+        if not self.traces[name]:
+            return np.array([])
+        return np.concatenate(self.traces[name])
+
+    def attach(self, solution: pybamm.Solution) -> "CycleStore":
+        self.summary_variables = solution.summary_variables
+        self.solve_time = solution.solve_time
+        return self
+
+
+# A CasadiSolver that hands every experiment step it solves to a CycleStore
+class RecordingSolver(pybamm.CasadiSolver):
+    def __init__(self, store: CycleStore, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+
+    def step(self, *args, **kwargs):
+        solution = super().step(*args, **kwargs)
+        self.store.add_step(solution, self)
+        return solution
+
+
+# Solves a cycling experiment through the solver profile ladder. Runs of up to
+# BOUNDED_FROM_CYCLES cycles return pybamm's Solution with every cycle saved, longer
+# ones a CycleStore holding only what `output_variables` declares. `callbacks` is a
+# list or a function of (Simulation, CycleStore or None) giving one. With
+# `checkpoint` set, runs that keep every cycle resume from the longest checkpoint
+# of the same start and protocol and leave their own (see checkpoints.py).
+# `backend` picks the solver (see solver_backends.py), bounded runs record their steps
+# through CasadiSolver so they always use the reference. `var_pts` is the mesh, the
+# model's default one without it.
+def solve(
+    chemistry: str,
+    model: pybamm.BaseModel,
+    parameters: pybamm.ParameterValues,
+    experiment: pybamm.Experiment,
+    output_variables: outputs.OutputVariables,
+    callbacks=None,
+    checkpoint: bool = False,
+    backend: str = solver_backends.REFERENCE,
+    var_pts: dict = None,
+    **kwargs,
+):
+    cycles = len(experiment.cycle_lengths)
+    if cycles <= BOUNDED_FROM_CYCLES:
+        key = None
+        remaining = experiment
+        if checkpoint:
+            solve_options = {**kwargs, "backend": backend, "var_pts": var_pts}
+            key = checkpoints.run_key(
+                chemistry, model, parameters, output_variables, solve_options
+            )
+            done, starting_solution = checkpoints.resume(key, experiment)
+            if starting_solution is not None:
+                print(f"Resuming from the checkpoint after cycle {done}")
+                remaining = checkpoints.remaining(experiment, done)
+                kwargs["starting_solution"] = starting_solution
+
+        solution = solver_profiles.solve_experiment(
+            lambda solver: pybamm.Simulation(
+                model,
+                parameter_values=parameters,
+                experiment=remaining,
+                solver=solver,
+                var_pts=var_pts,
+            ),
+            chemistry,
+            model,
+            remaining,
+            callbacks=(lambda sim: callbacks(sim, None))
+            if callable(callbacks)
+            else callbacks,
+            save_at_cycles=1,
+            backend=backend,
+            var_pts=var_pts,
+            **kwargs,
+        )
+        if key is not None:
+            checkpoints.save(key, experiment, solution)
+        return solution
+
+    print(f"Solving {cycles} cycles in bounded memory")
+    if backend != solver_backends.REFERENCE:
+        print(f"Bounded runs do not support solver backend {backend}, using the tiers")
+    store = CycleStore(output_variables)
+
+    def store_callbacks(sim: pybamm.Simulation) -> list:
+        store.simulation = sim
+        extra = callbacks(sim, store) if callable(callbacks) else callbacks
+        # The store goes first so the others see the cycle it just finished
+        return [store] + (extra or [])
+
+    solution = solver_profiles.solve_experiment(
+        lambda solver: pybamm.Simulation(
+            model,
+            parameter_values=parameters,
+            experiment=experiment,
+            solver=solver,
+            var_pts=var_pts,
+        ),
+        chemistry,
+        model,
+        experiment,
+        callbacks=store_callbacks,
+        solver_class=functools.partial(RecordingSolver, store),
+        # pybamm keeps the first and last cycles whatever this is, and no others
+        save_at_cycles=cycles + 1,
+        var_pts=var_pts,
+        **kwargs,
+    )
+    return store.attach(solution)
@@ -0,0 +1,119 @@
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+
+import tracing
+
+# Used when a request doesn't ask for anything else, matches the old 8100 point cap
+DEFAULT_METHOD = "pchip"
+DEFAULT_POINTS = 8100
+
+
+# Smooth resampling of both series over the sample index (the original behaviour)
+def pchip(x: np.ndarray, y: np.ndarray, points: int) -> tuple:
+    input_indices = np.arange(len(y))
+    output_indices = np.linspace(0, len(y) - 1, points)
+    pchip_interp_func = PchipInterpolator(input_indices, np.vstack([x, y]), axis=1)
+    x_out, y_out = pchip_interp_func(output_indices)
+    return x_out, y_out
+
+
+# Largest-Triangle-Three-Buckets: keeps the sample of each bucket that spans the
+# largest triangle with the previous pick and the next bucket's average
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> tuple:
+    n = len(y)
+    # points - 2 buckets between the fixed first and last samples
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    counts = np.diff(edges)
+    average_x = np.add.reduceat(x[: n - 1], edges[:-1]) / counts
+    average_y = np.add.reduceat(y[: n - 1], edges[:-1]) / counts
+    # The last bucket looks ahead to the final sample
+    next_x = np.append(average_x[1:], x[-1])
+    next_y = np.append(average_y[1:], y[-1])
+
+    selected = np.empty(points, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    for i in range(points - 2):
+        a = selected[i]
+        start, end = edges[i], edges[i + 1]
+        areas = np.abs(
+            (x[a] - next_x[i]) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (next_y[i] - y[a])
+        )
+        selected[i + 1] = start + np.argmax(areas)
+
+    return x[selected], y[selected]
+
+
+# Keeps the minimum and maximum of every bucket so spikes survive decimation
+def min_max(x: np.ndarray, y: np.ndarray, points: int) -> tuple:
+    n = len(y)
+    buckets = max((points - 2) // 2, 1)
+    bucket_size = -(-(n - 2) // buckets)
+    # Pad the interior to whole buckets so every bucket is a row of one array
+    interior = np.full(buckets * bucket_size, np.nan)
+    interior[: n - 2] = y[1 : n - 1]
+    rows = interior.reshape(buckets, bucket_size)
+    valid = ~np.all(np.isnan(rows), axis=1)
+    rows = rows[valid]
+    offsets = np.arange(buckets)[valid] * bucket_size + 1
+    low = offsets + np.nanargmin(rows, axis=1)
+    high = offsets + np.nanargmax(rows, axis=1)
+
+    selected = np.concatenate(
+        [[0], np.sort(np.stack([low, high], axis=1), axis=1).ravel(), [n - 1]]
+    )
+    # A flat bucket has the same sample as its minimum and maximum
+    selected = selected[np.concatenate([[True], np.diff(selected) != 0])]
+    return x[selected], y[selected]
+
+
+STRATEGIES = {
+    "pchip": pchip,
+    "lttb": lttb,
+    "minmax": min_max,
+}
+
+
+def downsample(
+    x, y, method: str = DEFAULT_METHOD, points: int = DEFAULT_POINTS
+) -> tuple:
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(y) <= points:
+        return x, y
+    return STRATEGIES[method](x, y, points)
+
+
+# Graph lists alternate x and y series, downsample every pair that is too long
+def downsample_graphs(graphs: list, method: str, points: int) -> list:
+    for x_graph, y_graph in zip(graphs[::2], graphs[1::2]):
+        x_values, y_values = x_graph["values"], y_graph["values"]
+        if len(y_values) <= points or len(x_values) != len(y_values):
+            continue
+        x_values, y_values = downsample(x_values, y_values, method, points)
+        x_graph["values"] = x_values.tolist()
+        y_graph["values"] = y_values.tolist()
+    return graphs
+
+
+# Applies the request's downsampling to every graph of a lab result
+def downsample_result(result: list, method: str, points: int) -> list:
+    with tracing.span("downsample", method):
+        for experiment_result in result:
+            for entry in experiment_result:
+                if "graphs" in entry:
+                    downsample_graphs(entry["graphs"], method, points)
+    return result
+
+
+# Reads {"Downsampling": {"Method": ..., "Points": ...}} from a lab payload
+def options_from_request(data: dict) -> tuple:
+    options = data.get("Downsampling") or {}
+    method = options.get("Method", DEFAULT_METHOD)
+    points = int(options.get("Points", DEFAULT_POINTS))
+    if method not in STRATEGIES:
+        raise ValueError(f"Unknown downsampling method: {method}")
+    if points < 4:
+        raise ValueError("Downsampling needs at least 4 points")
+    return method, points
@@ -0,0 +1,107 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import tracing
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, workers then run without a limit
+    resource = None
+
+# Number of simulation worker processes, 1 runs everything in the calling thread
+MAX_WORKERS = int(os.environ.get("SIMULATION_WORKERS", os.cpu_count() or 1))
+# Memory left to the server process when the workers' limit is worked out, in MB
+SERVER_MEMORY_MB = int(os.environ.get("SERVER_MEMORY_MB", 256))
+
+
+# Physical memory of the machine in MB, None where it cannot be read
+def _total_memory_mb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2**20
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# The machine's memory less SERVER_MEMORY_MB, split evenly between the workers, so
+# together they cannot take more than there is. Without a reading, no limit.
+def default_worker_memory_mb() -> int:
+    total = _total_memory_mb()
+    if total is None:
+        return 0
+    return max((total - SERVER_MEMORY_MB) // max(MAX_WORKERS, 1), 1)
+
+
+# Address space limit of each worker in MB, 0 disables the limit
+WORKER_MEMORY_MB = int(
+    os.environ.get("SIMULATION_WORKER_MEMORY_MB") or default_worker_memory_mb()
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _limit_worker_memory(limit_mb: int) -> None:
+    if resource is None or not limit_mb:
+        return
+    limit = limit_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned workers don't inherit the Flask threads or pybamm state
+            _pool = ProcessPoolExecutor(
+                max_workers=MAX_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_limit_worker_memory,
+                initargs=(WORKER_MEMORY_MB,),
+            )
+        return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+# Runs each (function, args) call, concurrently when workers are available, and
+# returns the results in the order the calls were given
+def run_ordered(calls: list) -> list:
+    if MAX_WORKERS <= 1 or len(calls) <= 1:
+        results = []
+        for function, args in calls:
+            with tracing.span(function.__name__):
+                results.append(function(*args))
+        return results
+
+    trace = tracing.current()
+    submitted_at = time.perf_counter()
+    futures = [
+        get_pool().submit(tracing.traced_call, function, args)
+        for function, args in calls
+    ]
+    try:
+        results = []
+        for future in futures:
+            result, spans = future.result()
+            # Worker clocks aren't ours, line their spans up with the submission
+            if trace is not None:
+                trace.merge(spans, submitted_at)
+            results.append(result)
+        return results
+    except BrokenProcessPool:
+        # A worker died (usually its memory limit), start fresh for the next request
+        _reset_pool()
+        raise MemoryError("Simulation worker crashed, likely out of memory")
+    finally:
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,66 @@
+import os
+import threading
+from collections import OrderedDict
+
+import pybamm
+import tracing
+import utils
+
+NEGATIVE_CONCENTRATION = "Initial concentration in negative electrode [mol.m-3]"
+POSITIVE_CONCENTRATION = "Initial concentration in positive electrode [mol.m-3]"
+
+# Initial states kept, each is a few floats
+MAX_INITIAL_STATES = int(os.environ.get("MAX_INITIAL_STATES", 1024))
+
+# (parameter fingerprint, model options, SOC) -> initial state
+_initial_states = OrderedDict()
+_lock = threading.Lock()
+
+
+# Electrode stoichiometries and particle concentrations at `initial_soc`, as pybamm's
+# set_initial_stoichiometries works them out with an electrode SOH solve. They only
+# depend on the parameter set (and the model options), so each is solved once.
+def resolve(
+    parameters: pybamm.ParameterValues, initial_soc: float, options: dict = None
+) -> dict:
+    key = (
+        utils.parameter_fingerprint(parameters),
+        repr(sorted((options or {}).items())),
+        float(initial_soc),
+    )
+    with _lock:
+        state = _initial_states.get(key)
+        if state is not None:
+            _initial_states.move_to_end(key)
+            return state
+
+    param = pybamm.LithiumIonParameters(options)
+    with tracing.span("esoh"):
+        x, y = pybamm.lithium_ion.get_initial_stoichiometries(
+            initial_soc, parameters, param=param, options=options
+        )
+    state = {
+        "x": float(x),
+        "y": float(y),
+        NEGATIVE_CONCENTRATION: float(x * parameters.evaluate(param.n.prim.c_max)),
+        POSITIVE_CONCENTRATION: float(y * parameters.evaluate(param.p.prim.c_max)),
+    }
+    with _lock:
+        _initial_states[key] = state
+        while len(_initial_states) > MAX_INITIAL_STATES:
+            _initial_states.popitem(last=False)
+    return state
+
+
+# Puts `parameters` at `initial_soc`, in place of passing initial_soc to sim.solve
+def set_initial_soc(
+    parameters: pybamm.ParameterValues, initial_soc: float, options: dict = None
+) -> pybamm.ParameterValues:
+    state = resolve(parameters, initial_soc, options)
+    parameters.update(
+        {
+            NEGATIVE_CONCENTRATION: state[NEGATIVE_CONCENTRATION],
+            POSITIVE_CONCENTRATION: state[POSITIVE_CONCENTRATION],
+        }
+    )
+    return parameters
@@ -0,0 +1,153 @@
+import os
+import queue
+import threading
+import time
+import uuid
+
+import pybamm
+from flask import current_app, jsonify
+
+import admission
+import metrics
+import responses
+import result_cache
+import tracing
+
+# Background threads that run submitted simulations
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 1))
+# Seconds a finished job (and its result) is kept for polling
+JOB_TTL = float(os.environ.get("JOB_TTL", 3600))
+
+
+class Job:
+    def __init__(self, lab: str, data: dict, run, track_progress: bool):
+        self.id = uuid.uuid4().hex
+        self.lab = lab
+        self.data = data
+        self.run = run
+        self.track_progress = track_progress
+        self.status = "queued"  # queued -> running -> done / failed
+        self.cycles_done = 0
+        self.cycles_total = None
+        self.body = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def to_dict(self) -> dict:
+        status = {
+            "id": self.id,
+            "lab": self.lab,
+            "status": self.status,
+            "progress": {"cycles": self.cycles_done, "total": self.cycles_total},
+        }
+        if self.error is not None:
+            status["error"] = self.error
+        return status
+
+
+# Keeps the job progress in step with the experiment's cycle counter
+class JobProgressCallback(pybamm.callbacks.Callback):
+    def __init__(self, job: Job):
+        self.job = job
+
+    def on_cycle_start(self, logs):
+        cycle, total = logs["cycle number"]
+        self.job.cycles_done = cycle - 1
+        self.job.cycles_total = total
+
+    def on_cycle_end(self, logs):
+        self.job.cycles_done, self.job.cycles_total = logs["cycle number"]
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+# Jobs waiting for a worker, bounded like the synchronous routes' admission queue
+_queue = queue.Queue(maxsize=admission.MAX_QUEUED_SIMULATIONS)
+_workers = []
+
+
+def _run_job(app, job: Job) -> None:
+    job.status = "running"
+    try:
+        run = job.run
+        if job.track_progress:
+
+            def run(data):
+                return job.run(data, callbacks=[JobProgressCallback(job)])
+
+        with app.app_context(), tracing.trace(f"{job.lab}-job"):
+            job.body = result_cache.cached_body(job.lab, job.data, run, block=True)
+        job.status = "done"
+    except Exception as e:
+        print(e)
+        job.error = "ERROR: " + str(e)
+        job.status = "failed"
+    job.finished_at = time.time()
+
+
+def _worker() -> None:
+    while True:
+        app, job = _queue.get()
+        metrics.jobs_queued.dec()
+        try:
+            _run_job(app, job)
+        finally:
+            _queue.task_done()
+
+
+def _start_workers() -> None:
+    while len(_workers) < JOB_WORKERS:
+        worker = threading.Thread(target=_worker, daemon=True)
+        worker.start()
+        _workers.append(worker)
+
+
+def _forget_finished_jobs() -> None:
+    now = time.time()
+    for job_id, job in list(_jobs.items()):
+        if job.finished_at is not None and now - job.finished_at > JOB_TTL:
+            del _jobs[job_id]
+
+
+# Queues a lab run and answers straight away with the id to poll, or with a 503 and
+# Retry-After when the queue is full
+def submit_job(lab: str, data: dict, run, track_progress: bool = False):
+    job = Job(lab, data, run, track_progress)
+    with _jobs_lock:
+        _forget_finished_jobs()
+        _start_workers()
+    metrics.jobs_queued.inc()
+    try:
+        _queue.put_nowait((current_app._get_current_object(), job))
+    except queue.Full:
+        metrics.jobs_queued.dec()
+        metrics.admission_rejections.inc(**metrics.lab_labels(lab, data))
+        return admission.busy_response(admission.Busy(admission.retry_after()))
+    with _jobs_lock:
+        _jobs[job.id] = job
+    return jsonify(job.to_dict()), 202
+
+
+def get_job(job_id: str) -> Job:
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+
+# Returns the same graphs the synchronous route would have returned
+def job_result(request, job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if job.status == "failed":
+        return jsonify([job.error])
+    if job.status != "done":
+        return jsonify(job.to_dict()), 202
+    return responses.respond(request, job.body)
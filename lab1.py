@@ -1,141 +1,293 @@
 from flask import jsonify
 import pybamm
 import utils
+import downsampling
+import responses
+import executor
+import surrogate
+import metrics
+import outputs
+import cycling
+import solver_backends
+import tracing
 import numpy
+import time
+
+# What the graphs read from each cycling run
+CYCLING_OUTPUTS = outputs.OutputVariables(
+    ["Loss of lithium inventory [%]"], ["Capacity [A.h]"]
+)
 
 
 # DONE Add c rates to Cycling
 def simulate_lab1(request):
     try:
         print("New Request: ", request.json)
-        data = request.json
-        battery_type: str = data.get("Type")
-        temperature: float = float(data.get("Ambient temperature [K]"))
-        capacity: float = float(data.get("Nominal cell capacity [A.h]"))
-        c_rates: list = data.get("C Rates", [1])
-        cycles: int = int(data.get("Cycles", 1))
+        data: dict = request.json
+        if data.get("Type") not in utils.batteries:
+            return jsonify({"error": "Unsupported chemistry"}), 400
 
-        if cycles > 50:
-            cycles = 50
+        # Previews are interpolated when the inputs are inside the surrogate grid
+        if data.get("Preview"):
+            data = {key: value for key, value in data.items() if key != "Preview"}
+            with tracing.span("surrogate"):
+                preview = preview_lab1(data)
+            if preview is not None:
+                return surrogate.respond(request, "lab1", data, *preview)
+            print("No surrogate preview within its error bound, solving")
+            labels = metrics.lab_labels("lab1", data)
+            metrics.surrogate_previews.inc(result="fallback", **labels)
 
-        if battery_type not in utils.batteries:
-            return jsonify({"error": "Unsupported chemistry"}), 400
+        return responses.lab_response(request, "lab1", data, run_lab1)
 
-        parameters = utils.get_battery_parameters(
-            battery_type, degradation_enabled=False
-        )
-        utils.update_parameters(
-            parameters, temperature, capacity, None, None, battery_type
-        )
+    except Exception as e:
+        print(e)
+        return jsonify(["ERROR: " + str(e)])
 
-        final_result = []
-        final_result.append(
-            utils.run_charging_experiments(battery_type, c_rates, "Charge", parameters)
-        )
 
-        parameters.set_initial_stoichiometries(1)
-        final_result.append(
-            utils.run_charging_experiments(
-                battery_type, c_rates, "Discharge", parameters
-            )
-        )
+def read_inputs(data: dict) -> tuple:
+    battery_type: str = data.get("Type")
+    temperature: float = float(data.get("Ambient temperature [K]"))
+    capacity: float = float(data.get("Nominal cell capacity [A.h]"))
+    c_rates: list = data.get("C Rates", [1])
+    cycles: int = cycling.clamp_cycles(data.get("Cycles", 1))
+    return battery_type, temperature, capacity, c_rates, cycles
 
-        # Cycling
-        experiment_result = [{"title": "Cycling"}]
-        minV, maxV = utils.get_voltage_limits(battery_type)
-        cycling_graphs = []
-        lithium_graphs = []
-        parameters = utils.get_battery_parameters(
-            battery_type, degradation_enabled=True
-        )
-        utils.update_parameters(
-            parameters, temperature, capacity, None, None, battery_type
-        )
-        i = 0
-        for c_rate in c_rates:
-            i = i + 1
-            #v_crate = float(c_rate)
-            v_crate = utils.get_virtual_c_rate(float(c_rate))
-            print("V C-rate: ", v_crate, " for ", c_rate)
-
-            c_experiment = pybamm.Experiment(
-                [
-                    (
-                        f"Charge at {v_crate} C for 10 hours or until {maxV} V",
-                        f"Discharge at {v_crate} C for 10 hours or until {minV} V",
-                        f"Hold at {maxV}V for 1 hour or until C/100",
-                    )
-                ]
-                * cycles
-            )
 
-            c_model = pybamm.lithium_ion.SPM(
-                {"SEI": "ec reaction limited"}
-            )
-            sim = pybamm.Simulation(
-                c_model, parameter_values=parameters, experiment=c_experiment
-            )
-            print("Running simulation Cycling\n")
-            solver = pybamm.CasadiSolver(
-                "safe", extra_options_setup={"max_num_steps": 200}
-            )
-            sol: pybamm.Solution = sim.solve(solver=solver, save_at_cycles=1)
-            # print(sol.summary_variables.keys())
-
-            cap = []
-            if battery_type == "NCA":
-                cap = sol.summary_variables["Capacity [A.h]"].tolist()
-            elif battery_type == "LFP":
-                cap = sol.summary_variables["Capacity [A.h]"].tolist()
-            else:
-                cap = utils.transform_to_inverse_bezier_curve(sol.summary_variables["Capacity [A.h]"], c_rate * cycles /550.0)
-            
-            cycling_graphs.append(
+def run_lab1(data: dict) -> list:
+    battery_type, temperature, capacity, c_rates, cycles = read_inputs(data)
+    method, points = downsampling.options_from_request(data)
+    digits = responses.precision_from_request(data)
+    # The sweeps solve a shared built model through CasADi, only cycling has a choice
+    backend = solver_backends.backend_from_request("lab1", data)
+
+    # The sweeps and every cycling C rate are independent, run them side by side
+    calls = [
+        (run_sweep, (battery_type, temperature, capacity, c_rates, "Charge")),
+        (run_sweep, (battery_type, temperature, capacity, c_rates, "Discharge")),
+    ]
+    calls += [
+        (run_cycling, (battery_type, temperature, capacity, c_rate, cycles, backend))
+        for c_rate in c_rates
+    ]
+    results = executor.run_ordered(calls)
+    return assemble_result(results, method, points, digits)
+
+
+# Returns (result, error bound) interpolated from the surrogate tables, None when the
+# request is outside them or their error is not within surrogate.MAX_ERROR
+def preview_lab1(data: dict) -> tuple:
+    battery_type, temperature, capacity, c_rates, cycles = read_inputs(data)
+    method, points = downsampling.options_from_request(data)
+    digits = responses.precision_from_request(data)
+    preview = surrogate.lab1_series(
+        battery_type, temperature, capacity, c_rates, cycles
+    )
+    if preview is None:
+        return None
+    rates, error = preview
+
+    # Same layout as the executor results: both sweeps, then each C rate's cycling
+    results = []
+    for mode in ("Charge", "Discharge"):
+        title, y_axis_label = utils.sweep_labels(mode)
+        graphs = []
+        for c_rate, series in zip(c_rates, rates):
+            graphs.append(
                 {
-                    "name": "Cycle",
-                    "round": True,
-                    # "values": utils.interpolate_array(sol.summary_variables["Cycle number"].tolist(), 24, True),
-                    "values": sol.summary_variables["Cycle number"].tolist(),
+                    "name": y_axis_label,
+                    "values": series[f"{mode.lower()}_capacity"].tolist(),
                 }
             )
-            cycling_graphs.append(
+            graphs.append(
                 {
-                    "name": "Discharge capacity [A.h]",
-                    # "fname": f"{c_rates[len(c_rates)-i]}C",
+                    "name": "Voltage [V]",
                     "fname": f"{c_rate}C",
-                    "values": cap,
-                    # "values": utils.interpolate_array(sol.summary_variables["Capacity [A.h]"].tolist(),24)
+                    "values": series[f"{mode.lower()}_voltage"].tolist(),
                 }
             )
-            # lithium_graphs.append(
-            #    {
-            #        "name": "Cycle",
-            #        "round": True,
-            #        # "values": utils.interpolate_array(sol.summary_variables["Cycle number"].tolist(), 24, True),
-            #        "values": sol.summary_variables["Cycle number"].tolist(),
-            #    }
-            # )
-            # lithium_graphs.append(
-            #    {
-            #        "name": "Loss of lithium inventory [%]",
-            #        # "fname": f"{c_rates[len(c_rates)-i]}C",
-            #        "fname": f"{c_rate}C",
-            #        "values": sol.summary_variables["Loss of lithium inventory [%]"].tolist(),
-            #        # "values": utils.interpolate_array(sol.summary_variables["Capacity [A.h]"].tolist(),24)
-            #    }
-            # )
-
-            lithium_graphs += utils.plot_against_cycle(
-                sol, cycles, "Loss of lithium inventory [%]", f"{c_rate}C"
+        results.append([{"title": title}, {"graphs": graphs}])
+    for c_rate, series in zip(c_rates, rates):
+        results.append(
+            build_cycling_graphs(
+                battery_type,
+                c_rate,
+                cycles,
+                numpy.arange(1, cycles + 1),
+                series["cycle_capacity"],
+                series["lithium_loss"],
             )
-            del sol
-        experiment_result.append({"graphs": cycling_graphs})
-        final_result.append(experiment_result)
+        )
+    return assemble_result(results, method, points, digits), error
 
-        experiment_result = [{"title": "Loss of Lithium"}, {"graphs": lithium_graphs}]
-        final_result.append(experiment_result)
-        return jsonify(final_result)
 
-    except Exception as e:
-        print(e)
-        return jsonify(["ERROR: " + str(e)])
+# Turns [charge sweep, discharge sweep, (cycling, lithium graphs) per C rate] into the
+# lab result
+def assemble_result(results: list, method: str, points: int, digits: int) -> list:
+    final_result = []
+    final_result.append(results[0])
+    final_result.append(results[1])
+
+    # Cycling
+    experiment_result = [{"title": "Cycling"}]
+    cycling_graphs = []
+    lithium_graphs = []
+    for c_rate_cycling_graphs, c_rate_lithium_graphs in results[2:]:
+        cycling_graphs += c_rate_cycling_graphs
+        lithium_graphs += c_rate_lithium_graphs
+    experiment_result.append({"graphs": cycling_graphs})
+    final_result.append(experiment_result)
+
+    experiment_result = [{"title": "Loss of Lithium"}, {"graphs": lithium_graphs}]
+    final_result.append(experiment_result)
+    downsampling.downsample_result(final_result, method, points)
+    return responses.round_result(final_result, digits)
+
+
+def run_sweep(
+    battery_type: str, temperature: float, capacity: float, c_rates: list, mode: str
+) -> list:
+    parameters = utils.get_battery_parameters(
+        battery_type, degradation_enabled=False
+    )
+    utils.update_parameters(
+        parameters, temperature, capacity, None, None, battery_type
+    )
+    return utils.run_charging_experiments(battery_type, c_rates, mode, parameters)
+
+
+# Returns the cycling and lithium loss graphs of a single C rate
+def run_cycling(
+    battery_type: str,
+    temperature: float,
+    capacity: float,
+    c_rate: float,
+    cycles: int,
+    backend: str = solver_backends.REFERENCE,
+) -> tuple:
+    sol = solve_cycling(battery_type, temperature, capacity, c_rate, cycles, backend)
+    postprocess_start = time.perf_counter()
+    graphs = build_cycling_graphs(
+        battery_type,
+        c_rate,
+        cycles,
+        sol.summary_variables["Cycle number"],
+        sol.summary_variables["Capacity [A.h]"],
+        utils.concatenate_cycles(sol, "Loss of lithium inventory [%]"),
+    )
+    tracing.record("postprocess", postprocess_start, f"{c_rate}C")
+    return graphs
+
+
+def solve_cycling(
+    battery_type: str,
+    temperature: float,
+    capacity: float,
+    c_rate: float,
+    cycles: int,
+    backend: str = solver_backends.REFERENCE,
+) -> pybamm.Solution:
+    minV, maxV = utils.get_voltage_limits(battery_type)
+    parameters = utils.get_battery_parameters(
+        battery_type, degradation_enabled=True
+    )
+    utils.update_parameters(
+        parameters, temperature, capacity, None, None, battery_type
+    )
+
+    #v_crate = float(c_rate)
+    v_crate = utils.get_virtual_c_rate(float(c_rate))
+    print("V C-rate: ", v_crate, " for ", c_rate)
+
+    c_experiment = pybamm.Experiment(
+        [
+            (
+                f"Charge at {v_crate} C for 10 hours or until {maxV} V",
+                f"Discharge at {v_crate} C for 10 hours or until {minV} V",
+                f"Hold at {maxV}V for 1 hour or until C/100",
+            )
+        ]
+        * cycles
+    )
+
+    c_model = CYCLING_OUTPUTS.prune(
+        pybamm.lithium_ion.SPM({"SEI": "ec reaction limited"})
+    )
+    print("Running simulation Cycling\n")
+    with tracing.span("solve", f"{c_rate}C"):
+        sol: pybamm.Solution = cycling.solve(
+            battery_type,
+            c_model,
+            parameters,
+            c_experiment,
+            CYCLING_OUTPUTS,
+            callbacks=tracing.cycle_callbacks(label=f"{c_rate}C"),
+            # Checkpoints live in the process that solved them. Spawned workers
+            # each keep their own and a rerun rarely lands on the same one, so
+            # they are only left when the cycling runs in the server itself.
+            checkpoint=executor.MAX_WORKERS <= 1,
+            backend=backend,
+        )
+    # print(sol.summary_variables.keys())
+    return sol
+
+
+# Builds the graphs of one C rate from its per cycle summary and lithium loss trace,
+# shared by the solver and the surrogate previews
+def build_cycling_graphs(
+    battery_type: str,
+    c_rate: float,
+    cycles: int,
+    cycle_numbers: numpy.ndarray,
+    capacities: numpy.ndarray,
+    lithium_loss: numpy.ndarray,
+) -> tuple:
+    cycling_graphs = []
+    lithium_graphs = []
+    cap = []
+    if battery_type == "NCA":
+        cap = capacities.tolist()
+    elif battery_type == "LFP":
+        cap = capacities.tolist()
+    else:
+        cap = utils.transform_to_inverse_bezier_curve(capacities, c_rate * cycles /550.0)
+    
+    cycling_graphs.append(
+        {
+            "name": "Cycle",
+            "round": True,
+            # "values": utils.interpolate_array(sol.summary_variables["Cycle number"].tolist(), 24, True),
+            "values": cycle_numbers.tolist(),
+        }
+    )
+    cycling_graphs.append(
+        {
+            "name": "Discharge capacity [A.h]",
+            # "fname": f"{c_rates[len(c_rates)-i]}C",
+            "fname": f"{c_rate}C",
+            "values": cap,
+            # "values": utils.interpolate_array(sol.summary_variables["Capacity [A.h]"].tolist(),24)
+        }
+    )
+    # lithium_graphs.append(
+    #    {
+    #        "name": "Cycle",
+    #        "round": True,
+    #        # "values": utils.interpolate_array(sol.summary_variables["Cycle number"].tolist(), 24, True),
+    #        "values": sol.summary_variables["Cycle number"].tolist(),
+    #    }
+    # )
+    # lithium_graphs.append(
+    #    {
+    #        "name": "Loss of lithium inventory [%]",
+    #        # "fname": f"{c_rates[len(c_rates)-i]}C",
+    #        "fname": f"{c_rate}C",
+    #        "values": sol.summary_variables["Loss of lithium inventory [%]"].tolist(),
+    #        # "values": utils.interpolate_array(sol.summary_variables["Capacity [A.h]"].tolist(),24)
+    #    }
+    # )
+
+    lithium_graphs += utils.series_against_cycle(
+        lithium_loss, cycles, "Loss of lithium inventory [%]", f"{c_rate}C"
+    )
+    return cycling_graphs, lithium_graphs
@@ -1,150 +1,289 @@
 from flask import jsonify
+import json
+import os
+import threading
+from collections import OrderedDict
 import pybamm
 import numpy as np
 import utils
+import downsampling
+import responses
+import result_cache
+import outputs
+import cycling
+import solver_backends
+import solver_profiles
+import tracing
+import time
+
+LITHIUM_PLOTS = {
+    "Total lithium in positive electrode [mol]": "Positive",
+    "Total lithium in negative electrode [mol]": "Negative",
+    "Total lithium [mol]": "Total",
+}
+INTERFACIAL_CURRENT_PLOTS = {
+    "X-averaged negative electrode primary interfacial current density [A.m-2]": "Graphite",
+    "X-averaged negative electrode secondary interfacial current density [A.m-2]": "Silicon",
+}
+LOSS_OF_LITHIUM_PLOTS = {
+    "Loss of lithium inventory [%]": "Loss",
+}
+# Everything the graphs read, the DFN is pruned down to these
+OUTPUTS = outputs.OutputVariables(
+    [*LITHIUM_PLOTS, *INTERFACIAL_CURRENT_PLOTS, *LOSS_OF_LITHIUM_PLOTS],
+    ["Throughput capacity [A.h]"],
+)
+
+# Mesh of each fidelity a request can ask for with "Fidelity", as changes to the
+# DFN's own (20 points in every domain and particle). "measured_error" is the largest
+# difference from standard on the benchmark payloads relative to each series' range,
+# measured with `python benchmark.py fidelity`: capacity is the throughput capacity
+# per cycle, lithium inventory the lithium and loss of lithium traces compared at the
+# same fractions of each cycle. It is an estimate, not a bound for other payloads,
+# and responses label it as such. A tier with a "last_tier" goes no further up the
+# solver tiers, a payload it fails on is answered at standard from then on (see
+# resolve_fidelity).
+FIDELITY_TIERS = {
+    "coarse": {
+        # About 1.6x faster than standard on the benchmark payloads, and solved both
+        # of them. Coarser meshes fail near the silicon's voltage cut-offs on most
+        # payloads, and this one may still fail on others.
+        "var_pts": {
+            "x_n": 15,
+            "x_s": 10,
+            "x_p": 15,
+            "r_n_prim": 10,
+            "r_n_sec": 10,
+            "r_p": 10,
+        },
+        "measured_error": {"capacity": 0.0032, "lithium inventory": 0.0014},
+        # The robust tier takes longer than solving at standard
+        "last_tier": "balanced",
+    },
+    "standard": {
+        "var_pts": {},
+        "measured_error": {"capacity": 0.0, "lithium inventory": 0.0},
+    },
+    "fine": {
+        "var_pts": {
+            "x_n": 30,
+            "x_s": 30,
+            "x_p": 30,
+            "r_n_prim": 30,
+            "r_n_sec": 30,
+            "r_p": 30,
+        },
+        "measured_error": {"capacity": 0.00069, "lithium inventory": 0.00041},
+    },
+}
+DEFAULT_FIDELITY = "standard"
+# Payloads remembered as failing at their fidelity
+MAX_UNAVAILABLE_FIDELITIES = int(os.environ.get("MAX_UNAVAILABLE_FIDELITIES", 1024))
+
+# result key of a payload -> None, for those that failed at their fidelity
+_unavailable = OrderedDict()
+_unavailable_lock = threading.Lock()
+
+
+class FidelityUnavailable(Exception):
+    pass
+
+
+# Reads "Fidelity" from a lab2 payload
+def fidelity_from_request(data: dict) -> str:
+    fidelity = data.get("Fidelity", DEFAULT_FIDELITY)
+    if fidelity not in FIDELITY_TIERS:
+        raise ValueError(f"Unknown fidelity: {fidelity}")
+    return fidelity
+
+
+# The fidelity a payload is solved at and the payload to solve (and cache) it as:
+# its own, or standard (without "Fidelity") once it failed at its own
+def resolve_fidelity(data: dict) -> tuple:
+    fidelity = fidelity_from_request(data)
+    with _unavailable_lock:
+        unavailable = result_cache.make_key("lab2", data) in _unavailable
+    if not unavailable:
+        return fidelity, data
+    data = {key: value for key, value in data.items() if key != "Fidelity"}
+    return DEFAULT_FIDELITY, data
 
 
 def simulate_lab2(request):
     try:
         print("New Request: ", request.json)
-        data: dict = request.json
-        temperature: float = float(data.get("Ambient temperature [K]"))
-        c_rate: float = data.get("C Rates", [1])[0]
-        # cycles: int = 3
-        silicon_percent: float = float(data.get("Silicon Percentage"))
-        cycles = int(data.get("Cycles"))
-        anode_thickness = float(data.get("Negative electrode thickness [um]"))
-        seperator_thickness = float(data.get("Separator thickness [um]"))
-
-        model = pybamm.lithium_ion.DFN(
-            {
-                "particle phases": ("2", "1"),
-                "open-circuit potential": (("single", "current sigmoid"), "single"),
-                "SEI": "solvent-diffusion limited",
-                "SEI": "ec reaction limited",
-            }
+        fidelity, data = resolve_fidelity(request.json)
+        try:
+            response = responses.lab_response(request, "lab2", data, run_lab2)
+        except FidelityUnavailable as e:
+            print(e)
+            tracing.event("fidelity-fallback", fidelity)
+            fidelity, data = resolve_fidelity(data)
+            response = responses.lab_response(request, "lab2", data, run_lab2)
+        # Lets the front end show a coarse result as such and ask for more
+        response.headers["X-Fidelity"] = fidelity
+        response.headers["X-Fidelity-Measured-Error"] = json.dumps(
+            FIDELITY_TIERS[fidelity]["measured_error"]
         )
+        return response
 
-        parameters = pybamm.ParameterValues("Chen2020_composite")
+    except Exception as e:
+        print(e)
+        return jsonify(["ERROR: " + str(e)])
+
+
+def run_lab2(data: dict, callbacks: list = None) -> list:
+    temperature: float = float(data.get("Ambient temperature [K]"))
+    c_rate: float = data.get("C Rates", [1])[0]
+    # cycles: int = 3
+    silicon_percent: float = float(data.get("Silicon Percentage"))
+    cycles = cycling.clamp_cycles(data.get("Cycles"))
+    anode_thickness = float(data.get("Negative electrode thickness [um]"))
+    seperator_thickness = float(data.get("Separator thickness [um]"))
+    method, points = downsampling.options_from_request(data)
+    digits = responses.precision_from_request(data)
+    backend = solver_backends.backend_from_request("lab2", data)
+    fidelity = fidelity_from_request(data)
+
+    model = pybamm.lithium_ion.DFN(
+        {
+            "particle phases": ("2", "1"),
+            "open-circuit potential": (("single", "current sigmoid"), "single"),
+            "SEI": "solvent-diffusion limited",
+            "SEI": "ec reaction limited",
+        }
+    )
+    OUTPUTS.prune(model)
+    var_pts = {**model.default_var_pts, **FIDELITY_TIERS[fidelity]["var_pts"]}
+
+    parameters = utils.get_battery_parameters("Silicon")
+
+    parameters.update(
+        {
+            "Primary: Maximum concentration in negative electrode [mol.m-3]": 28700,
+            "Primary: Initial concentration in negative electrode [mol.m-3]": 23000,
+            "Primary: Negative electrode diffusivity [m2.s-1]": 5.5e-14,
+            "Secondary: Negative electrode diffusivity [m2.s-1]": 1.67e-14,
+            "Secondary: Initial concentration in negative electrode [mol.m-3]": 277000,
+            "Secondary: Maximum concentration in negative electrode [mol.m-3]": 278000,
+        }
+    )
+    utils.update_parameters(
+        parameters, temperature, None, None, silicon_percent, "LG M50"
+    )
+
+    s = pybamm.step.string
+    # c_rate = utils.get_virtual_c_rate(c_rate)
+    cycling_experiment = pybamm.Experiment(
+        [
+            (
+                
+                s(
+                    f"Discharge at {c_rate} C for 11 hours or until 2.5 V",
+                    period="1 minutes",
+                ),
+                s(f"Charge at {c_rate} C for 11 hours until 4.0 V", period="1 minutes"
+                  ),
+                #s(f"Hold at 4.0 V for 1 hour or until 50 mA", period="0.5 minutes"),
+            )
+        ]
+        * cycles,
+    )
 
+    print("Running experiment")
+    if anode_thickness != None:
         parameters.update(
             {
-                "Primary: Maximum concentration in negative electrode [mol.m-3]": 28700,
-                "Primary: Initial concentration in negative electrode [mol.m-3]": 23000,
-                "Primary: Negative electrode diffusivity [m2.s-1]": 5.5e-14,
-                "Secondary: Negative electrode diffusivity [m2.s-1]": 1.67e-14,
-                "Secondary: Initial concentration in negative electrode [mol.m-3]": 277000,
-                "Secondary: Maximum concentration in negative electrode [mol.m-3]": 278000,
+                "Negative electrode thickness [m]": anode_thickness * 1e-6,
+                "Separator thickness [m]": seperator_thickness * 1e-6,
             }
         )
-        utils.update_parameters(
-            parameters, temperature, None, None, silicon_percent, "LG M50"
-        )
+    tier = FIDELITY_TIERS[fidelity]
+    with tracing.span("solve", fidelity):
+        try:
+            sol = cycling.solve(
+                "Silicon",
+                model,
+                parameters,
+                cycling_experiment,
+                OUTPUTS,
+                callbacks=tracing.cycle_callbacks(callbacks),
+                # The fast tier's long steps fail near the cut-offs of this model
+                tier="balanced",
+                backend=backend,
+                var_pts=var_pts,
+                last_tier=tier.get("last_tier", solver_profiles.TIERS[-1]),
+                calc_esoh=False,
+            )
+        except pybamm.SolverError as e:
+            if "last_tier" not in tier:
+                raise
+            # Later requests for this payload are answered at standard (see
+            # resolve_fidelity), a standard result never goes under its key
+            with _unavailable_lock:
+                _unavailable[result_cache.make_key("lab2", data)] = None
+                while len(_unavailable) > MAX_UNAVAILABLE_FIDELITIES:
+                    _unavailable.popitem(last=False)
+            raise FidelityUnavailable(
+                f"Fidelity {fidelity} failed ({e}), ask for {DEFAULT_FIDELITY}"
+            ) from e
+    print("Number of Cycles: ", len(sol.cycles))
+    print("Solution took: ", sol.solve_time)
+    postprocess_start = time.perf_counter()
 
-        fast_solver = pybamm.CasadiSolver(
-            mode="safe", dt_max=0.01, extra_options_setup={"max_num_steps": 600}, return_solution_if_failed_early=True
-        )
-        s = pybamm.step.string
-        # c_rate = utils.get_virtual_c_rate(c_rate)
-        cycling_experiment = pybamm.Experiment(
-            [
-                (
-                    
-                    s(
-                        f"Discharge at {c_rate} C for 11 hours or until 2.5 V",
-                        period="1 minutes",
-                    ),
-                    s(f"Charge at {c_rate} C for 11 hours until 4.0 V", period="1 minutes"
-                      ),
-                    #s(f"Hold at 4.0 V for 1 hour or until 50 mA", period="0.5 minutes"),
-                )
-            ]
-            * cycles,
+    experiment_result1 = [
+        {"title": "Lithium in Electrodes"},
+        {"graphs": utils.plot_graphs_against_cycle(sol, cycles, LITHIUM_PLOTS, "Lithium amount [mol]")},
+    ]
+    
+    capacity_graph = []
+    capacity_graph.append(
+            {
+                "name": "Cycle",
+                "round": False,
+                # "values": utils.interpolate_array(sol.summary_variables["Cycle number"].tolist(), 24, True),
+                "values": sol.summary_variables["Cycle number"].tolist(),
+            }
         )
-
-        print("Running experiment")
-        if anode_thickness != None:
-            parameters.update(
-                {
-                    "Negative electrode thickness [m]": anode_thickness * 1e-6,
-                    "Separator thickness [m]": seperator_thickness * 1e-6,
-                }
-            )
-        sim = pybamm.Simulation(
-            model,
-            parameter_values=parameters,
-            solver=fast_solver,
-            experiment=cycling_experiment,
+    capacity_graph.append(
+            {
+                "name": "Throughput capacity [A.h]",
+                # "fname": f"{c_rates[len(c_rates)-i]}C",
+                "fname": f"Capacity",
+                "values": sol.summary_variables["Throughput capacity [A.h]"].tolist(),
+                # "values": utils.interpolate_array(sol.summary_variables["Capacity [A.h]"].tolist(),24)
+            }
         )
-        sol = sim.solve(calc_esoh=False, save_at_cycles=1)
-        print("Number of Cycles: ", len(sol.cycles))
-        print("Solution took: ", sol.solve_time)
-
-        plots = {
-            "Total lithium in positive electrode [mol]": "Positive",
-            "Total lithium in negative electrode [mol]": "Negative",
-            "Total lithium [mol]": "Total",
-        }
-        experiment_result1 = [
-            {"title": "Lithium in Electrodes"},
-            {"graphs": utils.plot_graphs_against_cycle(sol, cycles, plots, "Lithium amount [mol]")},
-        ]
-        
-        capacity_graph = []
-        capacity_graph.append(
-                {
-                    "name": "Cycle",
-                    "round": False,
-                    # "values": utils.interpolate_array(sol.summary_variables["Cycle number"].tolist(), 24, True),
-                    "values": sol.summary_variables["Cycle number"].tolist(),
-                }
+    experiment_result2 = [{"title": "Capacity over Cycles"},{"graphs": capacity_graph}]
+    experiment_result3 = [
+        {"title": "Interfacial Current Density"},
+        {
+            "graphs": utils.plot_graphs_against_cycle(
+                sol,
+                cycles,
+                INTERFACIAL_CURRENT_PLOTS,
+                "interfacial current density [A.m-2]",
             )
-        capacity_graph.append(
-                {
-                    "name": "Throughput capacity [A.h]",
-                    # "fname": f"{c_rates[len(c_rates)-i]}C",
-                    "fname": f"Capacity",
-                    "values": sol.summary_variables["Throughput capacity [A.h]"].tolist(),
-                    # "values": utils.interpolate_array(sol.summary_variables["Capacity [A.h]"].tolist(),24)
-                }
-            )
-        experiment_result2 = [{"title": "Capacity over Cycles"},{"graphs": capacity_graph}]
-        experiment_result3 = [
-            {"title": "Interfacial Current Density"},
-            {
-                "graphs": utils.plot_graphs_against_cycle(
-                    sol,
-                    cycles,
-                    {
-                        "X-averaged negative electrode primary interfacial current density [A.m-2]": "Graphite",
-                        "X-averaged negative electrode secondary interfacial current density [A.m-2]": "Silicon",
-                    },
-                    "interfacial current density [A.m-2]",
-                )
-            },
-        ]
-
-        experiment_result4 = [
-            {"title": "Loss of Lithium"},
-            {
-                "graphs": utils.plot_graphs_against_cycle(
-                    sol,
-                    cycles,
-                    {
-                        "Loss of lithium inventory [%]": "Loss",
-                    },
-                )
-            },
-        ]
+        },
+    ]
 
-        final_result = [
-            experiment_result2,
-            experiment_result3,
-            experiment_result1,
-            experiment_result4,
-        ]
-        return jsonify(final_result)
+    experiment_result4 = [
+        {"title": "Loss of Lithium"},
+        {
+            "graphs": utils.plot_graphs_against_cycle(
+                sol,
+                cycles,
+                LOSS_OF_LITHIUM_PLOTS,
+            )
+        },
+    ]
 
-    except Exception as e:
-        print(e)
-        return jsonify(["ERROR: " + str(e)])
+    final_result = [
+        experiment_result2,
+        experiment_result3,
+        experiment_result1,
+        experiment_result4,
+    ]
+    tracing.record("postprocess", postprocess_start)
+    downsampling.downsample_result(final_result, method, points)
+    return responses.round_result(final_result, digits)
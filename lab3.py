@@ -1,176 +1,348 @@
-from flask import jsonify
+from flask import jsonify, current_app
+import json
+import queue
+import threading
 import pybamm
 import numpy as np
 from scipy.ndimage import interpolation
 import utils
+import downsampling
+import result_cache
+import responses
+import outputs
+import cycling
+import initial_state
+import solver_backends
+import tracing
+import time
+
+# Points kept of each cycle's voltage trace when streaming
+STREAM_TRACE_POINTS = 200
+STREAM_SUMMARY_VARIABLES = [
+    "Capacity [A.h]",
+    "Loss of lithium inventory [%]",
+    "Loss of capacity to negative SEI [A.h]",
+    "Minimum voltage [V]",
+]
+# What the graphs and the stream read, "Minimum voltage [V]" comes from the
+# experiment's voltage stop rather than the model
+OUTPUTS = outputs.OutputVariables(
+    ["Time [s]", "Voltage [V]", "Throughput capacity [A.h]"],
+    [name for name in STREAM_SUMMARY_VARIABLES if name != "Minimum voltage [V]"],
+)
 
 
 def simulate_lab3(request):
     try:
         print("New Request: ", request.json)
         data: dict = request.json
-        battery_type: str = data.get("Type")
-        initial_charge: float = float(data.get("Initial SOC", 1)) * 0.01
-
-        charging_properties: dict = data.get("Charging Properties")
-        charge_current: float = charging_properties.get("Charge C", 1)
-        charge_voltage: float = charging_properties.get("Charge V", 1)
-        hold_voltage: float = charging_properties.get("Hold V", 1)
-        hold_current: float = charging_properties.get("Hold C", 1)
-        rest1_minutes: float = charging_properties.get("Rest T", 1)
-        discharge_current: float = charging_properties.get("Discharge C", 1)
-        discharge_voltage: float = charging_properties.get("Discharge V", 1)
-        rest2_minutes: float = charging_properties.get("Rest 2T", 1)
-        cycles: float = charging_properties.get("Cycles", 1)
-        print("Initial Charge:", initial_charge)
-
-        if battery_type not in utils.batteries:
+        if data.get("Type") not in utils.batteries:
             return jsonify({"error": "Unsupported chemistry"}), 400
 
-        parameters = utils.get_battery_parameters(
-            battery_type, degradation_enabled=True
-        )
-
-        if cycles > 50:
-            cycles = 50
-
-        utils.update_parameters(parameters, None, 5, None, None, battery_type)
+        return responses.lab_response(request, "lab3", data, run_lab3)
 
-        model = pybamm.lithium_ion.SPM({"SEI": "ec reaction limited"})
+    except Exception as e:
+        print(e)
+        return jsonify(["ERROR: " + str(e)])
 
-        final_result = []
-        graphs = []
 
-        experiment = pybamm.Experiment(
-            [
-                (
-                    f"Charge at {(charge_current)} C for 10 hours or until {charge_voltage} V",
-                    f"Hold at {hold_voltage} V for 2 hours or until C*{hold_current}",
-                    f"Rest for {rest1_minutes} minutes",
-                    f"Discharge at {(discharge_current)} C for 10 hours or until {discharge_voltage} V",
-                    f"Rest for {rest2_minutes} minutes",
+# Streams each finished cycle as a server-sent event, then the full result
+def stream_lab3(request):
+    print("New Stream Request: ", request.json)
+    data: dict = request.json
+    if data.get("Type") not in utils.batteries:
+        return jsonify({"error": "Unsupported chemistry"}), 400
+
+    app = current_app._get_current_object()
+    events = queue.Queue()
+    cycles_sent = 0
+
+    def on_cycle(cycle: dict):
+        nonlocal cycles_sent
+        # A solver retry solves the first cycles again, they were already sent
+        if cycle["cycle"] <= cycles_sent:
+            return
+        cycles_sent = cycle["cycle"]
+        events.put(("cycle", json.dumps(cycle)))
+
+    def run():
+        try:
+            with app.app_context(), tracing.trace("lab3-stream"):
+                body = result_cache.cached_body(
+                    "lab3", data, lambda data: run_lab3(data, on_cycle=on_cycle)
                 )
-            ]
-            * cycles
-        )
-
-        sim = pybamm.Simulation(
-            model, parameter_values=parameters, experiment=experiment
-        )
-        print("Running simulation Cycling\n")
-        solver = pybamm.CasadiSolver(
-            "safe", dt_max=0.01, extra_options_setup={"max_num_steps": 500}
-        )
-        sol = sim.solve(solver=solver, save_at_cycles=1, initial_soc=initial_charge)
-
-        # Prepare data for plotting
-        experiment_result = [{"title": "Capacity over Cycles"}]
-        cap = []
-        if battery_type == "NCA":
-            cap = sol.summary_variables["Capacity [A.h]"].tolist()
-        elif battery_type == "LFP":
-            cap = utils.transform_to_inverse_bezier_curve(sol.summary_variables["Capacity [A.h]"], (cycles / 250.0) * ((charge_current + discharge_current) / 2))
+            events.put(("result", body.decode("utf-8").strip()))
+        except Exception as e:
+            print(e)
+            events.put(("error", json.dumps(["ERROR: " + str(e)])))
+        events.put(None)
+
+    # The solve keeps going (and fills the cache) even if the client disconnects
+    threading.Thread(target=run, daemon=True).start()
+
+    def generate():
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            name, payload = event
+            yield f"event: {name}\ndata: {payload}\n\n"
+
+    return current_app.response_class(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def voltage_trace(sub_solutions: list) -> tuple:
+    time = np.concatenate([sub.t for sub in sub_solutions])
+    voltage = np.concatenate([sub["Voltage [V]"].entries for sub in sub_solutions])
+    return time, voltage
+
+
+# Hands every completed cycle's summary and voltage trace to `on_cycle`. Bounded
+# runs (see cycling.py) drop their cycles from the solution, the trace then comes
+# from the run's CycleStore. Runs resumed from a checkpoint send its cycles first.
+class CycleStreamCallback(pybamm.callbacks.Callback):
+    def __init__(
+        self, sim: pybamm.Simulation, on_cycle, method: str, store=None
+    ):
+        self.sim = sim
+        self.on_cycle = on_cycle
+        self.method = method
+        self.store = store
+        self.sub_solutions_seen = 0
+        self.started = False
+
+    def on_cycle_start(self, logs):
+        solution = self.sim.solution
+        if not self.started and solution is not None:
+            total = logs["cycle number"][1]
+            for cycle, (cycle_solution, summary_variables) in enumerate(
+                zip(solution.cycles, solution.all_summary_variables), start=1
+            ):
+                self.send(
+                    cycle,
+                    total,
+                    summary_variables,
+                    *voltage_trace(cycle_solution.sub_solutions),
+                )
+        self.started = True
+        self.sub_solutions_seen = 0 if solution is None else len(solution.sub_solutions)
+
+    def on_cycle_end(self, logs):
+        cycle, total = logs["cycle number"]
+        if self.store is not None:
+            last_cycle = self.store.cycles[-1]
+            time = np.array(last_cycle["Time [s]"].entries)
+            voltage = np.array(last_cycle["Voltage [V]"].entries)
         else:
-            cap = utils.transform_to_inverse_bezier_curve(sol.summary_variables["Capacity [A.h]"], (cycles / 350.0) * ((charge_current + discharge_current) / 2))
-        graphs.append(
-            {
-                "name": "Cycle",
-                "round": True,
-                "values": sol.summary_variables["Cycle number"].tolist(),
-            }
+            sub_solutions = self.sim.solution.sub_solutions[self.sub_solutions_seen :]
+            time, voltage = voltage_trace(sub_solutions)
+        self.send(cycle, total, logs.get("summary variables", {}), time, voltage)
+
+    def send(
+        self,
+        cycle: int,
+        total: int,
+        summary_variables: dict,
+        time: np.ndarray,
+        voltage: np.ndarray,
+    ) -> None:
+        time, voltage = downsampling.downsample(
+            time - time[0], voltage, self.method, STREAM_TRACE_POINTS
         )
-        graphs.append(
+        self.on_cycle(
             {
-                "name": "Capacity [A.h]",
-                "fname": "Capacity",
-                "values": cap,
+                "cycle": cycle,
+                "total": total,
+                "summary": {
+                    name: float(summary_variables[name])
+                    for name in STREAM_SUMMARY_VARIABLES
+                    if name in summary_variables
+                },
+                "Time [s]": time.tolist(),
+                "Voltage [V]": voltage.tolist(),
             }
         )
-        experiment_result.append({"graphs": graphs})
-        final_result.append(experiment_result)
 
-        experiment_result = [{"title": "Voltage over Cycles"}]
 
-        experiment_result.append(
-            {
-                "graphs": utils.plot_against_cycle(
-                    sol, cycles, "Voltage [V]", "Voltage", True
-                )
-            }
+def run_lab3(data: dict, callbacks: list = None, on_cycle=None) -> list:
+    battery_type: str = data.get("Type")
+    initial_charge: float = float(data.get("Initial SOC", 1)) * 0.01
+
+    charging_properties: dict = data.get("Charging Properties")
+    charge_current: float = charging_properties.get("Charge C", 1)
+    charge_voltage: float = charging_properties.get("Charge V", 1)
+    hold_voltage: float = charging_properties.get("Hold V", 1)
+    hold_current: float = charging_properties.get("Hold C", 1)
+    rest1_minutes: float = charging_properties.get("Rest T", 1)
+    discharge_current: float = charging_properties.get("Discharge C", 1)
+    discharge_voltage: float = charging_properties.get("Discharge V", 1)
+    rest2_minutes: float = charging_properties.get("Rest 2T", 1)
+    cycles: float = charging_properties.get("Cycles", 1)
+    method, points = downsampling.options_from_request(data)
+    digits = responses.precision_from_request(data)
+    backend = solver_backends.backend_from_request("lab3", data)
+    print("Initial Charge:", initial_charge)
+
+    parameters = utils.get_battery_parameters(
+        battery_type, degradation_enabled=True
+    )
+
+    cycles = cycling.clamp_cycles(cycles)
+
+    utils.update_parameters(parameters, None, 5, None, None, battery_type)
+
+    model = OUTPUTS.prune(pybamm.lithium_ion.SPM({"SEI": "ec reaction limited"}))
+    initial_state.set_initial_soc(parameters, initial_charge, model.options)
+
+    final_result = []
+    graphs = []
+
+    experiment = pybamm.Experiment(
+        [
+            (
+                f"Charge at {(charge_current)} C for 10 hours or until {charge_voltage} V",
+                f"Hold at {hold_voltage} V for 2 hours or until C*{hold_current}",
+                f"Rest for {rest1_minutes} minutes",
+                f"Discharge at {(discharge_current)} C for 10 hours or until {discharge_voltage} V",
+                f"Rest for {rest2_minutes} minutes",
+            )
+        ]
+        * cycles
+    )
+
+    callbacks = tracing.cycle_callbacks(callbacks)
+
+    def simulation_callbacks(sim: pybamm.Simulation, store) -> list:
+        if on_cycle is None:
+            return callbacks
+        stream = CycleStreamCallback(sim, on_cycle, method, store)
+        return (callbacks or []) + [stream]
+
+    print("Running simulation Cycling\n")
+    with tracing.span("solve"):
+        sol = cycling.solve(
+            battery_type,
+            model,
+            parameters,
+            experiment,
+            OUTPUTS,
+            callbacks=simulation_callbacks,
+            # Reruns of the same protocol with more cycles carry on from the last
+            checkpoint=True,
+            backend=backend,
         )
-        final_result.append(experiment_result)
-
-        experiment_result = [{"title": "Charging in different Cycles"}]
-        graphs = []
-
-        # First cycle (cycle 0)
-        charge_step1 = sol.cycles[0].steps[0]  # Charging step
-        voltage_charge1 = charge_step1["Voltage [V]"].entries.tolist()
-        throughput_cap_charge1 = charge_step1["Throughput capacity [A.h]"].entries.tolist()
-        cycle1_crg_cap = [x - throughput_cap_charge1[0] for x in throughput_cap_charge1]  # Normalize to start at 0
-
-        # Second cycle (cycle 1)
-        charge_step2 = sol.cycles[1].steps[0]
-        voltage_charge2 = charge_step2["Voltage [V]"].entries.tolist()
-        throughput_cap_charge2 = charge_step2["Throughput capacity [A.h]"].entries.tolist()
-        cycle2_crg_cap = [x - throughput_cap_charge2[0] for x in throughput_cap_charge2]
-
-        # Last cycle
-        charge_stepL = sol.cycles[-1].steps[0]
-        voltage_chargeL = charge_stepL["Voltage [V]"].entries.tolist()
-        throughput_cap_chargeL = charge_stepL["Throughput capacity [A.h]"].entries.tolist()
-        cycleL_crg_cap = [x - throughput_cap_chargeL[0] for x in throughput_cap_chargeL]
-
-        # Populate graphs
-        graphs.append({"name": "Throughput capacity [A.h]", "values": cycle1_crg_cap})
-        graphs.append({"name": "Voltage [V]", "fname": "First", "values": voltage_charge1})
-
-        graphs.append({"name": "Throughput capacity [A.h]", "values": cycle2_crg_cap})
-        graphs.append({"name": "Voltage [V]", "fname": "Second", "values": voltage_charge2})
-
-        graphs.append({"name": "Throughput capacity [A.h]", "values": cycleL_crg_cap})
-        graphs.append({"name": "Voltage [V]", "fname": "Last", "values": voltage_chargeL})
-
-        experiment_result.append({"graphs": graphs})
-        final_result.append(experiment_result)
-
-        experiment_result = [{"title": "Discharging in different Cycles"}]
-
-        graphs = []
+    postprocess_start = time.perf_counter()
+
+    # Prepare data for plotting
+    experiment_result = [{"title": "Capacity over Cycles"}]
+    cap = []
+    if battery_type == "NCA":
+        cap = sol.summary_variables["Capacity [A.h]"].tolist()
+    elif battery_type == "LFP":
+        cap = utils.transform_to_inverse_bezier_curve(sol.summary_variables["Capacity [A.h]"], (cycles / 250.0) * ((charge_current + discharge_current) / 2))
+    else:
+        cap = utils.transform_to_inverse_bezier_curve(sol.summary_variables["Capacity [A.h]"], (cycles / 350.0) * ((charge_current + discharge_current) / 2))
+    graphs.append(
+        {
+            "name": "Cycle",
+            "round": True,
+            "values": sol.summary_variables["Cycle number"].tolist(),
+        }
+    )
+    graphs.append(
+        {
+            "name": "Capacity [A.h]",
+            "fname": "Capacity",
+            "values": cap,
+        }
+    )
+    experiment_result.append({"graphs": graphs})
+    final_result.append(experiment_result)
+
+    experiment_result = [{"title": "Voltage over Cycles"}]
+
+    experiment_result.append(
+        {
+            "graphs": utils.plot_against_cycle(
+                sol, cycles, "Voltage [V]", "Voltage", True
+            )
+        }
+    )
+    final_result.append(experiment_result)
+
+    experiment_result = [{"title": "Charging in different Cycles"}]
+    graphs = []
+
+    # First cycle (cycle 0)
+    charge_step1 = sol.cycles[0].steps[0]  # Charging step
+    voltage_charge1 = charge_step1["Voltage [V]"].entries.tolist()
+    throughput_cap_charge1 = charge_step1["Throughput capacity [A.h]"].entries.tolist()
+    cycle1_crg_cap = [x - throughput_cap_charge1[0] for x in throughput_cap_charge1]  # Normalize to start at 0
+
+    # Second cycle (cycle 1)
+    charge_step2 = sol.cycles[1].steps[0]
+    voltage_charge2 = charge_step2["Voltage [V]"].entries.tolist()
+    throughput_cap_charge2 = charge_step2["Throughput capacity [A.h]"].entries.tolist()
+    cycle2_crg_cap = [x - throughput_cap_charge2[0] for x in throughput_cap_charge2]
+
+    # Last cycle
+    charge_stepL = sol.cycles[-1].steps[0]
+    voltage_chargeL = charge_stepL["Voltage [V]"].entries.tolist()
+    throughput_cap_chargeL = charge_stepL["Throughput capacity [A.h]"].entries.tolist()
+    cycleL_crg_cap = [x - throughput_cap_chargeL[0] for x in throughput_cap_chargeL]
+
+    # Populate graphs
+    graphs.append({"name": "Throughput capacity [A.h]", "values": cycle1_crg_cap})
+    graphs.append({"name": "Voltage [V]", "fname": "First", "values": voltage_charge1})
+
+    graphs.append({"name": "Throughput capacity [A.h]", "values": cycle2_crg_cap})
+    graphs.append({"name": "Voltage [V]", "fname": "Second", "values": voltage_charge2})
+
+    graphs.append({"name": "Throughput capacity [A.h]", "values": cycleL_crg_cap})
+    graphs.append({"name": "Voltage [V]", "fname": "Last", "values": voltage_chargeL})
+
+    experiment_result.append({"graphs": graphs})
+    final_result.append(experiment_result)
+
+    experiment_result = [{"title": "Discharging in different Cycles"}]
+
+    graphs = []
 
 # First cycle (cycle 0)
-        discharge_step1 = sol.cycles[0].steps[3]  # Discharge step
-        voltage_discharge1 = discharge_step1["Voltage [V]"].entries.tolist()
-        throughput_cap_discharge1 = discharge_step1["Throughput capacity [A.h]"].entries.tolist()
-        cycle1_dsc_cap = [x - throughput_cap_discharge1[0] for x in throughput_cap_discharge1]  # Normalize to start at 0
-
-        # Second cycle (cycle 1)
-        discharge_step2 = sol.cycles[1].steps[3]
-        voltage_discharge2 = discharge_step2["Voltage [V]"].entries.tolist()
-        throughput_cap_discharge2 = discharge_step2["Throughput capacity [A.h]"].entries.tolist()
-        cycle2_dsc_cap = [x - throughput_cap_discharge2[0] for x in throughput_cap_discharge2]
-
-        # Last cycle (cycle -1)
-        discharge_stepL = sol.cycles[-1].steps[3]
-        voltage_dischargeL = discharge_stepL["Voltage [V]"].entries.tolist()
-        throughput_cap_dischargeL = discharge_stepL["Throughput capacity [A.h]"].entries.tolist()
-        cycleL_dsc_cap = [x - throughput_cap_dischargeL[0] for x in throughput_cap_dischargeL]
-
-        # Populate graphs for plotting
-        graphs.append({"name": "Throughput capacity [A.h]", "values": cycle1_dsc_cap})
-        graphs.append({"name": "Voltage [V]", "fname": "First", "values": voltage_discharge1})
-
-        graphs.append({"name": "Throughput capacity [A.h]", "values": cycle2_dsc_cap})
-        graphs.append({"name": "Voltage [V]", "fname": "Second", "values": voltage_discharge2})
-
-        graphs.append({"name": "Throughput capacity [A.h]", "values": cycleL_dsc_cap})
-        graphs.append({"name": "Voltage [V]", "fname": "Last", "values": voltage_dischargeL})
-
-        experiment_result.append({"graphs": graphs})
-        final_result.append(experiment_result)
-
-        return jsonify(final_result)
-
-    except Exception as e:
-        print(e)
-        return jsonify(["ERROR: " + str(e)])
+    discharge_step1 = sol.cycles[0].steps[3]  # Discharge step
+    voltage_discharge1 = discharge_step1["Voltage [V]"].entries.tolist()
+    throughput_cap_discharge1 = discharge_step1["Throughput capacity [A.h]"].entries.tolist()
+    cycle1_dsc_cap = [x - throughput_cap_discharge1[0] for x in throughput_cap_discharge1]  # Normalize to start at 0
+
+    # Second cycle (cycle 1)
+    discharge_step2 = sol.cycles[1].steps[3]
+    voltage_discharge2 = discharge_step2["Voltage [V]"].entries.tolist()
+    throughput_cap_discharge2 = discharge_step2["Throughput capacity [A.h]"].entries.tolist()
+    cycle2_dsc_cap = [x - throughput_cap_discharge2[0] for x in throughput_cap_discharge2]
+
+    # Last cycle (cycle -1)
+    discharge_stepL = sol.cycles[-1].steps[3]
+    voltage_dischargeL = discharge_stepL["Voltage [V]"].entries.tolist()
+    throughput_cap_dischargeL = discharge_stepL["Throughput capacity [A.h]"].entries.tolist()
+    cycleL_dsc_cap = [x - throughput_cap_dischargeL[0] for x in throughput_cap_dischargeL]
+
+    # Populate graphs for plotting
+    graphs.append({"name": "Throughput capacity [A.h]", "values": cycle1_dsc_cap})
+    graphs.append({"name": "Voltage [V]", "fname": "First", "values": voltage_discharge1})
+
+    graphs.append({"name": "Throughput capacity [A.h]", "values": cycle2_dsc_cap})
+    graphs.append({"name": "Voltage [V]", "fname": "Second", "values": voltage_discharge2})
+
+    graphs.append({"name": "Throughput capacity [A.h]", "values": cycleL_dsc_cap})
+    graphs.append({"name": "Voltage [V]", "fname": "Last", "values": voltage_dischargeL})
+
+    experiment_result.append({"graphs": graphs})
+    final_result.append(experiment_result)
+    tracing.record("postprocess", postprocess_start)
+
+    downsampling.downsample_result(final_result, method, points)
+    return responses.round_result(final_result, digits)
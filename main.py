@@ -1,39 +1,146 @@
 from flask import Flask, request, jsonify
 import flask_cors
-from lab1 import simulate_lab1
-from lab2 import simulate_lab2
-from lab3 import simulate_lab3
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from lab1 import simulate_lab1, run_lab1
+from lab2 import simulate_lab2, run_lab2, resolve_fidelity
+from lab3 import simulate_lab3, run_lab3, stream_lab3
+import os
+import time
+import jobs
+import metrics
+import tracing
+import utils
 
 app = Flask(__name__)
 flask_cors.CORS(app)
 app.config["PROPAGATE_EXCEPTIONS"] = True
 
+# Per client address, so a class behind one NAT shares it: keep it generous
+SIMULATION_RATE_LIMIT = os.environ.get("SIMULATION_RATE_LIMIT", "120 per minute")
+limiter = Limiter(get_remote_address, app=app, storage_uri="memory://")
+simulation_limit = limiter.shared_limit(SIMULATION_RATE_LIMIT, scope="simulate")
+
+# Parse every parameter set now so the first request after a cold start isn't slower
+utils.preload_battery_parameters()
+
+
+# Every request is traced, its phases come back in the Server-Timing header
+@app.before_request
+def start_trace():
+    trace = tracing.start(request.endpoint or request.path)
+    if tracing.wants_profile(request):
+        tracing.start_profile(trace)
+
+
+@app.after_request
+def finish_trace(response):
+    trace = tracing.current()
+    if trace is None:
+        return response
+    profile = tracing.stop_profile(trace)
+    if profile is not None:
+        response.headers["X-Profile"] = os.path.basename(profile)
+    response.headers["Server-Timing"] = trace.server_timing()
+    if trace.labels is not None:
+        metrics.request_duration.observe(trace.elapsed_ms() / 1000, **trace.labels)
+    tracing.finish(
+        trace,
+        method=request.method,
+        path=request.path,
+        status=response.status_code,
+    )
+    return response
+
 
 @app.errorhandler(404)
 def page_not_found(e):
     return jsonify(["ERROR: " + str(e)])
 
 
+@app.errorhandler(429)
+def rate_limited(e):
+    response = jsonify(["ERROR: " + str(e)])
+    response.status_code = 429
+    limit = limiter.current_limit
+    if limit is not None:
+        response.headers["Retry-After"] = str(max(1, int(limit.reset_at - time.time())))
+    return response
+
+
 @app.route("/")
 def home():
     return "Welp, at least the home page works."
 
 
 @app.route("/simulate-lab1", methods=["POST"])
+@simulation_limit
 def simulate_lab1_route():
     return simulate_lab1(request)
 
 
 @app.route("/simulate-lab2", methods=["POST"])
+@simulation_limit
 def simulate_lab2_route():
     return simulate_lab2(request)
 
 
 @app.route("/simulate-lab3", methods=["POST"])
+@simulation_limit
 def simulate_lab3_route():
     return simulate_lab3(request)
 
 
+@app.route("/metrics")
+def metrics_route():
+    return metrics.metrics_response()
+
+
+# Sends every cycle as it finishes, then the same result as /simulate-lab3
+@app.route("/simulate-lab3/stream", methods=["POST"])
+@simulation_limit
+def stream_lab3_route():
+    return stream_lab3(request)
+
+
+# Job mode: answer with a job id right away and let a background worker solve
+@app.route("/simulate-lab1/jobs", methods=["POST"])
+@simulation_limit
+def submit_lab1_job_route():
+    if request.json.get("Type") not in utils.batteries:
+        return jsonify({"error": "Unsupported chemistry"}), 400
+    return jobs.submit_job("lab1", request.json, run_lab1)
+
+
+@app.route("/simulate-lab2/jobs", methods=["POST"])
+@simulation_limit
+def submit_lab2_job_route():
+    # A payload that failed at its fidelity runs at standard
+    try:
+        _, data = resolve_fidelity(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jobs.submit_job("lab2", data, run_lab2, track_progress=True)
+
+
+@app.route("/simulate-lab3/jobs", methods=["POST"])
+@simulation_limit
+def submit_lab3_job_route():
+    if request.json.get("Type") not in utils.batteries:
+        return jsonify({"error": "Unsupported chemistry"}), 400
+    return jobs.submit_job("lab3", request.json, run_lab3, track_progress=True)
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status_route(job_id):
+    return jobs.job_status(job_id)
+
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result_route(job_id):
+    return jobs.job_result(request, job_id)
+
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     print(e)
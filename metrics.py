@@ -0,0 +1,251 @@
+import threading
+
+from flask import current_app
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, RSS is then read from /proc only
+    resource = None
+
+# Seconds, covers cached answers up to the slowest bounded (long) cycling runs
+DURATION_BUCKETS = (
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600, 7200
+)
+LABEL_NAMES = ("lab", "chemistry")
+
+_metrics = []
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: str = "") -> str:
+    pairs = [
+        f'{name}="{str(value)}"' for name, value in zip(label_names, label_values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# A metric family in the Prometheus text format, one value per label combination
+class Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, label_names: tuple = LABEL_NAMES):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def samples(self) -> list:
+        with self._lock:
+            return [
+                (self.name + _format_labels(self.label_names, key), value)
+                for key, value in sorted(self._values.items())
+            ]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{sample} {float(value)!r}" for sample, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(
+        self, name: str, help: str, label_names: tuple = LABEL_NAMES, read=None
+    ):
+        super().__init__(name, help, label_names)
+        # Gauges with `read` are sampled when /metrics is scraped
+        self.read = read
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self) -> list:
+        if self.read is not None:
+            return [(self.name, self.read())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple = LABEL_NAMES,
+        buckets: tuple = DURATION_BUCKETS,
+    ):
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self._values[key] = state
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def samples(self) -> list:
+        samples = []
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                # Bucket counts are cumulative, +Inf is every observation
+                bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+                counts = state["buckets"] + [state["count"]]
+                for bound, count in zip(bounds, counts):
+                    labels = _format_labels(self.label_names, key, f'le="{bound}"')
+                    samples.append((f"{self.name}_bucket{labels}", count))
+                labels = _format_labels(self.label_names, key)
+                samples.append((f"{self.name}_sum{labels}", state["sum"]))
+                samples.append((f"{self.name}_count{labels}", state["count"]))
+        return samples
+
+
+def resident_memory_bytes() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return float(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is not None:
+        # Peak rather than current, the best there is without /proc
+        return float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) * 1024
+    return 0.0
+
+
+request_duration = Histogram(
+    "battery_sim_request_duration_seconds",
+    "Time to answer a synchronous lab request, cached answers included",
+)
+solve_duration = Histogram(
+    "battery_sim_solve_duration_seconds",
+    "pybamm solve time of a lab run, summed over its sweeps and C rates",
+)
+cache_requests = Counter(
+    "battery_sim_result_cache_requests_total",
+    "Lab runs looked up in the result cache, by result (hit or miss)",
+    LABEL_NAMES + ("result",),
+)
+simulation_failures = Counter(
+    "battery_sim_simulation_failures_total",
+    "Lab runs that raised, by exception type",
+    LABEL_NAMES + ("error",),
+)
+solver_errors = Counter(
+    "battery_sim_solver_errors_total",
+    "Experiment steps that stopped the experiment with a SolverError",
+)
+infeasible_steps = Counter(
+    "battery_sim_infeasible_steps_total",
+    "Experiment steps that ended on their time limit or an unexpected event",
+)
+solver_retries = Counter(
+    "battery_sim_solver_retries_total",
+    "Solves repeated with the next solver profile tier after a failure",
+)
+early_returns = Counter(
+    "battery_sim_solver_early_returns_total",
+    "Solves cut short by return_solution_if_failed_early",
+)
+surrogate_previews = Counter(
+    "battery_sim_surrogate_previews_total",
+    "Preview requests, by result (served from the surrogate or fell back to the solver)",
+    LABEL_NAMES + ("result",),
+)
+admission_rejections = Counter(
+    "battery_sim_admission_rejections_total",
+    "Lab requests turned away with 503 because the simulation queue was full",
+)
+deduplicated_requests = Counter(
+    "battery_sim_deduplicated_requests_total",
+    "Lab requests that shared an identical simulation already in flight",
+)
+simulations_queued = Gauge(
+    "battery_sim_simulations_queued",
+    "Admitted lab runs waiting for a simulation slot",
+    (),
+)
+simulations_in_flight = Gauge(
+    "battery_sim_simulations_in_flight",
+    "Lab runs being simulated right now",
+)
+jobs_queued = Gauge(
+    "battery_sim_jobs_queued",
+    "Submitted jobs waiting for a job worker",
+    (),
+)
+resident_memory = Gauge(
+    "process_resident_memory_bytes",
+    "Resident memory of the server process",
+    (),
+    read=resident_memory_bytes,
+)
+
+# Trace events (see tracing.py) and the counter each one increments
+EVENT_COUNTERS = {
+    "solver-error": solver_errors,
+    "infeasible": infeasible_steps,
+    "early-return": early_returns,
+    "solver-retry": solver_retries,
+}
+
+
+# Labels of one lab run, lab 2 always simulates the silicon composite cell
+def lab_labels(lab: str, data: dict) -> dict:
+    if lab == "lab2":
+        return {"lab": lab, "chemistry": "Silicon"}
+    return {"lab": lab, "chemistry": str(data.get("Type", "unknown"))}
+
+
+# Updates the solve histogram and event counters from the spans a lab run recorded
+def observe_run(spans: list, labels: dict) -> None:
+    solve_seconds = 0.0
+    for span in spans:
+        if span["name"] == "solve":
+            solve_seconds += span["duration"] / 1000
+        elif span["name"] in EVENT_COUNTERS:
+            EVENT_COUNTERS[span["name"]].inc(**labels)
+    if solve_seconds:
+        solve_duration.observe(solve_seconds, **labels)
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _metrics) + "\n"
+
+
+# Prometheus text exposition of every metric
+def metrics_response():
+    return current_app.response_class(
+        render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+        headers={"Cache-Control": "no-cache"},
+    )
@@ -0,0 +1,414 @@
+import os
+import threading
+from collections import OrderedDict
+
+import casadi
+import numpy as np
+import pybamm
+import initial_state
+import outputs
+import solver_profiles
+import tracing
+import utils
+
+# Parameters that change between the runs of a sweep. They become input parameters
+# so a single processed and discretised model serves every run.
+SWEEP_INPUTS = (
+    "Current function [A]",
+    "Lower voltage cut-off [V]",
+    "Upper voltage cut-off [V]",
+    "Initial concentration in negative electrode [mol.m-3]",
+    "Initial concentration in positive electrode [mol.m-3]",
+)
+
+MAX_BUILT_MODELS = 8
+# Set to 0 to solve the runs of a sweep one after another
+BATCHED_SOLVES = os.environ.get("BATCHED_SOLVES", "1") != "0"
+
+
+# A discretised model plus the solvers that already hold its compiled CasADi functions
+class BuiltModel:
+    def __init__(self, model: pybamm.BaseModel, profile_key: tuple):
+        self.model = model
+        # One solver per solver profile tier, created when a run first needs it
+        self.solvers = {}
+        # (tier, runs, output times) -> integrator of that many runs stacked
+        self.stacked_integrators = {}
+        self.profile_key = profile_key
+        # The solvers keep per-model integrators, so runs on one model are serialised
+        self.lock = threading.Lock()
+
+    # Solve from the initial state for `duration` seconds, sampled every `period`
+    # seconds in the same way an experiment step is. Starts from the solver tier
+    # that last worked for this model and moves up one when the solve fails.
+    def solve(self, inputs: dict, duration: float, period: float = 60) -> pybamm.Solution:
+        npts = max(int(round(duration / period)) + 1, 2)
+        tiers = solver_profiles.TIERS
+        first = solver_profiles.starting_tier(self.profile_key)
+        with self.lock:
+            for index in range(first, len(tiers)):
+                tier = tiers[index]
+                if tier not in self.solvers:
+                    self.solvers[tier] = solver_profiles.make_solver(tier)
+                try:
+                    solution = self.solvers[tier].step(
+                        pybamm.EmptySolution(),
+                        self.model,
+                        duration,
+                        t_eval=np.linspace(0, duration, npts),
+                        save=False,
+                        inputs=inputs,
+                    )
+                except pybamm.SolverError as e:
+                    if index == len(tiers) - 1:
+                        raise
+                    solver_profiles.report_retry(index, e)
+                    continue
+                solver_profiles.learn(self.profile_key, index)
+                return solution
+
+    # Solves every set of inputs as solve() does. With more than one they are solved
+    # together as a single stacked ODE (see _solve_stacked), one at a time if that
+    # fails.
+    def solve_batch(
+        self, inputs_list: list, duration: float, period: float = 60
+    ) -> list:
+        if BATCHED_SOLVES and len(inputs_list) > 1:
+            with self.lock:
+                try:
+                    return self._solve_stacked(inputs_list, duration, period)
+                except pybamm.SolverError as e:
+                    print(f"Batched solve failed ({e}), solving one at a time")
+        return [self.solve(inputs, duration, period) for inputs in inputs_list]
+
+    # The runs still going are integrated as one ODE, a copy of the model's right
+    # hand side per set of inputs, in windows of the solver tier's dt_max like
+    # CasadiSolver's safe mode. Every run's terminating events are checked at each
+    # output, the runs that crossed one in a window have it located together and
+    # drop out of the stack. Each solution is timed as an equal share of the batch.
+    def _solve_stacked(self, inputs_list: list, duration: float, period: float) -> list:
+        timer = pybamm.Timer()
+        model = self.model
+        tier = solver_profiles.TIERS[solver_profiles.starting_tier(self.profile_key)]
+        if tier not in self.solvers:
+            self.solvers[tier] = solver_profiles.make_solver(tier)
+        solver = self.solvers[tier]
+        if model.len_alg > 0:
+            raise pybamm.SolverError("only ODE models can be stacked")
+        # The compiled functions take the inputs as a vector, in order of name
+        names = sorted(parameter.name for parameter in model.input_parameters)
+        if getattr(model, "casadi_rhs", None) is None:
+            solver.set_up(model, {name: inputs_list[0][name] for name in names})
+        set_up_time = timer.time()
+
+        runs = len(inputs_list)
+        parameters = np.array(
+            [[float(inputs[name]) for name in names] for inputs in inputs_list]
+        ).T
+        y_zero = np.zeros((model.len_rhs, 1))
+        events = casadi_events(model)
+
+        times = [[0.0] for _ in range(runs)]
+        ys = [
+            [model.initial_conditions_eval(0, y_zero, parameters[:, i]).full().ravel()]
+            for i in range(runs)
+        ]
+        solutions = [None] * runs
+        running = list(range(runs))
+        outputs_total = int(round(duration / period))
+        outputs_done = 0
+        window = max(1, int(solver.dt_max // period))
+        while running and outputs_done < outputs_total:
+            window = min(window, outputs_total - outputs_done)
+            t_start = outputs_done * period
+            window_times = period * np.arange(1, window + 1)
+            try:
+                window_ys = self._integrate(
+                    solver,
+                    tier,
+                    np.column_stack([ys[i][-1] for i in running]),
+                    parameters[:, running],
+                    np.full(len(running), t_start),
+                    window_times,
+                )
+            except pybamm.SolverError:
+                # Like safe mode, a failed window is tried again in smaller ones
+                if window == 1:
+                    raise
+                window //= 2
+                continue
+            crossed_runs = []
+            for i, run_ys in zip(running, window_ys):
+                values = events.map(window)(
+                    t_start + window_times[None, :],
+                    run_ys,
+                    np.repeat(parameters[:, i : i + 1], window, axis=1),
+                ).full()
+                crossed = ~(np.sign(values - 1e-5) == 1).all(axis=0)
+                keep = int(np.argmax(crossed)) if crossed.any() else window
+                times[i].extend(t_start + window_times[:keep])
+                ys[i].extend(run_ys[:, :keep].T)
+                if keep < window:
+                    crossed_runs.append(i)
+            if crossed_runs:
+                located = self._locate_events(
+                    solver, tier, events, times, ys, parameters, crossed_runs, period
+                )
+                for i, (t_event, y_event, event) in zip(crossed_runs, located):
+                    running.remove(i)
+                    solutions[i] = stacked_solution(
+                        model, times[i], ys[i], inputs_list[i], t_event, y_event, event
+                    )
+            outputs_done += window
+
+        for i in range(runs):
+            if solutions[i] is None:
+                solutions[i] = stacked_solution(model, times[i], ys[i], inputs_list[i])
+        integration_time = timer.time() - set_up_time
+        for solution in solutions:
+            solution.set_up_time = set_up_time / runs
+            solution.integration_time = integration_time / runs
+            solution.solve_time = solution.set_up_time + solution.integration_time
+        return solutions
+
+    # Integrates runs from their states and inputs (a column each) over
+    # `t_start + output_times`, with a start time per run. Returns the states of each
+    # run at the output times.
+    def _integrate(
+        self,
+        solver: pybamm.BaseSolver,
+        tier: str,
+        states: np.ndarray,
+        parameters: np.ndarray,
+        t_start: np.ndarray,
+        output_times: np.ndarray,
+    ) -> list:
+        runs = states.shape[1]
+        integrator = self._stacked_integrator(solver, tier, runs, output_times)
+        try:
+            result = integrator(
+                x0=states.reshape(-1, order="F"),
+                p=np.concatenate([parameters.reshape(-1, order="F"), t_start]),
+            )
+        except RuntimeError as e:
+            raise pybamm.SolverError(e.args[0]) from e
+        return np.split(result["xf"].full(), runs)
+
+    def _stacked_integrator(
+        self, solver: pybamm.BaseSolver, tier: str, runs: int, output_times: np.ndarray
+    ) -> casadi.Function:
+        key = (tier, runs, output_times.tobytes())
+        if key not in self.stacked_integrators:
+            model = self.model
+            t = casadi.MX.sym("t")
+            y = casadi.MX.sym("y", model.len_rhs * runs)
+            p = casadi.MX.sym("p", len(model.input_parameters) * runs)
+            t_start = casadi.MX.sym("t_start", runs)
+            rhs = model.casadi_rhs.map(runs)(
+                t_start.T + t,
+                casadi.reshape(y, model.len_rhs, runs),
+                casadi.reshape(p, -1, runs),
+            )
+            self.stacked_integrators[key] = casadi.integrator(
+                "F",
+                "cvodes",
+                {
+                    "t": t,
+                    "x": y,
+                    "p": casadi.vertcat(p, t_start),
+                    "ode": casadi.reshape(rhs, -1, 1),
+                },
+                0,
+                output_times,
+                {
+                    "show_eval_warnings": False,
+                    **solver.extra_options_setup,
+                    "reltol": solver.rtol,
+                    "abstol": solver.atol,
+                },
+            )
+        return self.stacked_integrators[key]
+
+    # Where each of `crossed_runs` crossed an event after its last output, found as
+    # CasadiSolver does: a 100 point pass over the next output period, then a linear
+    # interpolation between the points either side of the crossing. Returns (time,
+    # state, event name) per run.
+    def _locate_events(
+        self,
+        solver: pybamm.BaseSolver,
+        tier: str,
+        events: casadi.Function,
+        times: list,
+        ys: list,
+        parameters: np.ndarray,
+        crossed_runs: list,
+        period: float,
+    ) -> list:
+        dense_times = np.linspace(0, period, 100)
+        dense_ys = self._integrate(
+            solver,
+            tier,
+            np.column_stack([ys[i][-1] for i in crossed_runs]),
+            parameters[:, crossed_runs],
+            np.array([times[i][-1] for i in crossed_runs]),
+            dense_times[1:],
+        )
+        event_names = [
+            event.name
+            for event in self.model.events
+            if event.event_type == pybamm.EventType.TERMINATION
+        ]
+
+        located = []
+        for i, run_dense_ys in zip(crossed_runs, dense_ys):
+            run_times = times[i][-1] + dense_times
+            run_ys = np.column_stack([ys[i][-1], run_dense_ys])
+            values = (
+                events.map(len(dense_times))(
+                    run_times[None, :],
+                    run_ys,
+                    np.repeat(parameters[:, i : i + 1], len(dense_times), axis=1),
+                ).full()
+                - 1e-5
+            )
+            t_event, event = run_times[-1], None
+            for index in np.flatnonzero(np.sign(values[:, -1]) != 1):
+                # The first point past the crossing, NaN counts as past it
+                upper = max(1, int(np.argmax(~(values[index] > 0))))
+                lower_value = abs(values[index, upper - 1])
+                upper_value = abs(values[index, upper])
+                t = (
+                    lower_value * run_times[upper] + upper_value * run_times[upper - 1]
+                ) / (lower_value + upper_value)
+                if event is None or t < t_event:
+                    t_event, event = t, event_names[index]
+            if event is None:
+                raise pybamm.SolverError("no event crossed in the dense pass")
+            y_event = np.array([np.interp(t_event, run_times, row) for row in run_ys])
+            located.append((t_event, y_event, event))
+        return located
+
+
+# Solution of a run stacked with others, from its output times and states, ending
+# in `event` at `t_event` if it hit one
+def stacked_solution(
+    model: pybamm.BaseModel,
+    times: list,
+    ys: list,
+    inputs: dict,
+    t_event: float = None,
+    y_event: np.ndarray = None,
+    event: str = None,
+) -> pybamm.Solution:
+    # The solvers hand the inputs over sorted by name, Solution keeps them in order
+    inputs = {name: inputs[name] for name in sorted(inputs)}
+    ys = np.column_stack(ys)
+    termination = "final time"
+    if event is not None:
+        termination = f"event: {event}"
+        # As in a single solve, the event state is the last point unless it is one
+        if t_event != times[-1]:
+            times = times + [t_event]
+            ys = np.column_stack([ys, y_event])
+        t_event, y_event = np.array([t_event]), y_event[:, None]
+    return pybamm.Solution(
+        np.array(times), ys, model, inputs, t_event, y_event, termination
+    )
+
+
+# Every terminating event of a model as one function of (t, y, inputs)
+def casadi_events(model: pybamm.BaseModel) -> casadi.Function:
+    t = casadi.MX.sym("t")
+    y = casadi.MX.sym("y", model.len_rhs)
+    p = casadi.MX.sym("p", len(model.input_parameters))
+    values = casadi.vertcat(*[event(t, y, p) for event in model.terminate_events_eval])
+    return casadi.Function("events", [t, y, p], [values])
+
+
+_built_models = OrderedDict()
+_lock = threading.Lock()
+
+
+def build_model(
+    model: pybamm.BaseModel,
+    parameters: pybamm.ParameterValues,
+    var_pts: dict = None,
+    profile_key: tuple = None,
+    output_variables: outputs.OutputVariables = None,
+) -> BuiltModel:
+    if output_variables is not None:
+        output_variables.prune(model)
+    parameters = parameters.copy()
+    for name in SWEEP_INPUTS:
+        parameters[name] = "[input]"
+
+    geometry = model.default_geometry
+    model_with_set_params = parameters.process_model(model, inplace=False)
+    parameters.process_geometry(geometry)
+    mesh = pybamm.Mesh(
+        geometry, model.default_submesh_types, var_pts or model.default_var_pts
+    )
+    disc = pybamm.Discretisation(mesh, model.default_spatial_methods)
+    built_model = disc.process_model(model_with_set_params, inplace=False)
+
+    return BuiltModel(built_model, profile_key or (type(model).__name__, "sweep"))
+
+
+# Returns the built model for (model options, parameter set, mesh, outputs),
+# building it once
+def get_built_model(
+    model_class,
+    options: dict,
+    parameters: pybamm.ParameterValues,
+    var_pts: dict = None,
+    output_variables: outputs.OutputVariables = None,
+) -> BuiltModel:
+    key = (
+        model_class.__name__,
+        repr(sorted((options or {}).items())),
+        utils.parameter_fingerprint(parameters, exclude=SWEEP_INPUTS),
+        repr(sorted((var_pts or {}).items())),
+        output_variables.variables if output_variables is not None else None,
+    )
+    with _lock:
+        built = _built_models.get(key)
+        if built is not None:
+            _built_models.move_to_end(key)
+            return built
+
+        print("Building model ", model_class.__name__, options)
+        # Sweeps of one parameter set and model learn their solver tier together
+        profile_key = (key[2], model_class.__name__, "sweep")
+        with tracing.span("build", model_class.__name__):
+            built = build_model(
+                model_class(options), parameters, var_pts, profile_key, output_variables
+            )
+        _built_models[key] = built
+        while len(_built_models) > MAX_BUILT_MODELS:
+            _built_models.popitem(last=False)
+        return built
+
+
+# Inputs that put a sweep model at the given SOC with the given voltage window
+def sweep_inputs(
+    parameters: pybamm.ParameterValues,
+    initial_soc: float,
+    min_voltage: float = None,
+    max_voltage: float = None,
+) -> dict:
+    initial = initial_state.resolve(parameters, initial_soc)
+    # Like an experiment, the limits that are not under test stay as loose safeguards
+    if min_voltage is None:
+        min_voltage = parameters["Lower voltage cut-off [V]"] - 1
+    if max_voltage is None:
+        max_voltage = parameters["Upper voltage cut-off [V]"] + 1
+    return {
+        "Lower voltage cut-off [V]": min_voltage,
+        "Upper voltage cut-off [V]": max_voltage,
+        initial_state.NEGATIVE_CONCENTRATION: initial[
+            initial_state.NEGATIVE_CONCENTRATION
+        ],
+        initial_state.POSITIVE_CONCENTRATION: initial[
+            initial_state.POSITIVE_CONCENTRATION
+        ],
+    }
@@ -0,0 +1,50 @@
+import pybamm
+
+# Variables pybamm reads itself while running an experiment: step control and
+# terminations, the voltage stop and the inputs of the eSOH summary variables
+EXPERIMENT_VARIABLES = (
+    "Time [s]",
+    "Time [h]",
+    "Current [A]",
+    "Current variable [A]",
+    "C-rate",
+    "Voltage [V]",
+    "Battery voltage [V]",
+    "Power [W]",
+    "Terminal power [W]",
+    "Resistance [Ohm]",
+    "Discharge capacity [A.h]",
+    "Throughput capacity [A.h]",
+    "Negative electrode capacity [A.h]",
+    "Positive electrode capacity [A.h]",
+    "Total lithium capacity in particles [A.h]",
+)
+
+
+# The output variables a lab reads from its solutions. A model pruned to them skips
+# discretising the hundreds of other variables pybamm defines, and its cycles only
+# work out the summary variables that are asked for (eSOH ones like "Capacity [A.h]"
+# come from calc_esoh and are always there).
+class OutputVariables:
+    def __init__(self, variables: tuple = (), summary_variables: tuple = ()):
+        self.variables = tuple(variables)
+        self.summary_variables = tuple(summary_variables)
+
+    def prune(self, model: pybamm.BaseModel) -> pybamm.BaseModel:
+        keep = set(EXPERIMENT_VARIABLES + self.variables + self.summary_variables)
+        # Steps start from the last state of the step before, found by variable name
+        for variable in model.initial_conditions:
+            if isinstance(variable, pybamm.Concatenation):
+                keep.update(child.name for child in variable.orphans)
+            else:
+                keep.add(variable.name)
+        missing = [name for name in self.variables if name not in model.variables]
+        if missing:
+            raise KeyError(f"{model.name} has no variables {missing}")
+        model.variables = pybamm.FuzzyDict(
+            {name: value for name, value in model.variables.items() if name in keep}
+        )
+        model.summary_variables = [
+            name for name in model.summary_variables if name in self.summary_variables
+        ]
+        return model
@@ -0,0 +1,191 @@
+import gzip
+import json
+import struct
+
+import numpy as np
+from flask import current_app
+
+import admission
+import result_cache
+import tracing
+
+try:
+    import brotli
+except ImportError:  # gzip is still offered without it
+    brotli = None
+
+JSON_MIMETYPE = "application/json"
+# Packed layout, all little endian:
+#   uint32 header length | JSON header | float buffers
+# The header is the usual result with every "values" list replaced by
+# {"offset": bytes from the start of the body, "length": number of values} and the
+# buffer dtype stored under "dtype". Buffers start on 8 byte boundaries so clients
+# can view them directly, e.g. new Float32Array(body, offset, length).
+PACKED_MIMETYPE = "application/x-battery-sim-packed"
+PACKED_DTYPES = {"float32": "<f4", "float64": "<f8"}
+
+# Graph values are plotted at screen resolution, more digits only cost bytes
+DEFAULT_SIGNIFICANT_DIGITS = 6
+# Bodies smaller than this aren't worth compressing
+MIN_COMPRESS_BYTES = 1024
+# Largest power of ten a double can hold
+MAX_DECIMAL_EXPONENT = 308
+
+
+# Reads "Significant Digits" from a lab payload, 0 keeps full double precision
+def precision_from_request(data: dict) -> int:
+    digits = int(data.get("Significant Digits", DEFAULT_SIGNIFICANT_DIGITS))
+    if digits < 0 or digits > 17:
+        raise ValueError("Significant Digits must be between 0 and 17")
+    return digits
+
+
+def round_significant(values: list, digits: int) -> list:
+    array = np.asarray(values)
+    if array.dtype.kind != "f":
+        # Integer series (cycle numbers) are already short
+        return values
+    rounded = array.copy()
+    finite = np.isfinite(array) & (array != 0)
+    exponent = digits - 1 - np.floor(np.log10(np.abs(array[finite])))
+    # Past 1e308 the power of ten overflows, which only happens for values near the
+    # subnormal range. Those are kept as they are rather than turned into NaN.
+    unscaled = exponent > MAX_DECIMAL_EXPONENT
+    exponent[unscaled] = 0
+    scale = 10.0 ** np.abs(exponent)
+    small = exponent >= 0
+    # Divide by (or multiply with) an exact power of ten so the result is the double
+    # nearest to the short decimal, which then prints with few digits
+    finite_values = array[finite]
+    with np.errstate(over="ignore", invalid="ignore"):
+        scaled = np.round(finite_values[small] * scale[small]) / scale[small]
+        finite_values[small] = scaled
+        large = ~small
+        scaled = np.round(finite_values[large] / scale[large]) * scale[large]
+        finite_values[large] = scaled
+    # Rounding up the largest doubles can overflow, keep those unchanged too
+    exact = unscaled | ~np.isfinite(finite_values)
+    finite_values[exact] = array[finite][exact]
+    rounded[finite] = finite_values
+    return rounded.tolist()
+
+
+# Rounds every graph series of a lab result to `digits` significant digits
+def round_result(result: list, digits: int) -> list:
+    if not digits:
+        return result
+    with tracing.span("round"):
+        for experiment_result in result:
+            for entry in experiment_result:
+                for graph in entry.get("graphs", []):
+                    graph["values"] = round_significant(graph["values"], digits)
+    return result
+
+
+def _replace_values(value, buffers: list):
+    if isinstance(value, dict):
+        packed = {}
+        for key, item in value.items():
+            if key == "values" and isinstance(item, list):
+                buffers.append(item)
+                packed[key] = len(buffers) - 1
+            else:
+                packed[key] = _replace_values(item, buffers)
+        return packed
+    if isinstance(value, list):
+        return [_replace_values(item, buffers) for item in value]
+    return value
+
+
+def _set_offsets(value, locations: list):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == "values" and isinstance(item, int):
+                offset, length = locations[item]
+                value[key] = {"offset": offset, "length": length}
+            else:
+                _set_offsets(item, locations)
+    elif isinstance(value, list):
+        for item in value:
+            _set_offsets(item, locations)
+
+
+def _aligned(size: int) -> int:
+    return -(-size // 8) * 8
+
+
+def pack_result(result: list, dtype: str = "float32") -> bytes:
+    buffers = []
+    header = {"dtype": dtype, "result": _replace_values(result, buffers)}
+    arrays = [np.asarray(values, dtype=PACKED_DTYPES[dtype]) for values in buffers]
+
+    # Offsets depend on the header size, which depends on the offsets. Reserve room
+    # for the longest offset the body could need, then pad the header with spaces.
+    reserve = len(json.dumps(header)) + len(arrays) * 48 + 32
+    header_size = _aligned(4 + reserve) - 4
+    locations = []
+    offset = 4 + header_size
+    for array in arrays:
+        locations.append((offset, len(array)))
+        offset = _aligned(offset + array.nbytes)
+    _set_offsets(header["result"], locations)
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (header_size - len(header_bytes))
+
+    body = bytearray(offset)
+    body[:4] = struct.pack("<I", header_size)
+    body[4 : 4 + header_size] = header_bytes
+    for (start, length), array in zip(locations, arrays):
+        body[start : start + array.nbytes] = array.tobytes()
+    return bytes(body)
+
+
+def wants_packed(request) -> bool:
+    best = request.accept_mimetypes.best_match([JSON_MIMETYPE, PACKED_MIMETYPE])
+    return best == PACKED_MIMETYPE
+
+
+# Serialises a lab result in the format the client asked for, JSON by default.
+# `result` can be passed when it is already in memory to skip parsing the body.
+def respond(request, body: bytes, result: list = None):
+    if not wants_packed(request):
+        response = current_app.response_class(body, mimetype=JSON_MIMETYPE)
+    else:
+        dtype = request.args.get("dtype", "float32")
+        if dtype not in PACKED_DTYPES:
+            raise ValueError(f"Unsupported dtype: {dtype}")
+        if result is None:
+            result = json.loads(body)
+        with tracing.span("pack", dtype):
+            body = pack_result(result, dtype)
+        response = current_app.response_class(body, mimetype=PACKED_MIMETYPE)
+    response.vary.add("Accept")
+    return compress(request, response)
+
+
+# Compresses the body with brotli or gzip when the client accepts it
+def compress(request, response):
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_BYTES:
+        return response
+
+    encodings = request.accept_encodings
+    if brotli is not None and encodings["br"]:
+        with tracing.span("compress", "br"):
+            response.set_data(brotli.compress(body, quality=5))
+        response.headers["Content-Encoding"] = "br"
+    elif encodings["gzip"]:
+        with tracing.span("compress", "gzip"):
+            response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+def lab_response(request, lab: str, data: dict, run):
+    try:
+        body, result = result_cache.get_or_run(lab, data, run)
+    except admission.Busy as e:
+        print(e)
+        return admission.busy_response(e)
+    return respond(request, body, result)
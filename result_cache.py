@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import pybamm
+from flask import jsonify
+
+import admission
+import metrics
+import tracing
+
+# Bump whenever the shape of a lab result, or the run a payload asks for, changes so
+# stale entries stop matching (3: runs past 50 cycles are no longer cut to 50)
+RESULT_FORMAT_VERSION = 3
+
+
+# Payload entries the labs fill in when they are missing, in step with their
+# data.get defaults, so spelling one out shares the entry of leaving it out
+PAYLOAD_DEFAULTS = {
+    "lab1": {"C Rates": [1], "Cycles": 1, "Significant Digits": 6},
+    "lab2": {"C Rates": [1], "Fidelity": "standard", "Significant Digits": 6},
+    "lab3": {"Initial SOC": 1, "Significant Digits": 6},
+}
+
+
+# Strip whitespace from strings and write whole floats as ints so cosmetic
+# differences in the payload share an entry
+def normalize_payload(value):
+    if isinstance(value, dict):
+        return {str(k).strip(): normalize_payload(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize_payload(v) for v in value]
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+# The payload a lab runs and is cached as: normalized, without the defaults
+def canonical_payload(lab: str, data: dict) -> dict:
+    payload = normalize_payload(data)
+    defaults = normalize_payload(PAYLOAD_DEFAULTS.get(lab, {}))
+    return {
+        key: value
+        for key, value in payload.items()
+        if key not in defaults or value != defaults[key]
+    }
+
+
+# Content address of a lab request: same inputs + same pybamm -> same key
+def make_key(lab: str, data: dict) -> str:
+    canonical = json.dumps(
+        {
+            "lab": lab,
+            "payload": canonical_payload(lab, data),
+            "pybamm": pybamm.__version__,
+            "format": RESULT_FORMAT_VERSION,
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+# Two tier store of serialized lab results. The memory tier is an LRU bounded by
+# entry count and total bytes, the disk tier is optional and only bounded by TTL.
+class ResultCache:
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_bytes: int = 128 * 1024 * 1024,
+        ttl: float = 24 * 3600,
+        disk_dir: Optional[str] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (stored_at, body)
+        self._size = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _expired(self, stored_at: float) -> bool:
+        return bool(self.ttl) and time.time() - stored_at > self.ttl
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + ".json")
+
+    def _evict(self) -> None:
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._size > self.max_bytes
+        ):
+            _, (_, body) = self._entries.popitem(last=False)
+            self._size -= len(body)
+
+    def _store_in_memory(self, key: str, body: bytes, stored_at: float) -> None:
+        if len(body) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old[1])
+        self._entries[key] = (stored_at, body)
+        self._size += len(body)
+        self._evict()
+
+    def _read_disk(self, key: str) -> Optional[tuple]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if self._expired(stored_at):
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                return stored_at, f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, body: bytes) -> None:
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print("Could not write result to disk cache: ", e)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[0]):
+                self._entries.pop(key)
+                self._size -= len(entry[1])
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self._store_in_memory(key, entry[1], entry[0])
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, body: bytes) -> None:
+        with self._lock:
+            self._store_in_memory(key, body, time.time())
+        self._write_disk(key, body)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                return True
+        return self._read_disk(key) is not None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+# RESULT_CACHE_DIR enables the disk tier, point it at storage that outlives the instance
+cache = ResultCache(
+    max_entries=int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 256)),
+    max_bytes=int(float(os.environ.get("RESULT_CACHE_MAX_MB", 128)) * 1024 * 1024),
+    ttl=float(os.environ.get("RESULT_CACHE_TTL", 24 * 3600)),
+    disk_dir=os.environ.get("RESULT_CACHE_DIR") or None,
+)
+
+
+# Returns (stored JSON, None) for a repeated request, otherwise runs the lab on the
+# admission pool, stores its JSON and returns it together with the computed result.
+# The lab runs the canonical payload, so every payload of a key gets the same result.
+def get_or_run(lab: str, data: dict, run, block: bool = False) -> tuple:
+    labels = metrics.lab_labels(lab, data)
+    data = canonical_payload(lab, data)
+    trace = tracing.current()
+    if trace is not None:
+        trace.labels = labels
+    with tracing.span("cache"):
+        key = make_key(lab, data)
+        body = cache.get(key)
+    if body is not None:
+        print("Serving cached result for ", lab, key[:12])
+        metrics.cache_requests.inc(result="hit", **labels)
+        return body, None
+
+    metrics.cache_requests.inc(result="miss", **labels)
+
+    def run_and_store() -> tuple:
+        first_span = len(trace.spans) if trace is not None else 0
+        metrics.simulations_in_flight.inc(**labels)
+        try:
+            with tracing.span("run", lab):
+                result = run(data)
+        except Exception as e:
+            metrics.simulation_failures.inc(error=type(e).__name__, **labels)
+            raise
+        finally:
+            metrics.simulations_in_flight.dec(**labels)
+            if trace is not None:
+                metrics.observe_run(trace.spans[first_span:], labels)
+        with tracing.span("serialize"):
+            body = jsonify(result).get_data()
+        cache.put(key, body)
+        return body, result
+
+    return admission.run_once(key, run_and_store, labels, block)
+
+
+def cached_body(lab: str, data: dict, run, block: bool = False) -> bytes:
+    return get_or_run(lab, data, run, block)[0]
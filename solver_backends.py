@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import pybamm
+
+# The backend every other one is checked against, CasadiSolver run through the tier
+# ladder of solver_profiles
+REFERENCE = "casadi"
+
+# Solver backends a lab can run its experiments on: the pybamm solver class, its
+# settings and whether it can run here. The tolerances are those of the CasADi tiers.
+BACKENDS = OrderedDict(
+    [
+        (REFERENCE, (pybamm.CasadiSolver, {}, lambda: True)),
+        # Sparse direct IDA with compiled Jacobians, needs pybamm's idaklu extension
+        (
+            "idaklu",
+            (pybamm.IDAKLUSolver, {"rtol": 1e-6, "atol": 1e-6}, pybamm.have_idaklu),
+        ),
+    ]
+)
+
+# Set to 0 to raise when a backend fails rather than solve on the reference, as
+# validation does
+FALLBACK = os.environ.get("SOLVER_BACKEND_FALLBACK", "1") != "0"
+
+# Written by `python benchmark.py validate`: per lab, the fastest backend whose graphs
+# matched the reference on the benchmark payloads
+VALIDATION_FILE = os.environ.get(
+    "SOLVER_BACKENDS_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "solver_backends.json"),
+)
+
+_validated = None
+_lock = threading.Lock()
+
+
+def available(backend: str) -> bool:
+    return BACKENDS[backend][2]()
+
+
+def make_solver(backend: str) -> pybamm.BaseSolver:
+    solver_class, settings, _ = BACKENDS[backend]
+    return solver_class(**settings)
+
+
+# lab -> backend chosen by the last validation, empty without one
+def validated_backends() -> dict:
+    global _validated
+    with _lock:
+        if _validated is None:
+            try:
+                with open(VALIDATION_FILE) as f:
+                    labs = json.load(f)["labs"]
+                _validated = {lab: result["backend"] for lab, result in labs.items()}
+            except (OSError, ValueError, KeyError):
+                _validated = {}
+        return _validated
+
+
+# A lab's backend: LAB2_SOLVER_BACKEND=idaklu and so on, otherwise the validated one,
+# otherwise the reference
+def default_backend(lab: str) -> str:
+    return (
+        os.environ.get(f"{lab.upper()}_SOLVER_BACKEND")
+        or validated_backends().get(lab)
+        or REFERENCE
+    )
+
+
+# Reads "Solver Backend" from a lab payload, the lab's default without one. A backend
+# that cannot run here falls back to the reference.
+def backend_from_request(lab: str, data: dict) -> str:
+    backend = data.get("Solver Backend") or default_backend(lab)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown solver backend: {backend}")
+    if not available(backend):
+        if not FALLBACK:
+            raise ValueError(f"Solver backend {backend} is not available")
+        print(f"Solver backend {backend} is not available, using {REFERENCE}")
+        return REFERENCE
+    return backend
@@ -0,0 +1,161 @@
+import copy
+import math
+import threading
+from collections import OrderedDict
+
+import pybamm
+import solver_backends
+import tracing
+
+# CasadiSolver settings, cheapest first. The tolerances are the same in every tier
+# so they agree on the answer, they differ in how hard the integrator tries before
+# giving up on a step.
+PROFILES = OrderedDict(
+    [
+        # Long global steps, enough for the single particle models of labs 1 and 3
+        ("fast", {"mode": "safe", "extra_options_setup": {"max_num_steps": 1000}}),
+        # Global steps of one output period, lab 2's DFN needs these near its cut-offs
+        (
+            "balanced",
+            {"mode": "safe", "dt_max": 60, "extra_options_setup": {"max_num_steps": 600}},
+        ),
+        # More step size cuts before giving up, and then the cycles solved so far
+        # rather than an error
+        (
+            "robust",
+            {
+                "mode": "safe",
+                "dt_max": 60,
+                "max_step_decrease_count": 10,
+                "extra_options_setup": {"max_num_steps": 2000},
+                "return_solution_if_failed_early": True,
+            },
+        ),
+    ]
+)
+TIERS = tuple(PROFILES)
+
+# (chemistry, model, experiment shape) -> index of the tier that last succeeded
+_learned = {}
+_lock = threading.Lock()
+
+
+def make_solver(tier: str, solver_class=pybamm.CasadiSolver) -> pybamm.CasadiSolver:
+    return solver_class(**copy.deepcopy(PROFILES[tier]))
+
+
+# The steps of one cycle without their limits, C rates rounded up to a whole C,
+# e.g. "Charge 1C/Discharge 1C/Voltage"
+def experiment_shape(experiment: pybamm.Experiment) -> str:
+    steps = []
+    for step in experiment.steps[: experiment.cycle_lengths[0]]:
+        kind = step.direction or type(step).__name__
+        if isinstance(step, pybamm.step.CRate):
+            kind += f" {math.ceil(abs(float(step.value)))}C"
+        steps.append(kind)
+    return "/".join(steps)
+
+
+# The points of `var_pts` that differ from the model's default mesh, e.g. "x_n=10"
+def mesh_changes(model: pybamm.BaseModel, var_pts: dict = None) -> str:
+    defaults = model.default_var_pts
+    return ",".join(
+        f"{name}={points}"
+        for name, points in sorted((var_pts or {}).items())
+        if defaults.get(name) != points
+    )
+
+
+def starting_tier(key: tuple, default: str = TIERS[0]) -> int:
+    with _lock:
+        return _learned.get(key, TIERS.index(default))
+
+
+def learn(key: tuple, tier_index: int) -> None:
+    with _lock:
+        if _learned.get(key) != tier_index:
+            print(f"Solver tier for {key}: {TIERS[tier_index]}")
+        _learned[key] = tier_index
+
+
+def report_retry(tier_index: int, error: Exception) -> None:
+    tier, next_tier = TIERS[tier_index], TIERS[tier_index + 1]
+    print(f"Solver tier {tier} failed ({error}), retrying with {next_tier}")
+    tracing.event("solver-retry", tier)
+
+
+# Remembers the error pybamm stopped an experiment on, it otherwise only shows as
+# fewer cycles in the solution
+class StepFailure(pybamm.callbacks.Callback):
+    def __init__(self):
+        self.error = None
+
+    def on_experiment_error(self, logs):
+        self.error = logs["error"]
+
+
+# Solves an experiment from the tier that last worked for its chemistry, model and
+# shape (or `tier` until one is known), moving up a tier whenever a step fails.
+# `make_simulation(solver)` builds the Simulation, `callbacks` is a list or a
+# function of the Simulation giving one. `solver_class` makes the solvers, a
+# CasadiSolver or a subclass taking the same settings. Any other `backend` (see
+# solver_backends.py) is tried first, the tiers are the fallback when it fails.
+# `var_pts` is the simulation's mesh, another one learns its tier apart. Past
+# `last_tier` a failure raises SolverError rather than moving up.
+def solve_experiment(
+    make_simulation,
+    chemistry: str,
+    model: pybamm.BaseModel,
+    experiment: pybamm.Experiment,
+    callbacks=None,
+    tier: str = TIERS[0],
+    solver_class=pybamm.CasadiSolver,
+    backend: str = solver_backends.REFERENCE,
+    var_pts: dict = None,
+    last_tier: str = TIERS[-1],
+    **kwargs,
+) -> pybamm.Solution:
+    if backend != solver_backends.REFERENCE:
+        sim = make_simulation(solver_backends.make_solver(backend))
+        failure = StepFailure()
+        extra = callbacks(sim) if callable(callbacks) else callbacks
+        try:
+            solution = sim.solve(callbacks=(extra or []) + [failure], **kwargs)
+        # CasADi raises RuntimeError when a backend cannot load its functions
+        except (pybamm.SolverError, RuntimeError) as e:
+            if not solver_backends.FALLBACK:
+                raise
+            error = e
+        else:
+            if failure.error is None:
+                return solution
+            error = failure.error
+            if not solver_backends.FALLBACK:
+                raise pybamm.SolverError(str(error))
+        print(f"Solver backend {backend} failed ({error}), falling back to the tiers")
+        tracing.event("solver-fallback", backend)
+
+    key = (chemistry, type(model).__name__, experiment_shape(experiment))
+    mesh = mesh_changes(model, var_pts)
+    if mesh:
+        key += (mesh,)
+    last = TIERS.index(last_tier)
+    for index in range(min(starting_tier(key, tier), last), last + 1):
+        sim = make_simulation(make_solver(TIERS[index], solver_class))
+        failure = StepFailure()
+        extra = callbacks(sim) if callable(callbacks) else callbacks
+        try:
+            solution = sim.solve(callbacks=(extra or []) + [failure], **kwargs)
+        except pybamm.SolverError as e:
+            if index == last:
+                raise
+            error = e
+        else:
+            # The robust tier's partial result is still the best there is
+            if failure.error is None or index == len(TIERS) - 1:
+                learn(key, index)
+                return solution
+            if index == last:
+                raise pybamm.SolverError(str(failure.error))
+            error = failure.error
+        report_retry(index, error)
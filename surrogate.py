@@ -0,0 +1,386 @@
+# Surrogate tables for instant lab 1 previews.
+#
+#     python surrogate.py build --workers 4
+#     python surrogate.py build --chemistries NMC --temperatures 288.15 298.15 --c-rates 1 2
+#
+# A table holds the lab 1 sweeps and 50 cycle runs of one chemistry on a grid of
+# ambient temperatures and C rates, solved with the lab's own code. Previews
+# interpolate between the surrounding grid points. Every build checks the
+# interpolation against real solves at grid cell midpoints and stores the worst
+# error it saw, which is sent along with each preview. Tables with no recorded error,
+# or one above MAX_ERROR, serve no previews and the lab solves instead.
+
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pybamm
+from flask import jsonify
+
+import metrics
+import responses
+
+# Where the tables are read from and built into
+SURROGATE_DIR = os.environ.get(
+    "SURROGATE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "surrogate")
+)
+CHEMISTRIES = ("NMC", "NCA", "LFP")
+TEMPERATURES = (273.15, 285.65, 298.15, 310.65, 323.15)
+C_RATES = (0.5, 1, 1.5, 2, 3, 4)
+# Capacity the tables are solved at. update_parameters scales the electrode height
+# with the capacity, so currents, capacities and SEI growth all scale with it and
+# the other capacities are exact rescalings of this one.
+REFERENCE_CAPACITY = 10.0
+MAX_CYCLES = 50
+SWEEP_POINTS = 256
+LITHIUM_POINTS_PER_CYCLE = 64
+# Largest validated error of a table whose previews are served
+MAX_ERROR = {
+    "voltage [V]": float(os.environ.get("SURROGATE_MAX_VOLTAGE_ERROR", 0.05)),
+    "capacity [%]": float(os.environ.get("SURROGATE_MAX_CAPACITY_ERROR", 2)),
+    "lithium loss [%]": float(os.environ.get("SURROGATE_MAX_LITHIUM_LOSS_ERROR", 0.5)),
+}
+
+SWEEP_SERIES = ("charge_capacity", "charge_voltage", "discharge_capacity", "discharge_voltage")
+CYCLING_SERIES = ("cycle_capacity", "lithium_loss")
+# Series that hold a capacity and are rescaled to the requested one
+CAPACITY_SERIES = ("charge_capacity", "discharge_capacity", "cycle_capacity")
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+# update_parameters leaves a 5 Ah NMC cell as parameterised instead of rescaling it,
+# so that one gets a table of its own. Returns (table name, capacity it was solved at).
+def table_name(battery_type: str, capacity: float) -> tuple:
+    if battery_type == "NMC" and capacity == 5:
+        return "NMC-5Ah", 5.0
+    return battery_type, REFERENCE_CAPACITY
+
+
+def table_path(name: str, directory: str = None) -> str:
+    return os.path.join(directory or SURROGATE_DIR, f"lab1-{name}.npz")
+
+
+def _resample(values, points: int) -> np.ndarray:
+    values = np.asarray(values, dtype=float)
+    return np.interp(
+        np.linspace(0, len(values) - 1, points), np.arange(len(values)), values
+    )
+
+
+# Runs in a build worker: both sweeps of one temperature, every C rate resampled
+def _solve_sweeps(
+    battery_type: str, capacity: float, temperature: float, c_rates: list
+) -> dict:
+    import lab1
+
+    series = {}
+    for mode in ("Charge", "Discharge"):
+        experiment = lab1.run_sweep(battery_type, temperature, capacity, c_rates, mode)
+        graphs = experiment[1]["graphs"]
+        series[f"{mode.lower()}_capacity"] = np.array(
+            [_resample(graph["values"], SWEEP_POINTS) for graph in graphs[0::2]]
+        )
+        series[f"{mode.lower()}_voltage"] = np.array(
+            [_resample(graph["values"], SWEEP_POINTS) for graph in graphs[1::2]]
+        )
+    return series
+
+
+# Runs in a build worker: MAX_CYCLES cycles of one C rate, missing cycles are NaN
+def _solve_cycling(
+    battery_type: str, capacity: float, temperature: float, c_rate: float
+) -> dict:
+    import lab1
+
+    sol = lab1.solve_cycling(battery_type, temperature, capacity, c_rate, MAX_CYCLES)
+    cycle_capacity = np.full(MAX_CYCLES, np.nan)
+    lithium_loss = np.full((MAX_CYCLES, LITHIUM_POINTS_PER_CYCLE), np.nan)
+    summary = sol.summary_variables["Capacity [A.h]"][:MAX_CYCLES]
+    cycle_capacity[: len(summary)] = summary
+    for i, cycle in enumerate(sol.cycles[:MAX_CYCLES]):
+        lithium_loss[i] = _resample(
+            cycle["Loss of lithium inventory [%]"].entries, LITHIUM_POINTS_PER_CYCLE
+        )
+    return {"cycle_capacity": cycle_capacity, "lithium_loss": lithium_loss}
+
+
+# Grid interval holding `value` and the weight of its upper end
+def _bracket(grid: np.ndarray, value: float) -> tuple:
+    if len(grid) < 2 or value < grid[0] or value > grid[-1]:
+        return None
+    i = min(int(np.searchsorted(grid, value, side="right")) - 1, len(grid) - 2)
+    return i, (value - grid[i]) / (grid[i + 1] - grid[i])
+
+
+# Bilinear interpolation of every series at (temperature, C rate), None outside the
+# grid. Grid points that failed to solve are NaN and make the result NaN.
+def interpolate(table: dict, temperature: float, c_rate: float) -> dict:
+    temperature_bracket = _bracket(table["temperatures"], temperature)
+    c_rate_bracket = _bracket(table["c_rates"], c_rate)
+    if temperature_bracket is None or c_rate_bracket is None:
+        return None
+    (i, u), (j, v) = temperature_bracket, c_rate_bracket
+    corners = [
+        ((i, j), (1 - u) * (1 - v)),
+        ((i + 1, j), u * (1 - v)),
+        ((i, j + 1), (1 - u) * v),
+        ((i + 1, j + 1), u * v),
+    ]
+    # A grid hit only reads that grid point, so its NaN neighbours don't matter
+    corners = [(index, weight) for index, weight in corners if weight > 0]
+    return {
+        name: sum(weight * table[name][index].astype(float) for index, weight in corners)
+        for name in SWEEP_SERIES + CYCLING_SERIES
+    }
+
+
+def build_table(
+    pool: ProcessPoolExecutor,
+    battery_type: str,
+    capacity: float,
+    temperatures: list,
+    c_rates: list,
+) -> dict:
+    shape = (len(temperatures), len(c_rates))
+    table = {
+        "temperatures": np.array(temperatures, dtype=float),
+        "c_rates": np.array(c_rates, dtype=float),
+        "cycle_capacity": np.full(shape + (MAX_CYCLES,), np.nan),
+        "lithium_loss": np.full(
+            shape + (MAX_CYCLES, LITHIUM_POINTS_PER_CYCLE), np.nan
+        ),
+    }
+    for name in SWEEP_SERIES:
+        table[name] = np.full(shape + (SWEEP_POINTS,), np.nan)
+
+    sweeps = {
+        i: pool.submit(_solve_sweeps, battery_type, capacity, temperature, c_rates)
+        for i, temperature in enumerate(temperatures)
+    }
+    cycling = {
+        (i, j): pool.submit(_solve_cycling, battery_type, capacity, temperature, c_rate)
+        for i, temperature in enumerate(temperatures)
+        for j, c_rate in enumerate(c_rates)
+    }
+    for i, future in sweeps.items():
+        try:
+            for name, values in future.result().items():
+                table[name][i] = values
+        except Exception as e:
+            print("Sweep failed at ", temperatures[i], "K: ", e)
+    for (i, j), future in cycling.items():
+        try:
+            for name, values in future.result().items():
+                table[name][i, j] = values
+        except Exception as e:
+            print("Cycling failed at ", temperatures[i], "K ", c_rates[j], "C: ", e)
+    return table
+
+
+# Solves the midpoints of up to `points` grid cells and returns the worst error of
+# the interpolated series, None when nothing could be validated
+def validate_table(
+    pool: ProcessPoolExecutor,
+    table: dict,
+    battery_type: str,
+    capacity: float,
+    points: int,
+) -> dict:
+    temperatures, c_rates = table["temperatures"], table["c_rates"]
+    cells = [
+        (i, j) for i in range(len(temperatures) - 1) for j in range(len(c_rates) - 1)
+    ]
+    cells = cells[:: max(len(cells) // max(points, 1), 1)][:points]
+    checks = []
+    for i, j in cells:
+        temperature = float(temperatures[i : i + 2].mean())
+        c_rate = float(c_rates[j : j + 2].mean())
+        checks.append(
+            (
+                temperature,
+                c_rate,
+                pool.submit(_solve_sweeps, battery_type, capacity, temperature, [c_rate]),
+                pool.submit(_solve_cycling, battery_type, capacity, temperature, c_rate),
+            )
+        )
+
+    errors = {"voltage [V]": 0.0, "capacity [%]": 0.0, "lithium loss [%]": 0.0}
+    validated = 0
+    for temperature, c_rate, sweep_future, cycling_future in checks:
+        try:
+            solved = {**sweep_future.result(), **cycling_future.result()}
+        except Exception as e:
+            print("Validation solve failed at ", temperature, "K ", c_rate, "C: ", e)
+            continue
+        estimate = interpolate(table, temperature, c_rate)
+        for name in SWEEP_SERIES:
+            solved[name] = solved[name][0]
+        valid = ~np.isnan(solved["cycle_capacity"])
+        if any(np.isnan(estimate[name]).any() for name in SWEEP_SERIES) or np.isnan(
+            estimate["cycle_capacity"][valid]
+        ).any():
+            continue
+
+        for mode in ("charge", "discharge"):
+            voltage_error = np.abs(estimate[f"{mode}_voltage"] - solved[f"{mode}_voltage"])
+            errors["voltage [V]"] = max(errors["voltage [V]"], float(voltage_error.max()))
+            capacity_error = np.abs(
+                estimate[f"{mode}_capacity"] - solved[f"{mode}_capacity"]
+            ) / np.abs(solved[f"{mode}_capacity"]).max()
+            errors["capacity [%]"] = max(
+                errors["capacity [%]"], 100 * float(capacity_error.max())
+            )
+        capacity_error = np.abs(
+            estimate["cycle_capacity"][valid] - solved["cycle_capacity"][valid]
+        ) / solved["cycle_capacity"][valid]
+        errors["capacity [%]"] = max(
+            errors["capacity [%]"], 100 * float(capacity_error.max())
+        )
+        lithium_error = np.abs(
+            estimate["lithium_loss"][valid] - solved["lithium_loss"][valid]
+        )
+        errors["lithium loss [%]"] = max(
+            errors["lithium loss [%]"], float(lithium_error.max())
+        )
+        validated += 1
+
+    if not validated:
+        return None
+    return {name: float(f"{error:.3g}") for name, error in errors.items()}
+
+
+def save_table(path: str, table: dict, meta: dict) -> None:
+    arrays = {
+        name: values.astype(np.float32) if name in SWEEP_SERIES + CYCLING_SERIES else values
+        for name, values in table.items()
+    }
+    tmp_path = path + ".tmp.npz"
+    np.savez_compressed(tmp_path, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp_path, path)
+
+
+# Whether a table's validated error is known and within MAX_ERROR
+def within_error_bound(error: dict) -> bool:
+    if not error:
+        return False
+    return all(
+        error.get(name) is not None and error[name] <= bound
+        for name, bound in MAX_ERROR.items()
+    )
+
+
+# Loads (once) the table of a name, None when it is missing or built by another pybamm
+def load_table(name: str) -> dict:
+    with _tables_lock:
+        if name in _tables:
+            return _tables[name]
+        table = None
+        path = table_path(name)
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as stored:
+                table = {key: stored[key] for key in stored.files}
+            table["meta"] = json.loads(str(table["meta"]))
+            if table["meta"].get("pybamm") != pybamm.__version__:
+                print("Ignoring surrogate table built with pybamm ", table["meta"].get("pybamm"))
+                table = None
+        _tables[name] = table
+        return table
+
+
+# Every series of a lab 1 request interpolated from its table, one dict per C rate.
+# None when an input is outside the grid or next to a grid point that failed, or the
+# table's error is unknown or above MAX_ERROR.
+def lab1_series(
+    battery_type: str, temperature: float, capacity: float, c_rates: list, cycles: int
+) -> tuple:
+    name, table_capacity = table_name(battery_type, capacity)
+    table = load_table(name)
+    if table is None or cycles > MAX_CYCLES:
+        return None
+    if not within_error_bound(table["meta"].get("error")):
+        print("Surrogate table ", name, " error out of bounds: ", table["meta"].get("error"))
+        return None
+    scale = capacity / table_capacity
+
+    rates = []
+    for c_rate in c_rates:
+        series = interpolate(table, temperature, float(c_rate))
+        if series is None:
+            return None
+        series["cycle_capacity"] = series["cycle_capacity"][:cycles]
+        series["lithium_loss"] = series["lithium_loss"][:cycles].ravel()
+        for series_name in CAPACITY_SERIES:
+            series[series_name] = series[series_name] * scale
+        if any(np.isnan(values).any() for values in series.values()):
+            return None
+        rates.append(series)
+    return rates, table["meta"]["error"]
+
+
+# Sends a preview like any lab result, marked as interpolated and with its error bound
+def respond(request, lab: str, data: dict, result: list, error: dict):
+    metrics.surrogate_previews.inc(result="served", **metrics.lab_labels(lab, data))
+    response = responses.respond(request, jsonify(result).get_data(), result)
+    response.headers["X-Result-Source"] = "surrogate"
+    response.headers["X-Surrogate-Error"] = json.dumps(error)
+    return response
+
+
+def build(args) -> None:
+    os.makedirs(args.output_dir, exist_ok=True)
+    tables = [(battery_type, battery_type, REFERENCE_CAPACITY) for battery_type in args.chemistries]
+    if "NMC" in args.chemistries:
+        tables.append(("NMC-5Ah", "NMC", 5.0))
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(args.workers, mp_context=context) as pool:
+        for name, battery_type, capacity in tables:
+            started = time.time()
+            print("Building surrogate table ", name)
+            table = build_table(pool, battery_type, capacity, args.temperatures, args.c_rates)
+            error = validate_table(pool, table, battery_type, capacity, args.validation_points)
+            meta = {
+                "chemistry": battery_type,
+                "capacity": capacity,
+                "pybamm": pybamm.__version__,
+                "built": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "error": error,
+            }
+            path = table_path(name, args.output_dir)
+            save_table(path, table, meta)
+            print(f"Saved {path} in {time.time() - started:.0f} s, error: {error}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Surrogate tables for instant lab 1 previews"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="solve and store the tables")
+    build_parser.add_argument("--output-dir", default=SURROGATE_DIR)
+    build_parser.add_argument(
+        "--chemistries", nargs="+", choices=CHEMISTRIES, default=list(CHEMISTRIES)
+    )
+    build_parser.add_argument(
+        "--temperatures", nargs="+", type=float, default=list(TEMPERATURES)
+    )
+    build_parser.add_argument("--c-rates", nargs="+", type=float, default=list(C_RATES))
+    build_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    build_parser.add_argument("--validation-points", type=int, default=4)
+    args = parser.parse_args()
+    if len(args.temperatures) < 2 or len(args.c_rates) < 2:
+        parser.error("the grid needs at least two temperatures and two C rates")
+    args.temperatures.sort()
+    args.c_rates.sort()
+    build(args)
+
+
+if __name__ == "__main__":
+    main()
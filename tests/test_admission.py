@@ -0,0 +1,134 @@
+import math
+import pstats
+import threading
+import time
+
+import flask
+import pybamm
+import pytest
+
+import admission
+import metrics
+import tracing
+
+LABELS = {"lab": "test", "chemistry": "NMC"}
+
+
+def wait_for(condition, timeout: float = 10):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+# Calls run_once on a thread, its result (or error) lands in `outcome`
+def run_in_thread(key: str, function, outcome: list, block: bool = False):
+    def call():
+        try:
+            outcome.append(admission.run_once(key, function, LABELS, block))
+        except Exception as e:
+            outcome.append(e)
+
+    thread = threading.Thread(target=call)
+    thread.start()
+    return thread
+
+
+# A function that runs until released, to hold a simulation slot
+class Held:
+    def __init__(self, result=None):
+        self.result = result
+        self.release = threading.Event()
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        assert self.release.wait(10)
+        return self.result
+
+
+def solve_spm():
+    model = pybamm.lithium_ion.SPM()
+    return pybamm.Simulation(model).solve([0, 600])
+
+
+def test_profile_follows_the_solve_onto_the_pool(monkeypatch, tmp_path):
+    monkeypatch.setattr(tracing, "PROFILE_DIR", str(tmp_path))
+    trace = tracing.start("profiled")
+    assert tracing.start_profile(trace)
+    try:
+        admission.run_once("profiled", solve_spm, {})
+    finally:
+        path = tracing.stop_profile(trace)
+        tracing.finish(trace)
+
+    functions = [(filename, name) for filename, _, name in pstats.Stats(path).stats]
+    # The request thread waiting for the pool
+    assert any(f.endswith("admission.py") and n == "run_once" for f, n in functions)
+    # Frames of the solve itself, which runs on a pool thread
+    assert any("pybamm" in f and n == "solve" for f, n in functions)
+    assert any("casadi" in f for f, _ in functions)
+
+
+def test_identical_keys_share_one_run():
+    held = Held(result=[1, 2])
+    first, second = [], []
+    deduplicated = metrics.deduplicated_requests._values.get(("test", "NMC"), 0)
+    threads = [run_in_thread("same", held, first)]
+    wait_for(lambda: "same" in admission._in_flight)
+    threads.append(run_in_thread("same", held, second))
+    wait_for(
+        lambda: metrics.deduplicated_requests._values.get(("test", "NMC"), 0)
+        > deduplicated
+    )
+    held.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert held.calls == 1
+    assert first == [[1, 2]] and second == [[1, 2]]
+    assert first[0] is second[0]
+
+
+def test_full_queue_is_busy_unless_blocking(monkeypatch):
+    monkeypatch.setattr(admission, "MAX_SIMULATIONS", 1)
+    monkeypatch.setattr(admission, "MAX_QUEUED_SIMULATIONS", 0)
+    pending = admission._pending
+    held = Held(result="held")
+    held_outcome, blocked_outcome = [], []
+    threads = [run_in_thread("held", held, held_outcome)]
+    wait_for(lambda: admission._pending == pending + 1)
+
+    with pytest.raises(admission.Busy) as busy:
+        admission.run_once("other", lambda: "other", LABELS)
+    assert 1 <= busy.value.retry_after <= math.ceil(admission._average_duration)
+    with flask.Flask(__name__).app_context():
+        response = admission.busy_response(busy.value)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(busy.value.retry_after)
+
+    # Jobs waited in their own queue already and skip the check
+    blocked = Held(result="blocked")
+    threads.append(run_in_thread("blocked", blocked, blocked_outcome, block=True))
+    wait_for(lambda: admission._pending == pending + 2)
+    held.release.set()
+    blocked.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert held_outcome == ["held"] and blocked_outcome == ["blocked"]
+    assert admission._pending == pending
+
+
+def test_failed_runs_are_cleaned_up():
+    pending = admission._pending
+
+    def fail():
+        raise ValueError("solver failed")
+
+    with pytest.raises(ValueError):
+        admission.run_once("failing", fail, LABELS)
+    assert admission._pending == pending
+    assert "failing" not in admission._in_flight
+    # The key can run again
+    assert admission.run_once("failing", lambda: "ok", LABELS) == "ok"
@@ -0,0 +1,119 @@
+from collections import OrderedDict
+
+import numpy as np
+import pybamm
+import pytest
+
+import checkpoints
+import cycling
+import outputs
+import utils
+
+CYCLE = ("Discharge at 1C until 3.0 V", "Charge at 1C until 4.1 V")
+OTHER_CYCLE = ("Discharge at 2C until 3.0 V", "Charge at 1C until 4.1 V")
+OUTPUT_VARIABLES = outputs.OutputVariables(
+    ["Time [s]", "Voltage [V]"], ["Capacity [A.h]"]
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_checkpoints(monkeypatch):
+    monkeypatch.setattr(checkpoints, "_checkpoints", OrderedDict())
+    monkeypatch.setattr(checkpoints, "CHECKPOINT_EVERY", 2)
+
+
+def solve(cycles: list, checkpoint: bool = True) -> pybamm.Solution:
+    parameters = utils.get_battery_parameters("NMC", degradation_enabled=True)
+    model = pybamm.lithium_ion.SPM({"SEI": "ec reaction limited"})
+    return cycling.solve(
+        "NMC",
+        model,
+        parameters,
+        pybamm.Experiment(cycles),
+        OUTPUT_VARIABLES,
+        checkpoint=checkpoint,
+    )
+
+
+def saved_cycles() -> list:
+    return [cycles for _, cycles, _ in checkpoints._checkpoints]
+
+
+def test_resumed_run_matches_a_fresh_one(capsys):
+    solve([CYCLE] * 4)
+    assert saved_cycles() == [2, 4]
+
+    resumed = solve([CYCLE] * 6)
+    assert "Resuming from the checkpoint after cycle 4" in capsys.readouterr().out
+    fresh = solve([CYCLE] * 6, checkpoint=False)
+
+    assert len(resumed.cycles) == len(fresh.cycles) == 6
+    for resumed_cycle, fresh_cycle in zip(resumed.cycles, fresh.cycles):
+        np.testing.assert_allclose(
+            resumed_cycle["Voltage [V]"].entries,
+            fresh_cycle["Voltage [V]"].entries,
+            rtol=1e-6,
+        )
+    np.testing.assert_allclose(
+        resumed.summary_variables["Capacity [A.h]"],
+        fresh.summary_variables["Capacity [A.h]"],
+        rtol=1e-6,
+    )
+    # The resumed run leaves checkpoints of its own
+    assert saved_cycles() == [2, 4, 6]
+
+
+def test_prefix_hashes_split_where_the_protocol_changes():
+    same = checkpoints.prefix_hashes(pybamm.Experiment([CYCLE] * 4))
+    changed = checkpoints.prefix_hashes(
+        pybamm.Experiment([CYCLE] * 2 + [OTHER_CYCLE] * 2)
+    )
+    assert len(same) == len(changed) == 5
+    assert same[:3] == changed[:3]
+    assert all(a != b for a, b in zip(same[3:], changed[3:]))
+
+
+def test_resume_only_from_a_matching_prefix(monkeypatch):
+    monkeypatch.setattr(checkpoints, "CHECKPOINT_EVERY", 1)
+    solve([CYCLE] * 3)
+    key = next(iter(checkpoints._checkpoints))[0]
+
+    changed = pybamm.Experiment([CYCLE] * 2 + [OTHER_CYCLE] * 2)
+    done, solution = checkpoints.resume(key, changed)
+    assert done == 2 and len(solution.cycles) == 2
+    assert checkpoints.resume(key, pybamm.Experiment([OTHER_CYCLE] * 3)) == (0, None)
+    # At least one cycle is always left to solve
+    done, _ = checkpoints.resume(key, pybamm.Experiment([CYCLE] * 3))
+    assert done == 2
+    assert checkpoints.resume("another run", changed) == (0, None)
+
+
+def test_least_recently_used_checkpoints_are_evicted(monkeypatch):
+    monkeypatch.setattr(checkpoints, "CHECKPOINT_EVERY", 1)
+    monkeypatch.setattr(checkpoints, "MAX_CHECKPOINTS", 3)
+    solve([CYCLE] * 3)
+    assert saved_cycles() == [1, 2, 3]
+    key = next(iter(checkpoints._checkpoints))[0]
+
+    # Resuming from a checkpoint marks it used
+    assert checkpoints.resume(key, pybamm.Experiment([CYCLE] + [OTHER_CYCLE]))[0] == 1
+    solve([OTHER_CYCLE])
+    assert saved_cycles() == [3, 1, 1]
+    assert checkpoints.resume(key, pybamm.Experiment([CYCLE] * 3))[0] == 1
+
+
+def test_truncated_runs_leave_no_checkpoints():
+    solution = solve([CYCLE] * 2, checkpoint=False)
+    key = "run"
+    checkpoints.save(key, pybamm.Experiment([CYCLE] * 4), solution)
+    assert saved_cycles() == []
+
+    solution.cycles[1] = None
+    checkpoints.save(key, pybamm.Experiment([CYCLE] * 2), solution)
+    assert saved_cycles() == []
+
+
+def test_no_checkpoints_when_disabled(monkeypatch):
+    monkeypatch.setattr(checkpoints, "MAX_CHECKPOINTS", 0)
+    solve([CYCLE] * 2)
+    assert saved_cycles() == []
@@ -0,0 +1,56 @@
+import os
+
+import pybamm
+
+import cycling
+import outputs
+import utils
+
+CYCLES = 100
+# Growth of the resident set allowed from the end of the 20th cycle to the last,
+# about half what the solver state piles up to when it is not freed
+RSS_BUDGET_MB = 12
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+class RssCallback(pybamm.callbacks.Callback):
+    def __init__(self):
+        self.rss = []
+
+    def on_cycle_end(self, logs):
+        self.rss.append(_rss_mb())
+
+
+def test_bounded_run_memory_stays_within_budget():
+    parameters = utils.get_battery_parameters("NMC", degradation_enabled=True)
+    output_variables = outputs.OutputVariables(
+        ["Time [s]", "Voltage [V]"], ["Capacity [A.h]"]
+    )
+    model = output_variables.prune(
+        pybamm.lithium_ion.SPM({"SEI": "ec reaction limited"})
+    )
+    experiment = pybamm.Experiment(
+        [("Discharge at 1C until 3.0 V", "Charge at 1C until 4.1 V")] * CYCLES
+    )
+    assert CYCLES > cycling.BOUNDED_FROM_CYCLES
+    rss = RssCallback()
+
+    store = cycling.solve(
+        "NMC",
+        model,
+        parameters,
+        experiment,
+        output_variables,
+        callbacks=lambda sim, store: [rss],
+    )
+
+    assert isinstance(store, cycling.CycleStore)
+    assert len(store.cycles) == CYCLES
+    assert len(store.trace("Voltage [V]")) <= CYCLES * cycling.TRACE_POINTS
+    growth = rss.rss[-1] - rss.rss[19]
+    print(f"RSS {rss.rss[19]:.0f} MB after cycle 20, {rss.rss[-1]:.0f} MB at the end")
+    assert growth < RSS_BUDGET_MB
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+import downsampling
+
+# A discharge-like curve with a spike the decimation should not smooth away
+X = np.linspace(0, 3600, 10000)
+Y = 4.2 - 0.3 * X / 3600 - 0.5 * (X / 3600) ** 8
+Y[4321] = 2.5
+POINTS = 200
+
+
+@pytest.mark.parametrize("method", list(downsampling.STRATEGIES))
+def test_endpoints_and_point_counts(method):
+    x, y = downsampling.downsample(X, Y, method, POINTS)
+    assert len(x) == len(y)
+    assert x[0] == X[0] and x[-1] == X[-1]
+    assert y[0] == pytest.approx(Y[0]) and y[-1] == pytest.approx(Y[-1])
+    if method == "minmax":
+        # Flat buckets give one sample instead of two
+        assert 2 < len(y) <= POINTS
+    else:
+        assert len(y) == POINTS
+    assert np.all(np.diff(x) >= 0)
+
+
+@pytest.mark.parametrize("method", ["lttb", "minmax"])
+def test_selecting_strategies_keep_samples_and_spikes(method):
+    x, y = downsampling.downsample(X, Y, method, POINTS)
+    indices = np.searchsorted(X, x)
+    assert np.array_equal(X[indices], x)
+    assert np.array_equal(Y[indices], y)
+    assert y.min() == 2.5
+
+
+def test_short_series_are_returned_unchanged():
+    x, y = downsampling.downsample(X[:50], Y[:50], "lttb", POINTS)
+    assert np.array_equal(x, X[:50]) and np.array_equal(y, Y[:50])
+
+
+def test_downsample_result_keeps_graph_pairs_aligned():
+    graphs = [
+        {"name": "Time [s]", "values": X.tolist()},
+        {"name": "Voltage [V]", "values": Y.tolist()},
+        {"name": "Cycle", "values": [1, 2, 3]},
+        {"name": "Capacity [A.h]", "values": [5.0, 4.9, 4.8]},
+    ]
+    result = [[{"title": "1C", "graphs": graphs}, {"title": "no graphs"}]]
+    downsampling.downsample_result(result, "minmax", POINTS)
+
+    time, voltage, cycle, capacity = result[0][0]["graphs"]
+    assert len(time["values"]) == len(voltage["values"]) <= POINTS
+    assert time["values"][0] == X[0] and time["values"][-1] == X[-1]
+    assert cycle["values"] == [1, 2, 3]
+    assert capacity["values"] == [5.0, 4.9, 4.8]
+
+
+def test_options_from_request():
+    assert downsampling.options_from_request({}) == (
+        downsampling.DEFAULT_METHOD,
+        downsampling.DEFAULT_POINTS,
+    )
+    data = {"Downsampling": {"Method": "lttb", "Points": "500"}}
+    assert downsampling.options_from_request(data) == ("lttb", 500)
+    with pytest.raises(ValueError):
+        downsampling.options_from_request({"Downsampling": {"Method": "every"}})
+    with pytest.raises(ValueError):
+        downsampling.options_from_request({"Downsampling": {"Points": 3}})
@@ -0,0 +1,73 @@
+import json
+from collections import OrderedDict
+
+import flask
+import pybamm
+import pytest
+
+import cycling
+import lab2
+import result_cache
+
+PAYLOAD = {
+    "Ambient temperature [K]": 298,
+    "C Rates": [1],
+    "Silicon Percentage": 0.1,
+    "Cycles": 2,
+    "Negative electrode thickness [um]": 85,
+    "Separator thickness [um]": 12,
+}
+COARSE = {**PAYLOAD, "Fidelity": "coarse"}
+RESULT = [[{"title": "Loss of Lithium Inventory", "graphs": [{"values": [0.5]}]}]]
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(lab2, "_unavailable", OrderedDict())
+    monkeypatch.setattr(result_cache, "cache", result_cache.ResultCache())
+
+    # Every solve fails, as coarse meshes do near the cut-offs
+    def failing_solve(*args, **kwargs):
+        raise pybamm.SolverError("Maximum number of decreased steps occurred")
+
+    monkeypatch.setattr(cycling, "solve", failing_solve)
+
+
+def test_failed_fidelity_is_remembered():
+    assert lab2.resolve_fidelity(COARSE) == ("coarse", COARSE)
+    with pytest.raises(lab2.FidelityUnavailable):
+        lab2.run_lab2(COARSE)
+    assert lab2.resolve_fidelity(COARSE) == ("standard", PAYLOAD)
+    # Standard has nothing to fall back to
+    with pytest.raises(pybamm.SolverError):
+        lab2.run_lab2(PAYLOAD)
+    assert lab2.resolve_fidelity(PAYLOAD) == ("standard", PAYLOAD)
+
+
+def test_request_falls_back_to_standard(monkeypatch):
+    solve_lab2 = lab2.run_lab2
+    runs = []
+
+    # Coarse goes through the real lab (and fails), standard gets a stand-in result
+    def run_lab2(data, callbacks=None):
+        runs.append(data.get("Fidelity", "standard"))
+        if "Fidelity" in data:
+            return solve_lab2(data, callbacks)
+        return RESULT
+
+    monkeypatch.setattr(lab2, "run_lab2", run_lab2)
+    app = flask.Flask(__name__)
+    for _ in range(2):
+        with app.test_request_context(method="POST", json=COARSE):
+            response = lab2.simulate_lab2(flask.request)
+        assert response.headers["X-Fidelity"] == "standard"
+        assert json.loads(response.headers["X-Fidelity-Measured-Error"]) == {
+            "capacity": 0.0,
+            "lithium inventory": 0.0,
+        }
+        assert json.loads(response.get_data()) == RESULT
+
+    # Coarse was tried once, the second request went straight to the cache
+    assert runs == ["coarse", "standard"]
+    assert result_cache.make_key("lab2", PAYLOAD) in result_cache.cache
+    assert result_cache.make_key("lab2", COARSE) not in result_cache.cache
@@ -0,0 +1,46 @@
+import numpy as np
+import pybamm
+
+import model_cache
+import utils
+
+# Largest difference between a stacked run and the same run solved alone, relative
+# to the range of each series
+TOLERANCE = 1e-5
+
+
+def _sweep_runs(parameters: pybamm.ParameterValues) -> list:
+    capacity = parameters["Nominal cell capacity [A.h]"]
+    runs = []
+    # Every run stops on its own cut-off at its own time
+    for c_rate, min_voltage in [(0.5, 3.0), (1, 3.2), (2, 2.8), (3, 3.4)]:
+        inputs = model_cache.sweep_inputs(parameters, 1, min_voltage=min_voltage)
+        runs.append({**inputs, "Current function [A]": (c_rate + 0.01) * capacity})
+    return runs
+
+
+def test_stacked_runs_match_single_runs():
+    parameters = utils.get_battery_parameters("NMC")
+    built_model = model_cache.build_model(
+        pybamm.lithium_ion.SPM(),
+        parameters,
+        output_variables=utils.SWEEP_OUTPUTS,
+    )
+    runs = _sweep_runs(parameters)
+    duration = 100 * 3600
+
+    stacked = built_model._solve_stacked(runs, duration, 60)
+    single = [built_model.solve(inputs, duration) for inputs in runs]
+
+    event_times = []
+    for stacked_run, single_run in zip(stacked, single):
+        assert stacked_run.termination == single_run.termination
+        assert stacked_run.termination.startswith("event")
+        np.testing.assert_allclose(stacked_run.t, single_run.t, rtol=TOLERANCE)
+        for name in ["Voltage [V]", "Discharge capacity [A.h]"]:
+            old = single_run[name].entries
+            new = stacked_run[name].entries
+            assert np.abs(new - old).max() / np.ptp(old) < TOLERANCE
+        assert float(stacked_run.solve_time.value) > 0
+        event_times.append(single_run.t[-1])
+    assert len(set(np.round(event_times))) == len(runs)
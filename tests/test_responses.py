@@ -0,0 +1,104 @@
+import gzip
+import json
+import struct
+
+import flask
+import numpy as np
+import pytest
+
+import responses
+
+RESULT = [
+    [
+        {
+            "title": "1C",
+            "graphs": [
+                {"name": "Time [s]", "values": [0.0, 0.5, 1.25, 3600.0]},
+                {"name": "Voltage [V]", "values": [4.2, 4.1, 3.95, 3.0]},
+            ],
+        },
+        {"title": "Cycles", "graphs": [{"name": "Cycle", "values": [1, 2, 3]}]},
+    ]
+]
+
+
+# Reads a packed body back into the JSON result, as a client would
+def unpack(body: bytes) -> list:
+    (header_size,) = struct.unpack("<I", body[:4])
+    header = json.loads(body[4 : 4 + header_size])
+    dtype = responses.PACKED_DTYPES[header["dtype"]]
+
+    def read(value):
+        if isinstance(value, dict):
+            if set(value) == {"offset", "length"}:
+                array = np.frombuffer(
+                    body, dtype=dtype, count=value["length"], offset=value["offset"]
+                )
+                return array.tolist()
+            return {key: read(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [read(item) for item in value]
+        return value
+
+    return read(header["result"])
+
+
+def test_packed_float64_round_trips_to_the_json_values():
+    assert unpack(responses.pack_result(RESULT, "float64")) == json.loads(
+        json.dumps(RESULT)
+    )
+
+
+def test_packed_float32_round_trips_at_single_precision():
+    unpacked = unpack(responses.pack_result(RESULT, "float32"))
+    for graphs, expected in zip(unpacked[0], RESULT[0]):
+        for graph, expected_graph in zip(graphs["graphs"], expected["graphs"]):
+            assert graph["name"] == expected_graph["name"]
+            assert graph["values"] == pytest.approx(expected_graph["values"], 1e-7)
+
+
+def test_packed_buffers_are_aligned():
+    body = responses.pack_result(RESULT, "float32")
+    (header_size,) = struct.unpack("<I", body[:4])
+    header = json.loads(body[4 : 4 + header_size])
+    graphs = [graph for entry in header["result"][0] for graph in entry["graphs"]]
+    for graph in graphs:
+        assert graph["values"]["offset"] % 8 == 0
+    assert (4 + header_size) % 8 == 0
+
+
+def test_round_significant_edge_values():
+    values = [0.0, -0.0, -1.234567891, 123456789.123, 5e-324, 1e-310, 2.2e-308]
+    rounded = responses.round_significant(values, 6)
+    assert rounded[:4] == [0.0, -0.0, -1.23457, 123457000.0]
+    assert np.signbit(rounded[1])
+    # Subnormals are too small to scale by a power of ten and pass through
+    assert rounded[4:] == [5e-324, 1e-310, 2.2e-308]
+
+
+def test_round_significant_passes_non_finite_values_through():
+    values = [float("nan"), float("inf"), -float("inf"), 1.7976931348623157e308]
+    rounded = responses.round_significant(values, 1)
+    assert np.isnan(rounded[0])
+    assert rounded[1:3] == [float("inf"), -float("inf")]
+    # Rounding up would overflow to inf, the value is kept instead
+    assert rounded[3] == 1.7976931348623157e308
+
+
+def test_round_significant_leaves_integer_series_alone():
+    assert responses.round_significant([1, 2, 3], 1) == [1, 2, 3]
+
+
+def test_compress_only_bodies_worth_it():
+    app = flask.Flask(__name__)
+    body = json.dumps(RESULT * 100).encode("utf-8")
+    headers = {"Accept-Encoding": "gzip"}
+    with app.test_request_context(headers=headers):
+        response = responses.compress(flask.request, app.response_class(body))
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.get_data()) == body
+        assert "Accept-Encoding" in response.vary
+
+        small = responses.compress(flask.request, app.response_class(b"[]"))
+        assert "Content-Encoding" not in small.headers
+        assert small.get_data() == b"[]"
@@ -0,0 +1,97 @@
+import flask
+
+import result_cache
+
+PAYLOAD = {
+    "Type": "NMC",
+    "Ambient temperature [K]": 298,
+    "Nominal cell capacity [A.h]": 5,
+    "C Rates": [1, 2],
+    "Cycles": 3,
+}
+
+
+def test_key_is_stable_across_cosmetic_differences():
+    key = result_cache.make_key("lab1", PAYLOAD)
+    reordered = dict(reversed(list(PAYLOAD.items())))
+    spaced = {**PAYLOAD, "Type": " NMC ", " Cycles": 3}
+    del spaced["Cycles"]
+    as_floats = {**PAYLOAD, "Cycles": 3.0, "C Rates": [1.0, 2.0]}
+    with_defaults = {**PAYLOAD, "Significant Digits": 6}
+    for payload in (reordered, spaced, as_floats, with_defaults):
+        assert result_cache.make_key("lab1", payload) == key
+
+
+def test_key_changes_with_the_run():
+    key = result_cache.make_key("lab1", PAYLOAD)
+    assert result_cache.make_key("lab3", PAYLOAD) != key
+    assert result_cache.make_key("lab1", {**PAYLOAD, "Cycles": 4}) != key
+    assert result_cache.make_key("lab1", {**PAYLOAD, "Cycles": 3.5}) != key
+    assert result_cache.make_key("lab1", {**PAYLOAD, "Significant Digits": 3}) != key
+
+
+def test_defaults_are_dropped_only_for_their_lab():
+    assert result_cache.canonical_payload("lab1", {"Cycles": 1.0}) == {}
+    assert result_cache.canonical_payload("lab2", {"Fidelity": "standard"}) == {}
+    assert result_cache.canonical_payload("lab2", {"Cycles": 1}) == {"Cycles": 1}
+
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = result_cache.ResultCache(max_entries=2, disk_dir=None)
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    assert cache.get("a") == b"1"
+    cache.put("c", b"3")
+    assert "b" not in cache
+    assert cache.get("a") == b"1"
+    assert cache.get("c") == b"3"
+
+
+def test_memory_tier_is_bounded_by_bytes():
+    cache = result_cache.ResultCache(max_entries=10, max_bytes=10, disk_dir=None)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    cache.put("c", b"12345")
+    assert "a" not in cache
+    assert cache.get("c") == b"12345"
+    # Too large to keep in memory at all
+    cache.put("d", b"x" * 11)
+    assert "d" not in cache
+
+
+def test_disk_tier_round_trips(tmp_path):
+    cache = result_cache.ResultCache(disk_dir=str(tmp_path))
+    cache.put("key", b'[["result"]]')
+    restarted = result_cache.ResultCache(disk_dir=str(tmp_path))
+    assert restarted.get("key") == b'[["result"]]'
+    # Read back into the memory tier
+    assert "key" in restarted._entries
+
+
+def test_disk_tier_expires(tmp_path):
+    cache = result_cache.ResultCache(ttl=1e-9, disk_dir=str(tmp_path))
+    cache.put("key", b"[]")
+    assert cache.get("key") is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_get_or_run_runs_once_per_key(monkeypatch):
+    monkeypatch.setattr(result_cache, "cache", result_cache.ResultCache())
+    runs = []
+
+    def run(data):
+        runs.append(data)
+        return [{"graphs": [{"values": [data["Cycles"]]}]}]
+
+    with flask.Flask(__name__).app_context():
+        body, result = result_cache.get_or_run("lab1", PAYLOAD, run)
+        cached, cached_result = result_cache.get_or_run(
+            "lab1", {**PAYLOAD, "Cycles": 3.0}, run
+        )
+
+    assert result == [{"graphs": [{"values": [3]}]}]
+    assert cached == body
+    assert cached_result is None
+    assert len(runs) == 1
+    # The lab runs the canonical payload
+    assert runs[0] == result_cache.canonical_payload("lab1", PAYLOAD)
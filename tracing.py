@@ -0,0 +1,276 @@
+import contextvars
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import uuid
+import warnings
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import pybamm
+
+# Set to let a client profile its request with ?profile=1 or an "X-Profile: 1" header
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "") not in ("", "0")
+# Where cProfile dumps go, open them with snakeviz or python -m pstats
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+_current = contextvars.ContextVar("trace", default=None)
+# cProfile can only follow one request at a time
+_profile_lock = threading.Lock()
+
+
+# The spans of one request (or job), times are in ms from the start of the trace
+class Trace:
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+        # Set once the trace is known to be a lab run, see result_cache.get_or_run
+        self.labels = None
+        self.profiler = None
+        # Profiles of the request's work on other threads, merged into its own
+        self.thread_profilers = []
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def add(self, name: str, start: float, duration: float, label: str = None, **attrs):
+        span = {
+            "name": name,
+            "start": round((start - self.started) * 1000, 3),
+            "duration": round(duration * 1000, 3),
+        }
+        if label:
+            span["label"] = label
+        span.update(attrs)
+        self.spans.append(span)
+
+    # Adds spans recorded elsewhere (a worker process) that began at `start`
+    def merge(self, spans: list, start: float) -> None:
+        offset = (start - self.started) * 1000
+        for span in spans:
+            self.spans.append(dict(span, start=round(span["start"] + offset, 3)))
+
+    # One Server-Timing entry per span name and label, repeated spans are summed
+    def server_timing(self) -> str:
+        totals = OrderedDict()
+        for span in self.spans:
+            key = (span["name"], span.get("label"))
+            count, duration = totals.get(key, (0, 0.0))
+            totals[key] = (count + 1, duration + span["duration"])
+
+        entries = []
+        for (name, label), (count, duration) in totals.items():
+            entry = f"{name};dur={duration:.1f}"
+            description = " ".join(
+                part for part in (label, f"x{count}" if count > 1 else None) if part
+            )
+            if description:
+                entry += f';desc="{description}"'
+            entries.append(entry)
+        entries.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(entries)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace": self.id,
+            "name": self.name,
+            "total": round(self.elapsed_ms(), 3),
+            "spans": self.spans,
+        }
+
+
+def current() -> Trace:
+    return _current.get()
+
+
+def start(name: str) -> Trace:
+    trace = Trace(name)
+    _current.set(trace)
+    return trace
+
+
+# Logs the trace as a single JSON line and detaches it from the context
+def finish(trace: Trace, **fields) -> None:
+    if trace is None:
+        return
+    stop_profile(trace)
+    line = {"event": "timing", **trace.to_dict(), **fields}
+    print(json.dumps(line, default=str))
+    if _current.get() is trace:
+        _current.set(None)
+
+
+# Runs a block as its own trace, for work outside a request (jobs, streams)
+@contextmanager
+def trace(name: str):
+    token = _current.set(Trace(name))
+    try:
+        yield _current.get()
+    finally:
+        finish(_current.get())
+        _current.reset(token)
+
+
+# Times a block into the current trace, does nothing when there isn't one
+@contextmanager
+def span(name: str, label: str = None, **attrs):
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start_time, time.perf_counter() - start_time, label, **attrs)
+
+
+# Records a span that began at `start_time` (from time.perf_counter) and ends now
+def record(name: str, start_time: float, label: str = None, **attrs) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, start_time, time.perf_counter() - start_time, label, **attrs)
+
+
+# Marks something that happened (a solver error, an early return) in the current trace
+def event(name: str, label: str = None, **attrs) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, time.perf_counter(), 0, label, **attrs)
+
+
+# return_solution_if_failed_early makes CasadiSolver warn instead of raise, every one
+# of those warnings becomes an "early-return" event of the trace that hit it
+EARLY_RETURN_WARNING = "Maximum number of decreased steps occurred"
+_show_warning = warnings.showwarning
+
+
+def _show_solver_warning(message, category, *args, **kwargs):
+    if issubclass(category, pybamm.SolverWarning) and str(message).startswith(
+        EARLY_RETURN_WARNING
+    ):
+        event("early-return")
+    _show_warning(message, category, *args, **kwargs)
+
+
+warnings.showwarning = _show_solver_warning
+# Messages carry the failure time, but make sure repeats aren't swallowed either
+warnings.filterwarnings("always", category=pybamm.SolverWarning)
+
+
+# Records the model build and every cycle of an experiment solve
+class CycleTimer(pybamm.callbacks.Callback):
+    def __init__(self, trace: Trace, label: str = None):
+        self.trace = trace
+        self.label = label
+        self.experiment_start = None
+        self.cycle_start = None
+
+    def on_experiment_start(self, logs):
+        self.experiment_start = time.perf_counter()
+
+    def on_cycle_start(self, logs):
+        self.cycle_start = time.perf_counter()
+        # Everything between the start and the first cycle is building the models
+        if self.experiment_start is not None:
+            duration = self.cycle_start - self.experiment_start
+            self.trace.add("build", self.experiment_start, duration, self.label)
+            self.experiment_start = None
+
+    def on_cycle_end(self, logs):
+        cycle, _ = logs["cycle number"]
+        duration = time.perf_counter() - self.cycle_start
+        self.trace.add("cycle", self.cycle_start, duration, self.label, cycle=cycle)
+
+    # pybamm stops the experiment on these and returns the cycles solved so far
+    def on_experiment_error(self, logs):
+        now = time.perf_counter()
+        self.trace.add("solver-error", now, 0, self.label, error=str(logs["error"]))
+
+    def on_experiment_infeasible_time(self, logs):
+        self.trace.add("infeasible", time.perf_counter(), 0, self.label)
+
+    def on_experiment_infeasible_event(self, logs):
+        self.trace.add("infeasible", time.perf_counter(), 0, self.label)
+
+
+# Adds a CycleTimer to an experiment's callbacks when a trace is running
+def cycle_callbacks(callbacks: list = None, label: str = None) -> list:
+    trace = _current.get()
+    if trace is None:
+        return callbacks
+    return (callbacks or []) + [CycleTimer(trace, label)]
+
+
+# Runs function(*args) in a worker process under its own trace, returns
+# (result, spans) for the caller to merge
+def traced_call(function, args: tuple) -> tuple:
+    trace = Trace(function.__name__)
+    token = _current.set(trace)
+    try:
+        with span(function.__name__):
+            result = function(*args)
+    finally:
+        _current.reset(token)
+    return result, trace.spans
+
+
+def wants_profile(request) -> bool:
+    if not PROFILE_REQUESTS:
+        return False
+    return request.args.get("profile") == "1" or request.headers.get("X-Profile") == "1"
+
+
+# Profiles the rest of the request's thread, skipped while another request is profiled
+def start_profile(trace: Trace) -> bool:
+    if not _profile_lock.acquire(blocking=False):
+        print("Another request is being profiled, not profiling ", trace.id)
+        return False
+    trace.profiler = cProfile.Profile()
+    trace.profiler.enable()
+    return True
+
+
+def stop_profile(trace: Trace) -> str:
+    if trace.profiler is None:
+        return None
+    trace.profiler.disable()
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{trace.name}-{trace.id}.prof")
+        stats = pstats.Stats(trace.profiler)
+        for profiler in trace.thread_profilers:
+            stats.add(profiler)
+        stats.dump_stats(path)
+        print("Saved profile to ", path)
+        return path
+    except OSError as e:
+        print("Could not save profile: ", e)
+        return None
+    finally:
+        trace.profiler = None
+        trace.thread_profilers = []
+        _profile_lock.release()
+
+
+# Profiles a block of the current trace's work that runs on another thread (the
+# admission pool). cProfile only follows the thread that enabled it, so the block
+# gets a profiler of its own that stop_profile merges into the request's.
+@contextmanager
+def profile_thread():
+    trace = _current.get()
+    if trace is None or trace.profiler is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        trace.thread_profilers.append(profiler)
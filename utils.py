@@ -2,7 +2,13 @@ import pybamm
 import numpy as np
 from scipy.interpolate import PchipInterpolator
 import math
+import hashlib
+import functools
 from scipy.special import binom
+import cycling
+import model_cache
+import outputs
+import tracing
 
 # Battery titles in the front end mapping to the parameter set in PyBAMM
 batteries: dict = {
@@ -62,7 +68,11 @@ def remove_every_other_from_array(list: list) -> list:
     return list[::2]
 
 
-def get_battery_parameters(
+# Parsed parameter sets by (battery type, degradation enabled), never handed out directly
+_parameter_registry: dict = {}
+
+
+def load_battery_parameters(
     battery_type: str, degradation_enabled=False
 ) -> pybamm.ParameterValues:
     parameters = pybamm.ParameterValues(batteries[battery_type])
@@ -93,6 +103,64 @@ def get_battery_parameters(
     return parameters
 
 
+# Loads every chemistry, with and without degradation, so requests only pay for a copy
+def preload_battery_parameters() -> None:
+    for battery_type in batteries:
+        for degradation_enabled in (False, True):
+            key = (battery_type, degradation_enabled)
+            if key not in _parameter_registry:
+                _parameter_registry[key] = load_battery_parameters(
+                    battery_type, degradation_enabled
+                )
+
+
+# Returns a private copy of the preloaded set, safe to pass to update_parameters
+def get_battery_parameters(
+    battery_type: str, degradation_enabled=False
+) -> pybamm.ParameterValues:
+    key = (battery_type, degradation_enabled)
+    with tracing.span("parameters", battery_type):
+        parameters = _parameter_registry.get(key)
+        if parameters is None:
+            parameters = load_battery_parameters(battery_type, degradation_enabled)
+            _parameter_registry[key] = parameters
+        return parameters.copy()
+
+
+def _fingerprint_value(value) -> bytes:
+    if isinstance(value, np.ndarray):
+        return str(value.shape).encode() + value.tobytes()
+    if isinstance(value, (list, tuple)):
+        return b"(" + b",".join(_fingerprint_value(v) for v in value) + b")"
+    if callable(value) and hasattr(value, "__qualname__"):
+        return f"{value.__module__}.{value.__qualname__}".encode()
+    return repr(value).encode()
+
+
+# Stable hash of a parameter set, used to key anything that is derived from it
+def parameter_fingerprint(
+    parameters: pybamm.ParameterValues, exclude: tuple = ()
+) -> str:
+    digest = hashlib.sha256()
+    for name in sorted(parameters.keys()):
+        if name in exclude:
+            continue
+        digest.update(name.encode())
+        digest.update(_fingerprint_value(parameters[name]))
+    return digest.hexdigest()
+
+
+# One array with the variable over every cycle, filled without growing Python lists.
+# Bounded runs give their in-memory sample, the graphs are downsampled anyway.
+def concatenate_cycles(solution: pybamm.Solution, variable_name: str) -> np.ndarray:
+    if isinstance(solution, cycling.CycleStore):
+        return solution.trace(variable_name)
+    entries = [cycle[variable_name].entries for cycle in solution.cycles]
+    if len(entries) == 0:
+        return np.array([])
+    return np.concatenate(entries)
+
+
 # Returns graph dictionary ready to be sent to the front-end
 def plot_against_cycle(
     solution: pybamm.Solution,
@@ -101,18 +169,25 @@ def plot_against_cycle(
     func_name="",
     round_x: bool = False,
 ) -> list:
-    function = []
+    # Long series are capped later by the request's downsampling strategy
+    function = concatenate_cycles(solution, variable_name)
+    return series_against_cycle(
+        function, number_of_cycles, variable_name, func_name, round_x
+    )
 
-    graphs = []
-    for cycle in solution.cycles:
-        function += cycle[variable_name].entries.tolist()
 
-    if len(function) > 8100:
-        function = interpolate_array(function, 8100)
+# Graphs of a series that spans `number_of_cycles` cycles, spread evenly over them
+def series_against_cycle(
+    function: np.ndarray,
+    number_of_cycles: int,
+    variable_name: str,
+    func_name="",
+    round_x: bool = False,
+) -> list:
+    graphs = []
+    function = np.asarray(function).tolist()
 
     print("Number of Samples: ", len(function))
-    # while len(function) > 8100:
-    #    function = remove_every_other_from_array(function)
 
     cycles_array = np.linspace(0, number_of_cycles, len(function))
     graphs.append(
@@ -197,29 +272,53 @@ def bezier_curve(t, control_points):
         curve += bernstein_poly * np.array(control_points[i])
     return curve
 
-def transform_to_inverse_bezier_curve(arr: list, factor: float = 0.5) -> np.ndarray:
-    if len(arr) == 0:
-        return np.array([])  # Return an empty array if the input array is empty
 
-    n = len(arr)
-    t_values = np.linspace(0, 1, n)
-    
-    # Define control points for the Bézier curve
-    start = arr[0]
-    end = arr[-1]
-    mid = (start + end) / 2 - factor * (max(arr) - min(arr))
-    
-    control_points = [
-        [0, start],
-        [0.5, mid],
-        [1, end]
-    ]
+# Bernstein polynomials of `degree` at n evenly spaced t in [0, 1], one row per t.
+# Shared between calls, so it is read only.
+@functools.lru_cache(maxsize=128)
+def bernstein_basis(degree: int, n: int) -> np.ndarray:
+    t = np.linspace(0, 1, n)[:, np.newaxis]
+    i = np.arange(degree + 1)
+    basis = binom(degree, i) * (t ** i) * ((1 - t) ** (degree - i))
+    basis.setflags(write=False)
+    return basis
+
+
+# Evaluates Bézier curves at n evenly spaced t in one matrix product. Control points
+# are (..., degree + 1, dims) and the curves come back as (..., n, dims).
+def bezier_curves(control_points, n: int) -> np.ndarray:
+    control_points = np.asarray(control_points, dtype=float)
+    return bernstein_basis(control_points.shape[-2] - 1, n) @ control_points
+
+
+# Replaces each series with a quadratic Bézier from its first to its last value, bent
+# down by factor * (its range). Series of the same length share one evaluation.
+def transform_to_inverse_bezier_curves(arrays: list, factors: list) -> list:
+    curves = [None] * len(arrays)
+    indices_by_length = {}
+    for index, arr in enumerate(arrays):
+        indices_by_length.setdefault(len(arr), []).append(index)
+
+    for n, indices in indices_by_length.items():
+        if n == 0:
+            for index in indices:
+                curves[index] = np.array([])
+            continue
+        values = np.array([np.asarray(arrays[index], dtype=float) for index in indices])
+        factor = np.array([factors[index] for index in indices], dtype=float)
+        start = values[:, 0]
+        end = values[:, -1]
+        mid = (start + end) / 2 - factor * (values.max(axis=1) - values.min(axis=1))
+        # Only the y values are returned, the x control points are fixed at 0, 0.5, 1
+        control_points = np.stack([start, mid, end], axis=1)[:, :, np.newaxis]
+        y_values = bezier_curves(control_points, n)[:, :, 0]
+        for row, index in enumerate(indices):
+            curves[index] = y_values[row].tolist()
+    return curves
 
-    # Compute the Bézier curve
-    curve = np.array([bezier_curve(t, control_points) for t in t_values])
 
-    # Since we only need the y-values from the curve:
-    return curve[:, 1].tolist()
+def transform_to_inverse_bezier_curve(arr: list, factor: float = 0.5) -> np.ndarray:
+    return transform_to_inverse_bezier_curves([arr], [factor])[0]
 
 # Returns graphs dictionary ready to be sent to the front-end
 def plot_graphs_against_cycle(
@@ -231,11 +330,9 @@ def plot_graphs_against_cycle(
 ) -> list:
     graphs = []
     for variable_name in variables:
-        function = []
         if y_axis_name == None:
             y_axis_name = variable_name
-        for cycle in solution.cycles:
-            function += cycle[variable_name].entries.tolist()
+        function = concatenate_cycles(solution, variable_name)
 
         cycles_array = np.linspace(0, number_of_cycles, len(function))
         graphs.append(
@@ -249,7 +346,7 @@ def plot_graphs_against_cycle(
             {
                 "name": y_axis_name,
                 "fname": variables[variable_name],
-                "values": function,
+                "values": function.tolist(),
             }
         )
 
@@ -327,36 +424,50 @@ def update_parameters(
         )
 
 
+# Everything the sweeps read, their built model is pruned down to these
+SWEEP_OUTPUTS = outputs.OutputVariables(
+    ["Voltage [V]", "Throughput capacity [A.h]", "Discharge capacity [A.h]"]
+)
+
+
+# Title and capacity axis of the "Charge" and "Discharge" sweeps
+def sweep_labels(mode: str) -> tuple:
+    title = f"{mode.capitalize()[:-1]}ing at different C Rates"
+    if mode == "Charge":
+        return title, "Throughput capacity [A.h]"
+    return title, "Discharge capacity [A.h]"
+
+
 def run_charging_experiments(
     battery_type: str, c_rates: list, mode: str, parameters: pybamm.ParameterValues
 ) -> dict:
-    experiment_result = [{"title": f"{mode.capitalize()[:-1]}ing at different C Rates"}]
+    title, y_axis_label = sweep_labels(mode)
+    experiment_result = [{"title": title}]
     graphs = []
-    model = pybamm.lithium_ion.SPM()
-    solver = pybamm.CasadiSolver("fast", extra_options_setup={"max_num_steps": 10})
-    y_axis_label = None
+    # Every C rate shares one built SPM, only the current and cut-off are inputs
+    built_model = model_cache.get_built_model(
+        pybamm.lithium_ion.SPM, {}, parameters, output_variables=SWEEP_OUTPUTS
+    )
+    capacity = parameters["Nominal cell capacity [A.h]"]
     minV, maxV = get_voltage_limits(battery_type)
+    if mode == "Charge":
+        inputs = model_cache.sweep_inputs(parameters, 0, max_voltage=maxV)
+        direction = -1
+    else:
+        inputs = model_cache.sweep_inputs(parameters, 1, min_voltage=minV)
+        direction = 1
+
+    runs = []
     for c_rate in c_rates:
-
-        if mode == "Charge":
-            experiment = pybamm.Experiment(
-                [f"Charge at {c_rate + 0.01}C for 100 hours or until {maxV} V"]
-            )
-            initial_soc = 0
-            y_axis_label = "Throughput capacity [A.h]"
-        else:
-            experiment = pybamm.Experiment(
-                [f"Discharge at {c_rate+ 0.01}C for 100 hours or until {minV} V"]
-            )
-            initial_soc = 1
-            y_axis_label = "Discharge capacity [A.h]"
-
         print(f"Running simulation C Rate: {c_rate} {mode.lower()[:-1]}ing\n")
-
-        sim = pybamm.Simulation(
-            model, parameter_values=parameters, experiment=experiment
-        )
-        sol = sim.solve(initial_soc=initial_soc, solver=solver)
+        current = direction * (c_rate + 0.01) * capacity
+        runs.append({**inputs, "Current function [A]": current})
+    # Same 100 hour window and one minute sampling as the old experiment step, every
+    # C rate in one solve
+    with tracing.span("solve", f"{mode} x{len(runs)}"):
+        solutions = built_model.solve_batch(runs, 100 * 3600)
+
+    for c_rate, sol in zip(c_rates, solutions):
         graphs.append(
             {"name": y_axis_label, "values": sol[y_axis_label].entries.tolist()}
         )